@@ -0,0 +1,536 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import json
+import time
+import copy
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import yaml
+from harness import ROOT, FakeContext, load_handler, use_endpoint
+
+
+# Runs the state machines in statemachines/ locally, with the Task states invoking the
+# lambda handlers in-process, and records what happens: a timeline of every state
+# entered, the number of state transitions, and the lambda invocations and their
+# durations. From these, the cost of a run is estimated.
+#
+# Only the subset of the Amazon States Language used by this project is supported:
+# Pass, Task, Choice, Map (inline, with MaxConcurrency or MaxConcurrencyPath, or
+# distributed, with an S3 JSON ItemReader), Succeed and Fail states, InputPath,
+# Parameters, ResultSelector, ResultPath and OutputPath, States.Format and
+# States.ArrayContains, Retry, nested
+# executions through startExecution.sync, and S3 calls through the aws-sdk integration.
+# Map iterations run on a real thread pool.
+#
+# Which lambda or state machine each substitution in a definition refers to, and the
+# memory size of each lambda, are read from template.yaml. Substitutions referring to
+# template parameters take the parameter default unless overridden.
+#
+# Example, against an S3-compatible store with the environment of the lambdas set:
+#
+#   benchmarks/asl_local.py CombineLogFilesSM --input '{"date": "2024-03-05"}' \
+#       --substitute ControlTowerBucketName=aws-controltower-logs-111122223333-xx-xxxxx-1 \
+#       --substitute OtherBucketNames=aws-controltower-s3-access-logs \
+#       --endpoint-url http://127.0.0.1:5000 --trace trace.json
+
+TEMPLATE = ROOT / 'template.yaml'
+
+# The largest number of iterations run at a time by a Map with MaxConcurrency 0, as
+# for an inline Map in Step Functions
+MAX_MAP_CONCURRENCY = 40
+
+# Prices in us-east-1, used for the cost estimate
+PRICE_PER_TRANSITION = 0.000025
+PRICE_PER_GB_SECOND = 0.0000166667
+PRICE_PER_INVOCATION = 0.0000002
+
+FUNCTION_PREFIX = 'local:function:'
+STATE_MACHINE_PREFIX = 'local:stateMachine:'
+AWS_SDK_S3_PREFIX = 'arn:aws:states:::aws-sdk:s3:'
+
+INTRINSIC_FORMAT = re.compile(r"States\.Format\('((?:[^'\\]|\\.)*)'((?:\s*,\s*[^,)]+)*)\s*\)$")
+INTRINSIC_ARRAY_CONTAINS = re.compile(r"States\.ArrayContains\(\s*(\$[^,]*?)\s*,\s*([^,)]+?)\s*\)$")
+
+
+class StatesError(Exception):
+
+    def __init__(self, error, cause=''):
+        super().__init__(f'{error}: {cause}')
+        self.error = error
+        self.cause = cause
+
+
+def load_template(path=TEMPLATE):
+    # CloudFormation tags such as !Ref and !GetAtt are read as {'Ref': ...} and so on
+    class Loader(yaml.SafeLoader):
+        pass
+
+    def tag(loader, suffix, node):
+        if isinstance(node, yaml.ScalarNode):
+            value = loader.construct_scalar(node)
+        elif isinstance(node, yaml.SequenceNode):
+            value = loader.construct_sequence(node, deep=True)
+        else:
+            value = loader.construct_mapping(node, deep=True)
+        return {suffix: value}
+
+    Loader.add_multi_constructor('!', tag)
+    with open(path) as f:
+        return yaml.load(f, Loader=Loader)
+
+
+class Workflow:
+
+    def __init__(self, template_path=TEMPLATE, overrides=None, lambda_timeout=None, retry_scale=1.0):
+        template = load_template(template_path)
+        globals_ = template.get('Globals', {}).get('Function', {})
+        parameters = template.get('Parameters', {})
+        resources = template['Resources']
+        overrides = overrides or {}
+
+        self.retry_scale = retry_scale
+        self.lambda_timeout = lambda_timeout or globals_.get('Timeout', 900)
+        self.functions = {}
+        self.machines = {}
+        for name, resource in resources.items():
+            properties = resource.get('Properties', {})
+            if resource['Type'] == 'AWS::Serverless::Function':
+                self.functions[name] = {
+                    'directory': os.path.basename(properties['CodeUri'].rstrip('/')),
+                    'memory': properties.get('MemorySize', globals_.get('MemorySize', 128)),
+                }
+
+        def resolve(key, value):
+            if key in overrides:
+                return overrides[key]
+            if isinstance(value, dict) and 'GetAtt' in value:
+                return FUNCTION_PREFIX + value['GetAtt'].split('.')[0]
+            if isinstance(value, dict) and 'Ref' in value:
+                ref = value['Ref']
+                if resources.get(ref, {}).get('Type') == 'AWS::Serverless::StateMachine':
+                    return STATE_MACHINE_PREFIX + ref
+                return str(parameters.get(ref, {}).get('Default', ''))
+            return str(value)
+
+        for name, resource in resources.items():
+            if resource['Type'] == 'AWS::Serverless::StateMachine':
+                properties = resource['Properties']
+                with open(ROOT / properties['DefinitionUri']) as f:
+                    text = f.read()
+                for key, value in properties.get('DefinitionSubstitutions', {}).items():
+                    text = text.replace('${' + key + '}', resolve(key, value))
+                self.machines[name] = yaml.safe_load(text)
+
+        self.handlers = {}
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.timeline = []
+        self.transitions = 0
+        self.invocations = []
+
+    # ---------------------------------------------------------------------------
+    # Running
+
+    def run(self, machine_name, data):
+        self.start_time = time.perf_counter()
+        return self._execute(machine_name, data, machine_name)
+
+    def _execute(self, machine_name, data, path):
+        execution_id = f'local:execution:{machine_name}:{random.getrandbits(32):08x}'
+        context = {'Execution': {'Id': execution_id, 'Input': data}}
+        return self._run_states(self.machines[machine_name], data, context, path)
+
+    def _run_states(self, machine, data, context, path):
+        name = machine['StartAt']
+        while True:
+            state = machine['States'][name]
+            data, next_name = self._enter(name, state, data, context, f'{path} / {name}')
+            if next_name is None:
+                return data
+            name = next_name
+
+    def _enter(self, name, state, data, context, path):
+        with self.lock:
+            self.transitions += 1
+        start = time.perf_counter()
+        error = None
+        try:
+            return self._run_state(state, data, context, path)
+        except StatesError as e:
+            error = e.error
+            raise
+        finally:
+            with self.lock:
+                self.timeline.append({
+                    'state': path,
+                    'type': state['Type'],
+                    'start': start - self.start_time,
+                    'end': time.perf_counter() - self.start_time,
+                    'thread': threading.get_ident(),
+                    'error': error,
+                })
+
+    def _run_state(self, state, data, context, path):
+        kind = state['Type']
+        state_input = get_path(data, state.get('InputPath', '$'), context)
+
+        if kind == 'Choice':
+            for choice in state.get('Choices', []):
+                if evaluate_choice(choice, state_input, context):
+                    return get_path(state_input, state.get('OutputPath', '$'), context), choice['Next']
+            if 'Default' not in state:
+                raise StatesError('States.NoChoiceMatched', path)
+            return get_path(state_input, state.get('OutputPath', '$'), context), state['Default']
+
+        if kind == 'Succeed':
+            return get_path(state_input, state.get('OutputPath', '$'), context), None
+
+        if kind == 'Fail':
+            raise StatesError(state.get('Error', 'States.Fail'), state.get('Cause', ''))
+
+        effective_input = state_input
+        if 'Parameters' in state and kind != 'Map':
+            effective_input = evaluate_parameters(state['Parameters'], state_input, context)
+
+        if kind == 'Pass':
+            result = state.get('Result', effective_input)
+        elif kind == 'Task':
+            result = self._with_retries(state, lambda: self._run_task(state, effective_input, path), path)
+        elif kind == 'Map':
+            result = self._run_map(state, state_input, context, path)
+        else:
+            raise StatesError('States.Runtime', f"Unsupported state type {kind} in {path}")
+
+        if 'ResultSelector' in state:
+            result = evaluate_parameters(state['ResultSelector'], result, context)
+        output = set_path(data if 'InputPath' not in state else state_input,
+                          state.get('ResultPath', '$'), result)
+        output = get_path(output, state.get('OutputPath', '$'), context)
+        return output, None if state.get('End') else state['Next']
+
+    def _with_retries(self, state, action, path):
+        attempts = {}
+        while True:
+            try:
+                return action()
+            except StatesError as e:
+                retrier = next((r for r in state.get('Retry', []) if error_matches(e.error, r['ErrorEquals'])), None)
+                if retrier is None:
+                    raise
+                n = attempts.get(id(retrier), 0)
+                if n >= retrier.get('MaxAttempts', 3):
+                    raise
+                attempts[id(retrier)] = n + 1
+                delay = retrier.get('IntervalSeconds', 1) * retrier.get('BackoffRate', 2.0) ** n
+                print(f"{path}: retrying after {e.error}", file=sys.stderr)
+                time.sleep(delay * self.retry_scale)
+                with self.lock:
+                    self.transitions += 1
+
+    def _run_task(self, state, data, path):
+        resource = state['Resource']
+        if resource.startswith(FUNCTION_PREFIX):
+            return self._invoke(resource[len(FUNCTION_PREFIX):], data, path)
+        if resource.startswith('arn:aws:states:::states:startExecution.sync'):
+            machine = data['StateMachineArn']
+            if not machine.startswith(STATE_MACHINE_PREFIX):
+                raise StatesError('States.Runtime', f"Unknown state machine {machine}")
+            output = self._execute(machine[len(STATE_MACHINE_PREFIX):], data.get('Input', {}), path)
+            # The original integration returns the output as a JSON string, :2 as JSON
+            return {'Status': 'SUCCEEDED', 'Output': output if resource.endswith(':2') else json.dumps(output)}
+        if resource.startswith(AWS_SDK_S3_PREFIX):
+            action = re.sub(r'(?<!^)(?=[A-Z])', '_', resource[len(AWS_SDK_S3_PREFIX):]).lower()
+            try:
+                response = getattr(boto3.client('s3'), action)(**data)
+            except Exception as e:
+                raise StatesError(f'S3.{type(e).__name__}', str(e)) from e
+            response.pop('ResponseMetadata', None)
+            return json.loads(json.dumps(response, default=str))
+        raise StatesError('States.Runtime', f"Unsupported resource {resource} in {path}")
+
+    def _invoke(self, function_name, data, path):
+        with self.lock:
+            if function_name not in self.handlers:
+                self.handlers[function_name] = load_handler(self.functions[function_name]['directory'])
+        handler = self.handlers[function_name]
+
+        start = time.perf_counter()
+        try:
+            # Payloads pass through JSON, as they would in Step Functions
+            result = handler(json.loads(json.dumps(data)), FakeContext(self.lambda_timeout))
+            return json.loads(json.dumps(result))
+        except Exception as e:
+            raise StatesError(type(e).__name__, str(e)) from e
+        finally:
+            with self.lock:
+                self.invocations.append({
+                    'function': function_name,
+                    'state': path,
+                    'seconds': time.perf_counter() - start,
+                    'memory': self.functions[function_name]['memory'],
+                })
+
+    def _run_map(self, state, data, context, path):
+        if 'ItemReader' in state:
+            items = self._read_items(state['ItemReader'], data, context, path)
+        else:
+            items = get_path(data, state.get('ItemsPath', '$'), context)
+        processor = state.get('ItemProcessor') or state['Iterator']
+        parameters = state.get('ItemSelector') or state.get('Parameters')
+        if 'MaxConcurrencyPath' in state:
+            concurrency = get_path(data, state['MaxConcurrencyPath'], context) or MAX_MAP_CONCURRENCY
+        else:
+            concurrency = state.get('MaxConcurrency', 0) or MAX_MAP_CONCURRENCY
+
+        def iterate(index, item):
+            item_context = {**context, 'Map': {'Item': {'Index': index, 'Value': item}}}
+            item_input = evaluate_parameters(parameters, data, item_context) if parameters else item
+            return self._run_states(processor, item_input, item_context, f'{path} [{index}]')
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return list(pool.map(iterate, range(len(items)), items))
+
+    def _read_items(self, reader, data, context, path):
+        if reader['Resource'] != 'arn:aws:states:::s3:getObject' or \
+                reader.get('ReaderConfig', {}).get('InputType') != 'JSON':
+            raise StatesError('States.Runtime', f"Unsupported ItemReader in {path}")
+        parameters = evaluate_parameters(reader['Parameters'], data, context)
+        try:
+            response = boto3.client('s3').get_object(Bucket=parameters['Bucket'], Key=parameters['Key'])
+        except Exception as e:
+            raise StatesError('States.ItemReaderFailed', str(e)) from e
+        return json.loads(response['Body'].read())
+
+    # ---------------------------------------------------------------------------
+    # Reporting
+
+    def report(self):
+        wall = max((entry['end'] for entry in self.timeline), default=0)
+        gb_seconds = sum(i['seconds'] * i['memory'] / 1024 for i in self.invocations)
+        cost = (self.transitions * PRICE_PER_TRANSITION + gb_seconds * PRICE_PER_GB_SECOND +
+                len(self.invocations) * PRICE_PER_INVOCATION)
+
+        states = {}
+        for entry in self.timeline:
+            # Map iterations are folded together by dropping their indices
+            name = ' / '.join(part.split(' [')[0] for part in entry['state'].split(' / '))
+            figures = states.setdefault(name, {'entered': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            seconds = entry['end'] - entry['start']
+            figures['entered'] += 1
+            figures['seconds'] += seconds
+            figures['max_seconds'] = max(figures['max_seconds'], seconds)
+
+        return {
+            'seconds': wall,
+            'transitions': self.transitions,
+            'invocations': len(self.invocations),
+            'gb_seconds': gb_seconds,
+            'estimated_cost': cost,
+            'states': states,
+        }
+
+    def chrome_trace(self):
+        # The timeline in the Trace Event Format, for chrome://tracing or Perfetto
+        return {'traceEvents': [
+            {
+                'name': entry['state'].rsplit(' / ', 1)[-1],
+                'cat': entry['type'],
+                'ph': 'X',
+                'ts': entry['start'] * 1e6,
+                'dur': (entry['end'] - entry['start']) * 1e6,
+                'pid': 1,
+                'tid': entry['thread'],
+                'args': {'path': entry['state'], 'error': entry['error']},
+            }
+            for entry in self.timeline
+        ]}
+
+
+# -------------------------------------------------------------------------------
+# Paths, parameters and choices
+
+def split_path(path):
+    parts = []
+    for part in path.split('.')[1:]:
+        while '[' in part:
+            name, _, rest = part.partition('[')
+            if name:
+                parts.append(name)
+            index, _, part = rest.partition(']')
+            parts.append(int(index))
+        if part:
+            parts.append(part)
+    return parts
+
+
+def get_path(data, path, context=None):
+    if path is None:
+        return {}
+    if path.startswith('$$'):
+        data, path = context, path[1:]
+    for part in split_path(path):
+        try:
+            data = data[part]
+        except (KeyError, IndexError, TypeError):
+            raise StatesError('States.Runtime', f"Invalid path {path}")
+    return data
+
+
+def set_path(data, path, value):
+    if path is None:
+        return data
+    parts = split_path(path)
+    if not parts:
+        return value
+    data = copy.deepcopy(data) if isinstance(data, dict) else {}
+    target = data
+    for part in parts[:-1]:
+        target = target.setdefault(part, {})
+    target[parts[-1]] = value
+    return data
+
+
+def evaluate_parameters(parameters, data, context):
+    if isinstance(parameters, dict):
+        result = {}
+        for key, value in parameters.items():
+            if key.endswith('.$'):
+                result[key[:-2]] = evaluate_path(value, data, context)
+            else:
+                result[key] = evaluate_parameters(value, data, context)
+        return result
+    if isinstance(parameters, list):
+        return [evaluate_parameters(value, data, context) for value in parameters]
+    return parameters
+
+
+def evaluate_path(value, data, context):
+    # A path, or a States.Format or States.ArrayContains intrinsic with paths or string
+    # literals as arguments
+    if value.startswith('$'):
+        return get_path(data, value, context)
+    match = INTRINSIC_ARRAY_CONTAINS.match(value.strip())
+    if match:
+        array, item = match.groups()
+        item = get_path(data, item, context) if item.startswith('$') else item.strip("'")
+        return item in get_path(data, array, context)
+    match = INTRINSIC_FORMAT.match(value.strip())
+    if not match:
+        raise StatesError('States.Runtime', f"Unsupported intrinsic function: {value}")
+    template = match.group(1).replace("\\'", "'")
+    args = [arg.strip() for arg in match.group(2).split(',')[1:]]
+    values = [get_path(data, arg, context) if arg.startswith('$') else arg.strip("'") for arg in args]
+    pieces = template.split('{}')
+    if len(pieces) != len(values) + 1:
+        raise StatesError('States.Runtime', f"Wrong number of arguments: {value}")
+    result = pieces[0]
+    for v, piece in zip(values, pieces[1:]):
+        result += str(v) + piece
+    return result
+
+
+COMPARISONS = {
+    'StringEquals': lambda a, b: isinstance(a, str) and a == b,
+    'StringLessThan': lambda a, b: isinstance(a, str) and a < b,
+    'StringGreaterThan': lambda a, b: isinstance(a, str) and a > b,
+    'NumericEquals': lambda a, b: is_number(a) and a == b,
+    'NumericLessThan': lambda a, b: is_number(a) and a < b,
+    'NumericLessThanEquals': lambda a, b: is_number(a) and a <= b,
+    'NumericGreaterThan': lambda a, b: is_number(a) and a > b,
+    'NumericGreaterThanEquals': lambda a, b: is_number(a) and a >= b,
+    'BooleanEquals': lambda a, b: isinstance(a, bool) and a == b,
+    'IsNull': lambda a, b: (a is None) == b,
+}
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def evaluate_choice(rule, data, context):
+    if 'And' in rule:
+        return all(evaluate_choice(r, data, context) for r in rule['And'])
+    if 'Or' in rule:
+        return any(evaluate_choice(r, data, context) for r in rule['Or'])
+    if 'Not' in rule:
+        return not evaluate_choice(rule['Not'], data, context)
+
+    try:
+        value = get_path(data, rule['Variable'], context)
+        present = True
+    except StatesError:
+        value, present = None, False
+    if 'IsPresent' in rule:
+        return present == rule['IsPresent']
+    if not present:
+        raise StatesError('States.Runtime', f"Invalid path {rule['Variable']}")
+
+    for operator, compare in COMPARISONS.items():
+        if operator in rule:
+            return compare(value, rule[operator])
+        if operator + 'Path' in rule:
+            return compare(value, get_path(data, rule[operator + 'Path'], context))
+    raise StatesError('States.Runtime', f"Unsupported choice rule {rule}")
+
+
+def error_matches(error, error_equals):
+    return error in error_equals or 'States.ALL' in error_equals or (
+        'States.TaskFailed' in error_equals and not error.startswith('States.'))
+
+
+# -------------------------------------------------------------------------------
+
+def print_report(report):
+    print(f"Wall time:           {report['seconds']:.2f} s")
+    print(f"State transitions:   {report['transitions']}")
+    print(f"Lambda invocations:  {report['invocations']}")
+    print(f"Lambda GB-seconds:   {report['gb_seconds']:.2f}")
+    print(f"Estimated cost:      ${report['estimated_cost']:.6f}")
+    print()
+    print(f"{'entered':>9}{'seconds':>10}{'max':>9}   state")
+    for name, figures in sorted(report['states'].items(), key=lambda x: -x[1]['seconds']):
+        print(f"{figures['entered']:>9}{figures['seconds']:>10.2f}{figures['max_seconds']:>9.2f}   {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a state machine of the template locally.")
+    parser.add_argument('state_machine', help="The logical ID of the state machine, e.g. CombineLogFilesSM")
+    parser.add_argument('--input', default='{}', help="The execution input, as JSON")
+    parser.add_argument('--substitute', action='append', default=[], metavar='NAME=VALUE',
+                        help="Overrides a definition substitution. May be repeated.")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help="Sets an environment variable of the lambdas. May be repeated.")
+    parser.add_argument('--endpoint-url', help="The S3 endpoint, for S3-compatible storage")
+    parser.add_argument('--lambda-timeout', type=int, help="The lambda timeout in seconds. Default: as in the template.")
+    parser.add_argument('--retry-scale', type=float, default=1.0, help="Scales the retry intervals")
+    parser.add_argument('--trace', help="Write the timeline to this file, in the Trace Event Format")
+    parser.add_argument('--save', help="Save the report as JSON to this file")
+    args = parser.parse_args()
+
+    if args.endpoint_url:
+        use_endpoint(args.endpoint_url)
+    os.environ.update(dict(setting.split('=', 1) for setting in args.env))
+
+    workflow = Workflow(overrides=dict(s.split('=', 1) for s in args.substitute),
+                        lambda_timeout=args.lambda_timeout, retry_scale=args.retry_scale)
+    output = workflow.run(args.state_machine, json.loads(args.input))
+    print(json.dumps(output, indent=2))
+    print()
+
+    report = workflow.report()
+    print_report(report)
+    if args.trace:
+        with open(args.trace, 'w') as f:
+            json.dump(workflow.chrome_trace(), f)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import importlib.util
+import subprocess
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+from urllib.parse import unquote
+
+ROOT = Path(__file__).resolve().parent.parent
+FUNCTIONS = ROOT / 'functions'
+sys.path.insert(0, str(ROOT / 'layers' / 'common'))
+
+
+# The pieces needed to run the lambda handlers locally against an S3 stand-in, and to
+# measure what they do: a fake Lambda context, a loader for the handlers, a meter of
+# S3 API calls and bytes, and a recorder of per-stage figures.
+
+
+# A stand-in for the Lambda context, counting down from the function timeout
+class FakeContext:
+
+    def __init__(self, timeout=900):
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+
+def start_local_s3(port=None, timeout=60):
+    # Starts a moto server in a process of its own, so that its memory use doesn't
+    # count towards that of the handlers. Returns the process and the endpoint URL once
+    # the server accepts connections, which can take a while on a cold start.
+    if port is None:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'moto.server', '--port', str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    endpoint_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The local S3 server exited with code {process.returncode}; is moto[server] installed?")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return process, endpoint_url
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"The local S3 server didn't start within {timeout} seconds")
+
+
+def use_endpoint(endpoint_url):
+    # Makes all boto3 clients created from now on, including those of the handlers,
+    # talk to the given endpoint
+    os.environ['AWS_ENDPOINT_URL_S3'] = endpoint_url
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+
+def load_handler(name):
+    # Loads functions/{name}/app.py as a module of its own. Each function directory is
+    # on the path while its module is loaded, so that it can import its own modules.
+    directory = str(FUNCTIONS / name)
+    sys.path.insert(0, directory)
+    try:
+        spec = importlib.util.spec_from_file_location(f'{name}_app', f'{directory}/app.py')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+    return module.lambda_handler
+
+
+# Counts the S3 API calls made by all boto3 clients of the default session, by
+# operation, along with the bytes downloaded, uploaded and copied within S3. The sizes
+# of objects copied with CopyObject are taken from the known sizes, if any.
+class S3Meter:
+
+    def __init__(self, known_sizes=None):
+        self.known_sizes = known_sizes if known_sizes is not None else {}
+        self.calls = Counter()
+        self.bytes = Counter()
+        self.lock = threading.Lock()
+
+    def install(self, session):
+        session.events.register('before-parameter-build.s3', self._before_call)
+        session.events.register('after-call.s3', self._after_call)
+
+    def reset(self):
+        with self.lock:
+            self.calls = Counter()
+            self.bytes = Counter()
+
+    def _before_call(self, params, model, **_kwargs):
+        copied = uploaded = 0
+        if model.name in ('PutObject', 'UploadPart'):
+            uploaded = body_size(params.get('Body', b''))
+        elif model.name == 'UploadPartCopy':
+            first, last = params['CopySourceRange'].split('=')[1].split('-')
+            copied = int(last) - int(first) + 1
+        elif model.name == 'CopyObject':
+            copied = self.known_sizes.get(copy_source(params['CopySource']), 0)
+        with self.lock:
+            self.calls[model.name] += 1
+            self.bytes['uploaded'] += uploaded
+            self.bytes['copied'] += copied
+
+    def _after_call(self, parsed, model, **_kwargs):
+        if model.name == 'GetObject':
+            with self.lock:
+                self.bytes['downloaded'] += parsed.get('ContentLength', 0)
+
+
+def body_size(body):
+    # The size of the Body of an upload, which botocore may already have wrapped in a
+    # file-like object
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    if hasattr(body, 'seek') and hasattr(body, 'tell'):
+        position = body.tell()
+        size = body.seek(0, os.SEEK_END) - position
+        body.seek(position)
+        return size
+    return 0
+
+
+def copy_source(source):
+    # Returns the (bucket, key) of the CopySource of a copy, given as a dict or, once
+    # botocore has serialised it, as the string 'bucket/key[?versionId=...]', URL-encoded
+    if isinstance(source, dict):
+        return source['Bucket'], source['Key']
+    bucket, _, key = unquote(source.partition('?versionId=')[0]).lstrip('/').partition('/')
+    return bucket, key
+
+
+# Runs handler invocations as stages, recording the wall time, S3 calls and bytes, peak
+# Python memory use and the largest payload passed, per stage. Invocations are run one
+# at a time so that everything measured can be attributed to a single stage. Payloads
+# are passed through JSON, as they would be by Step Functions.
+class Recorder:
+
+    def __init__(self, meter, timeout=900, trace_memory=True):
+        self.meter = meter
+        self.timeout = timeout
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    def invoke(self, stage, handler, data):
+        figures = self.stages.setdefault(stage, {
+            'invocations': 0,
+            'seconds': 0.0,
+            'calls': Counter(),
+            'bytes': Counter(),
+            'peak_memory': 0,
+            'max_payload': 0,
+        })
+        payload = json.dumps(data)
+        self.meter.reset()
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            result = handler(json.loads(payload), FakeContext(self.timeout))
+        finally:
+            figures['seconds'] += time.perf_counter() - start
+            if self.trace_memory:
+                figures['peak_memory'] = max(figures['peak_memory'], tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            figures['invocations'] += 1
+            figures['calls'] += self.meter.calls
+            figures['bytes'] += self.meter.bytes
+        result_payload = json.dumps(result)
+        figures['max_payload'] = max(figures['max_payload'], len(payload), len(result_payload))
+        return json.loads(result_payload)
+
+    def report(self):
+        return {
+            stage: {**figures, 'calls': dict(figures['calls']), 'bytes': dict(figures['bytes'])}
+            for stage, figures in self.stages.items()
+        }
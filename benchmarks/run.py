@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import argparse
+import boto3
+from botocore.config import Config
+from asl_local import Workflow, print_report as print_workflow_report
+from harness import Recorder, S3Meter, load_handler, start_local_s3, use_endpoint
+from synthetic import (MAIN_LOG_TYPES, SizeDistribution, access_log_keys, control_tower_keys, create_bucket,
+                       parse_date, populate, stream_keys)
+
+
+# Replays a synthetic day of logs through the lambda handlers, the way the state
+# machine would, and reports per stage the wall time, S3 calls by operation, bytes
+# downloaded, uploaded and copied within S3, peak Python memory use, and the largest
+# payload passed between states.
+#
+# By default a local moto server is started as the S3 stand-in; any other S3-compatible
+# endpoint can be given instead. The buckets generated are:
+#
+#   * a Control Tower log bucket with CloudTrail, CloudTrail-Digest and Config logs for
+#     a number of accounts and regions, in the v2 or the v3 layout
+#   * an S3 access log bucket, with many tiny log files
+#   * a bucket of large streamed log files, which are copied rather than combined
+#
+# With --state-machine, the CombineLogFilesSM state machine itself is run by the local
+# interpreter in asl_local.py instead, with its Maps running concurrently, and the
+# state transitions, timeline and estimated cost are reported along with the S3 calls.
+#
+# Example:
+#
+#   benchmarks/run.py --accounts 20 --regions 4 --median-size 20000 --save after.json \
+#       --baseline before.json
+
+ORG_ID = 'o-benchmark'
+TMP_BUCKET = 'benchmark-tmp-logs'
+STATE_BUCKET = 'benchmark-log-aggregator-state'
+DEST_BUCKET = 'benchmark-all-aggregated-logs'
+CT_BUCKET = 'aws-controltower-logs-111122223333-xx-bench-1'
+ACCESS_LOG_BUCKET = 'aws-controltower-s3-access-logs-111122223333-xx-bench-1'
+STREAM_BUCKET = 'cloudwatch-logs-111122223333-xx-bench-1'
+GLACIER_OBJECT_SIZE = 204800
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the lambdas against synthetic log buckets.")
+    parser.add_argument('--date', type=parse_date, default=parse_date('2024-03-05'))
+    parser.add_argument('--layout', choices=['v2', 'v3'], default='v3', help="The Control Tower log layout")
+    parser.add_argument('--accounts', type=int, default=5)
+    parser.add_argument('--regions', type=int, default=2)
+    parser.add_argument('--files-per-hour', type=int, default=12, help="CloudTrail log files per account, region and hour")
+    parser.add_argument('--access-logs-per-hour', type=int, default=200)
+    parser.add_argument('--streams', type=int, default=4)
+    parser.add_argument('--median-size', type=int, default=20000, help="The median size of main and access log files")
+    parser.add_argument('--sigma', type=float, default=1.0, help="The spread of the log-normal size distribution")
+    parser.add_argument('--stream-size', type=int, default=2 * 1024 * 1024, help="The median size of streamed log files")
+    parser.add_argument('--max-archive-size', type=int, default=2 * 1024 * 1024 * 1024)
+    parser.add_argument('--distributed-map-threshold', type=int, default=100000,
+                        help="Lower it to have the access log bucket go through the Distributed Map")
+    parser.add_argument('--max-files-per-part', type=int, default=20000,
+                        help="The most files in each slice of the Distributed Map")
+    parser.add_argument('--recompression-level', type=int, default=0,
+                        help="Recompress the log files into gzip at this level, 1 to 9, as they are combined")
+    parser.add_argument('--lambda-timeout', type=int, default=900,
+                        help="The lambda timeout in seconds; lower it to exercise the continuation loops")
+    parser.add_argument('--no-trace-memory', action='store_true', help="Don't trace memory use, which slows things down")
+    parser.add_argument('--state-machine', action='store_true',
+                        help="Run the state machine with the local interpreter instead of replaying it")
+    parser.add_argument('--trace', help="With --state-machine, write the timeline to this file, in the Trace Event Format")
+    parser.add_argument('--endpoint-url', help="Use this S3-compatible endpoint instead of a local moto server")
+    parser.add_argument('--s3-start-timeout', type=int, default=60,
+                        help="The seconds to wait for the local moto server to start")
+    parser.add_argument('--save', help="Save the figures as JSON to this file")
+    parser.add_argument('--baseline', help="Compare with figures saved earlier")
+    args = parser.parse_args()
+
+    server = None
+    endpoint_url = args.endpoint_url
+    if not endpoint_url:
+        server, endpoint_url = start_local_s3(timeout=args.s3_start_timeout)
+    use_endpoint(endpoint_url)
+
+    os.environ.update({
+        'TMP_LOGS_BUCKET_NAME': TMP_BUCKET,
+        'STATE_BUCKET_NAME': STATE_BUCKET,
+        'DEST_LOGS_BUCKET_NAME': DEST_BUCKET,
+        'FINAL_AGGREGATION_PREFIX': 'AggregatedLogs',
+        'ORG_ID': ORG_ID,
+        'MIN_SIZE': str(GLACIER_OBJECT_SIZE),
+        'MAX_ARCHIVE_SIZE': str(args.max_archive_size),
+        'AGGREGATION_REGIONS': '[]',
+        'DISTRIBUTED_MAP_THRESHOLD': str(args.distributed_map_threshold),
+        'MAX_FILES_PER_PART': str(args.max_files_per_part),
+        'RECOMPRESSION_LEVEL': str(args.recompression_level),
+    })
+
+    try:
+        known_sizes = generate(args)
+        meter = S3Meter(known_sizes)
+        boto3.setup_default_session()
+        meter.install(boto3.DEFAULT_SESSION)
+        if args.state_machine:
+            workflow = run_state_machine(args.date.strftime('%Y-%m-%d'), args.lambda_timeout)
+        else:
+            recorder = Recorder(meter, args.lambda_timeout, not args.no_trace_memory)
+            replay(recorder, args.date.strftime('%Y-%m-%d'))
+    finally:
+        if server:
+            server.terminate()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.state_machine:
+        figures = {**workflow.report(), 'calls': dict(meter.calls), 'bytes': dict(meter.bytes)}
+        print_workflow_report(figures)
+        print_totals(figures, baseline)
+        if args.trace:
+            with open(args.trace, 'w') as f:
+                json.dump(workflow.chrome_trace(), f)
+    else:
+        figures = recorder.report()
+        print_report(figures, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(figures, f, indent=2)
+
+
+def generate(args):
+    s3_client = boto3.client('s3', config=Config(max_pool_connections=32))
+    regions = ['us-east-1', 'eu-west-1', 'eu-north-1', 'ap-southeast-2', 'us-west-2', 'eu-central-1'][:args.regions]
+    accounts = [f'{111111111111 * (n + 1) % 10 ** 12:012d}' for n in range(args.accounts)]
+    sizes = SizeDistribution(args.median_size, args.sigma)
+
+    for bucket, versioned in [(TMP_BUCKET, False), (STATE_BUCKET, False), (DEST_BUCKET, True), (CT_BUCKET, True),
+                              (ACCESS_LOG_BUCKET, True), (STREAM_BUCKET, True)]:
+        create_bucket(s3_client, bucket, versioned)
+
+    known_sizes = {}
+    print("Generating synthetic log buckets...", file=sys.stderr)
+    for bucket, keys, distribution in [
+        (CT_BUCKET, control_tower_keys(ORG_ID, accounts, regions, args.date, args.layout, args.files_per_hour), sizes),
+        (ACCESS_LOG_BUCKET, access_log_keys(args.date, args.access_logs_per_hour), SizeDistribution(2000, args.sigma)),
+        (STREAM_BUCKET, stream_keys(args.date, args.streams), SizeDistribution(args.stream_size, 0.5, GLACIER_OBJECT_SIZE)),
+    ]:
+        objects = populate(s3_client, bucket, keys, distribution, args.date)
+        known_sizes.update({(bucket, key): size for key, size in objects.items()})
+        print(f"  {bucket}: {len(objects)} files, {sum(objects.values())} bytes", file=sys.stderr)
+    return known_sizes
+
+
+def replay(recorder, date):
+    # Follows the paths of the combine_log_files state machine, one invocation at a time
+    s3_client = boto3.client('s3')
+    handlers = {name: load_handler(name) for name in [
+        'get_control_tower_account_ids', 'process_account', 'get_files',
+        'determine_operation_type', 'shard_files', 'determine_archive_key', 'combine_log_files',
+        'copy_log_files', 'delete_originals', 'assemble_slices', 'record_done',
+    ]}
+
+    def invoke(name, data):
+        return recorder.invoke(name, handlers[name], data)
+
+    # Each returns the statuses of the last invocations, for Check Bucket Status
+    def combine_parts(data, parts):
+        if isinstance(parts, dict):
+            # Handed to AggregateSlicesSM, which combines the slices, each at its key, and
+            # then assembles them into their archives. The originals go only at the end.
+            for item in read_list(parts['slicesKey']):
+                combine({**data, **item}, 'combine_log_files')
+            for item in read_list(parts['assembliesKey']):
+                assemble({'bucket_name': data['bucket_name'], 'key': item['key'], 'files': item['files']})
+            return [delete(data)]
+        statuses = []
+        for part in parts:
+            item = {**data, 'shard': part['shard'], 'part': part['part'], 'files': part['files']}
+            item['key'] = invoke('determine_archive_key', item)
+            combine(item, 'combine_log_files')
+            statuses.append(delete(item))
+        return statuses
+
+    def read_list(key):
+        return json.loads(s3_client.get_object(Bucket=TMP_BUCKET, Key=key)['Body'].read())
+
+    def assemble(data):
+        while True:
+            data['assembleSlicesResult'] = invoke('assemble_slices', data)
+            if 'continuationMarker' not in data['assembleSlicesResult']:
+                break
+
+    def combine_and_delete(data, operation):
+        combine(data, operation)
+        return [data['combineMainLogsResult'].get('status'), delete(data)]
+
+    def combine(data, operation):
+        while True:
+            data['combineMainLogsResult'] = invoke(operation, data)
+            if 'continuationMarker' not in data['combineMainLogsResult']:
+                break
+
+    def delete(data):
+        while True:
+            data['deleteOriginalsResult'] = invoke('delete_originals', data)
+            if 'continuationMarker' not in data['deleteOriginalsResult']:
+                return data['deleteOriginalsResult'].get('status')
+
+    # Main logs, per log type and account
+    for log_type in MAIN_LOG_TYPES:
+        data = {'bucket_name': CT_BUCKET, 'date': date, 'log_type': log_type}
+        for account_prefix in invoke('get_control_tower_account_ids', data):
+            account = {**data, 'account_prefix': account_prefix}
+            while True:
+                account['processAccountResult'] = invoke('process_account', account)
+                if 'continuationMarker' not in account['processAccountResult']:
+                    break
+
+    # Other log buckets
+    for bucket_name in [ACCESS_LOG_BUCKET, STREAM_BUCKET]:
+        data = {'bucket_name': bucket_name, 'date': date}
+        data['files'] = invoke('get_files', data)
+        data['operation_type'] = invoke('determine_operation_type', data)
+        if data['operation_type'] == 'none':
+            continue
+        if data['operation_type'] == 'copy_all':
+            statuses = combine_and_delete(data, 'copy_log_files')
+        else:
+            statuses = combine_parts(data, invoke('shard_files', data))
+        if 'error' not in statuses:
+            invoke('record_done', data)
+
+
+def run_state_machine(date, lambda_timeout):
+    # The S3 meter is never reset here, so it counts the calls of the whole execution
+    workflow = Workflow(overrides={
+        'ControlTowerBucketName': CT_BUCKET,
+        'OtherBucketNames': f'{ACCESS_LOG_BUCKET},{STREAM_BUCKET}',
+        'TmpLogsBucketName': TMP_BUCKET,
+    }, lambda_timeout=lambda_timeout)
+    workflow.run('CombineLogFilesSM', {'date': date})
+    return workflow
+
+
+def print_report(figures, baseline=None):
+    header = f"{'stage':<32}{'invocations':>12}{'seconds':>10}{'S3 calls':>10}{'MB down':>9}{'MB up':>8}" \
+             f"{'MB copied':>11}{'peak MB':>9}{'payload KB':>12}"
+    print(header)
+    print('-' * len(header))
+    mb = 1024 * 1024
+    for stage, f in figures.items():
+        calls = sum(f['calls'].values())
+        line = f"{stage:<32}{f['invocations']:>12}{f['seconds']:>10.2f}{calls:>10}" \
+               f"{f['bytes'].get('downloaded', 0) / mb:>9.1f}{f['bytes'].get('uploaded', 0) / mb:>8.1f}" \
+               f"{f['bytes'].get('copied', 0) / mb:>11.1f}{f['peak_memory'] / mb:>9.1f}{f['max_payload'] / 1024:>12.1f}"
+        if baseline and stage in baseline:
+            b = baseline[stage]
+            line += f"   time {change(b['seconds'], f['seconds'])}, calls {change(sum(b['calls'].values()), calls)}"
+        print(line)
+
+    print()
+    print("S3 calls by operation:")
+    for stage, f in figures.items():
+        operations = ', '.join(f'{name} {n}' for name, n in sorted(f['calls'].items(), key=lambda x: -x[1]))
+        print(f"  {stage}: {operations}")
+
+
+def print_totals(figures, baseline=None):
+    mb = 1024 * 1024
+    calls = sum(figures['calls'].values())
+    print()
+    print(f"S3 calls:            {calls}")
+    print(f"MB downloaded:       {figures['bytes'].get('downloaded', 0) / mb:.1f}")
+    print(f"MB uploaded:         {figures['bytes'].get('uploaded', 0) / mb:.1f}")
+    print(f"MB copied:           {figures['bytes'].get('copied', 0) / mb:.1f}")
+    if baseline and 'transitions' in baseline:
+        print()
+        print(f"Compared with the baseline: time {change(baseline['seconds'], figures['seconds'])}, "
+              f"transitions {change(baseline['transitions'], figures['transitions'])}, "
+              f"S3 calls {change(sum(baseline['calls'].values()), calls)}, "
+              f"estimated cost {change(baseline['estimated_cost'], figures['estimated_cost'])}")
+
+
+def change(before, after):
+    if not before:
+        return 'n/a'
+    return f'{(after - before) / before:+.0%}'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+import json
+import zlib
+import random
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+
+# Generates synthetic log buckets with the key layouts of the real ones, for the
+# benchmarks. The log files hold what the real ones do, as recompression and the
+# Parquet output read them: gzipped JSON documents of CloudTrail records, digests and
+# Config items, gzipped lines of streamed logs, and plain lines of S3 access logs.
+#
+# File sizes are drawn from a log-normal distribution, given as a median and a sigma,
+# which is a fair model of the sizes of real log files. The size is that of the file
+# as stored, i.e. compressed.
+
+MAIN_LOG_TYPES = ['CloudTrail', 'CloudTrail-Digest', 'Config']
+
+
+class SizeDistribution:
+
+    def __init__(self, median=20000, sigma=1.0, minimum=100, maximum=64 * 1024 * 1024, seed=0):
+        self.median = median
+        self.sigma = sigma
+        self.minimum = minimum
+        self.maximum = maximum
+        self.random = random.Random(seed)
+
+    def sample(self):
+        size = int(self.random.lognormvariate(0, self.sigma) * self.median)
+        return max(self.minimum, min(self.maximum, size))
+
+
+def control_tower_keys(org_id, accounts, regions, date, layout='v3', files_per_hour=12):
+    # Yields the keys of a day's worth of main log files in a Control Tower log bucket.
+    # From Control Tower v3.0, CloudTrail logs are organisation trail logs stored under
+    # an extra level named after the organisation.
+    ymd = date.strftime('%Y%m%d')
+    path = date.strftime('%Y/%m/%d')
+    rand = random.Random(f'{org_id}-{ymd}')
+    for account in accounts:
+        trail_root = f'{org_id}/AWSLogs/{org_id}/{account}' if layout == 'v3' else f'{org_id}/AWSLogs/{account}'
+        config_root = f'{org_id}/AWSLogs/{account}'
+        for region in regions:
+            for hour in range(24):
+                for n in range(files_per_hour):
+                    minute = n * 60 // files_per_hour
+                    yield (f'{trail_root}/CloudTrail/{region}/{path}/'
+                           f'{account}_CloudTrail_{region}_{ymd}T{hour:02d}{minute:02d}Z_{rand.getrandbits(64):016X}.json.gz')
+                yield (f'{trail_root}/CloudTrail-Digest/{region}/{path}/'
+                       f'{account}_CloudTrail-Digest_{region}_{org_id}_{ymd}T{hour:02d}0000Z.json.gz')
+                if hour % 6 == 0:
+                    yield (f'{config_root}/Config/{region}/{path}/ConfigHistory/'
+                           f'{account}_Config_{region}_ConfigHistory_AWS::EC2::Instance_'
+                           f'{ymd}T{hour:02d}0000Z_{ymd}T{hour + 5:02d}5959Z_1.json.gz')
+
+
+def access_log_keys(date, files_per_hour=200):
+    # S3 server access logs: a flat bucket of small, uncompressed log files
+    rand = random.Random(f'access-{date}')
+    for hour in range(24):
+        for _ in range(files_per_hour):
+            time = date + timedelta(hours=hour, seconds=rand.randrange(3600))
+            yield f"{time.strftime('%Y-%m-%d-%H-%M-%S')}-{rand.getrandbits(64):016X}"
+
+
+def stream_keys(date, streams=4, files_per_hour=1):
+    # Large log files from a streaming export, e.g. CloudWatch Logs via Firehose
+    path = date.strftime('%Y/%m/%d')
+    for hour in range(24):
+        for stream in range(streams):
+            for n in range(files_per_hour):
+                yield f'{path}/{hour:02d}/stream-{stream}-{date:%Y-%m-%d}-{hour:02d}-{n:04d}.gz'
+
+
+# Makes the contents of log files of about a given size, quickly. A thousand records
+# are made up and compressed once, in pieces of records_per_piece, each on its own as
+# raw deflate ending with a full flush, so that the pieces can be strung together, in
+# any order and number, into a valid gzip member without compressing anything again;
+# only the CRC is computed per file. The more records per piece, the closer the
+# compression ratio comes to that of real log files, and the larger the smallest file.
+class LogContents:
+
+    def __init__(self, kind, date, seed=0, n_records=1024, records_per_piece=8):
+        rand = random.Random(f'{kind}-{seed}')
+        self.kind = kind
+        self.gzipped = kind != 'access'
+        head, separator, tail, make_record = {
+            'CloudTrail': ('{"Records":[', ',', ']}', cloudtrail_record),
+            'CloudTrail-Digest': ('{"digestPublicKeyFingerprint":"0","logFiles":[', ',', ']}', digest_record),
+            'Config': ('{"fileVersion":"1.0","configurationItems":[', ',', ']}', config_item),
+            'stream': ('', '', '', stream_line),
+            'access': ('', '', '', access_line),
+        }[kind]
+        records = [make_record(rand, date) for _ in range(n_records)]
+        self.head = (head + records[0]).encode()
+        self.pieces = [
+            ''.join(separator + record for record in records[n:n + records_per_piece]).encode()
+            for n in range(1, n_records, records_per_piece)
+        ]
+        self.tail = tail.encode()
+        if self.gzipped:
+            self.compressed_head = raw_deflate(self.head)
+            self.compressed_pieces = [raw_deflate(piece) for piece in self.pieces]
+            self.compressed_tail = raw_deflate(self.tail, final=True)
+
+    def make(self, size, rand):
+        # Returns the contents of a log file of about size bytes
+        if not self.gzipped:
+            data = [self.head]
+            total = len(self.head)
+            while total < size:
+                piece = rand.choice(self.pieces)
+                data.append(piece)
+                total += len(piece)
+            return b''.join(data)
+
+        crc = zlib.crc32(self.head)
+        length = len(self.head)
+        compressed = [self.compressed_head]
+        total = 18 + len(self.compressed_head) + len(self.compressed_tail)
+        while total < size:
+            n = rand.randrange(len(self.pieces))
+            crc = zlib.crc32(self.pieces[n], crc)
+            length += len(self.pieces[n])
+            compressed.append(self.compressed_pieces[n])
+            total += len(self.compressed_pieces[n])
+        crc = zlib.crc32(self.tail, crc)
+        length += len(self.tail)
+        header = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+        trailer = struct.pack('<II', crc, length & 0xffffffff)
+        return header + b''.join(compressed) + self.compressed_tail + trailer
+
+
+def raw_deflate(data, final=False):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_FULL_FLUSH)
+
+
+def random_time(rand, date):
+    return (date + timedelta(seconds=rand.randrange(86400))).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def random_id(rand, bits=128):
+    return f'{rand.getrandbits(bits):0{bits // 4}x}'
+
+
+def cloudtrail_record(rand, date):
+    account = f'{rand.randrange(10 ** 12):012d}'
+    service, name = rand.choice([('s3', 'GetObject'), ('ec2', 'DescribeInstances'), ('sts', 'AssumeRole'),
+                                 ('iam', 'ListRoles'), ('kms', 'Decrypt'), ('signin', 'ConsoleLogin')])
+    return json.dumps({
+        'eventVersion': '1.09',
+        'userIdentity': {'type': 'AssumedRole', 'principalId': f'AROA{random_id(rand, 64).upper()}:session',
+                         'arn': f'arn:aws:sts::{account}:assumed-role/Role/session', 'accountId': account},
+        'eventTime': random_time(rand, date),
+        'eventSource': f'{service}.amazonaws.com',
+        'eventName': name,
+        'awsRegion': rand.choice(['us-east-1', 'eu-west-1', 'eu-north-1']),
+        'sourceIPAddress': f'10.{rand.randrange(256)}.{rand.randrange(256)}.{rand.randrange(256)}',
+        'userAgent': 'aws-sdk-go-v2/1.24.0 os/linux lang/go#1.21.5',
+        'requestParameters': {'resource': random_id(rand)},
+        'responseElements': None,
+        'requestID': random_id(rand),
+        'eventID': random_id(rand),
+        'readOnly': name.startswith(('Get', 'Describe', 'List')),
+        'eventType': 'AwsApiCall',
+        'managementEvent': True,
+        'recipientAccountId': account,
+        'eventCategory': 'Management',
+    })
+
+
+def digest_record(rand, date):
+    return json.dumps({
+        's3Bucket': 'aws-controltower-logs',
+        's3Object': f'AWSLogs/{random_id(rand, 64)}.json.gz',
+        'hashValue': random_id(rand, 256),
+        'hashAlgorithm': 'SHA-256',
+        'newestEventTime': random_time(rand, date),
+        'oldestEventTime': random_time(rand, date),
+    })
+
+
+def config_item(rand, date):
+    resource_id = f'i-{random_id(rand, 64)}'
+    return json.dumps({
+        'configurationItemVersion': '1.3',
+        'configurationItemCaptureTime': random_time(rand, date),
+        'configurationStateId': rand.randrange(10 ** 13),
+        'awsAccountId': f'{rand.randrange(10 ** 12):012d}',
+        'configurationItemStatus': 'OK',
+        'resourceType': 'AWS::EC2::Instance',
+        'resourceId': resource_id,
+        'awsRegion': 'us-east-1',
+        'configuration': {'instanceId': resource_id, 'state': {'name': 'running'}, 'imageId': f'ami-{random_id(rand, 64)}'},
+        'tags': {'Name': random_id(rand, 32)},
+    })
+
+
+def stream_line(rand, date):
+    return json.dumps({'timestamp': random_time(rand, date), 'id': random_id(rand),
+                       'message': f'request {random_id(rand, 64)} served in {rand.randrange(1000)} ms'}) + '\n'
+
+
+def access_line(rand, date):
+    time = (date + timedelta(seconds=rand.randrange(86400))).strftime('%d/%b/%Y:%H:%M:%S +0000')
+    return (f'{random_id(rand, 256)} bucket [{time}] 10.0.{rand.randrange(256)}.{rand.randrange(256)} - '
+            f'{random_id(rand, 64).upper()} REST.GET.OBJECT key/{random_id(rand, 32)} "GET /key HTTP/1.1" 200 - '
+            f'{rand.randrange(10 ** 6)} {rand.randrange(10 ** 6)} {rand.randrange(100)} - "-" "aws-cli/2.15" -\n')
+
+
+def contents_for(key):
+    # The kind of contents for a key of the synthetic buckets
+    for log_type in ['CloudTrail-Digest', 'CloudTrail', 'Config']:
+        if f'/{log_type}/' in key:
+            return log_type
+    return 'stream' if key.endswith('.gz') else 'access'
+
+
+def populate(s3_client, bucket, keys, sizes, date, concurrency=32):
+    # Puts a log file of about a size drawn from the distribution under each key.
+    # Returns a dict from key to size.
+    rand = random.Random(bucket)
+    contents = {}
+    objects = {}
+    for key in keys:
+        kind = contents_for(key)
+        if kind not in contents:
+            contents[kind] = LogContents(kind, date, seed=bucket)
+        objects[key] = (kind, sizes.sample(), rand.getrandbits(32))
+
+    def put(item):
+        key, (kind, size, seed) = item
+        body = contents[kind].make(size, random.Random(seed))
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+        return key, len(body)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return dict(pool.map(put, objects.items()))
+
+
+def create_bucket(s3_client, bucket, versioned=False):
+    s3_client.create_bucket(Bucket=bucket)
+    if versioned:
+        s3_client.put_bucket_versioning(Bucket=bucket, VersioningConfiguration={'Status': 'Enabled'})
+
+
+def parse_date(text):
+    return datetime.strptime(text, '%Y-%m-%d')
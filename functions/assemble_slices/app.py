@@ -0,0 +1,125 @@
+import os
+import logging
+import boto3
+from itertools import chain, islice, tee
+from botocore.config import Config
+from common.archive_index import index_key, read_index
+from common.deletion import delete_files
+from common.manifest import FileList, entry_fields, entry_last_modified
+from common.merge import MultipartMerge, fetch_in_order, map_in_order
+from common.metrics import Metrics
+from common.scheduler import Scheduler
+from common.throttle import RateController
+
+# Configure the logger
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+TMP_LOGS_BUCKET_NAME = os.environ['TMP_LOGS_BUCKET_NAME']
+DEST_LOGS_BUCKET_NAME = os.environ['DEST_LOGS_BUCKET_NAME']
+
+# The size of the parts built from small slices in memory. Must be at least 5 MB.
+MERGE_PART_SIZE = int(os.environ.get('MERGE_PART_SIZE', 8 * 1024 * 1024))
+
+# The maximum number of slices, and of their indexes, being fetched at the same time
+DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', 32))
+
+
+metrics = Metrics('assemble_slices')
+rate_controller = RateController(metrics)
+
+s3_client = rate_controller.instrument(metrics.instrument(boto3.client('s3', config=Config(
+                                max_pool_connections=2 * DOWNLOAD_CONCURRENCY,
+                                retries={'max_attempts': 10}))))
+
+
+# Assembles the slices of an archive of a very large bucket, each combined in a child
+# execution of its own into the temp bucket, into the archive at key, in order, with the same server-side
+# merge as the daily aggregation. The index of the archive is made from the indexes of
+# the slices, their entries shifted to where each slice now begins.
+#
+# Once the archive and its index are in place, the slices and their indexes are deleted
+# from the temp bucket.
+#
+# When the time left runs out, the work left is returned in assembleSlicesResult:
+#
+#   {'continuationMarker': index of the next slice, 'phase': 'combine',
+#    'uploadId': ..., 'partCount': ..., 'offset': ...}, or
+#   {'continuationMarker': index of the next key to delete, 'phase': 'delete'}
+
+@metrics.handler
+def lambda_handler(data, context):
+    dest_bucket_name = DEST_LOGS_BUCKET_NAME or data['bucket_name']
+    key = data['key']
+    slices = FileList(s3_client, TMP_LOGS_BUCKET_NAME, data['files'])
+    state = data.get('assembleSlicesResult', {})
+    phase = state.get('phase', 'combine')
+    start = state.get('continuationMarker', 0)
+
+    scheduler = Scheduler(context)
+    progress = False
+
+    if phase == 'combine':
+        result = assemble(dest_bucket_name, key, slices.entries(start), start, state, scheduler)
+        if result:
+            return result
+        progress = True
+        start = 0
+
+    # Each slice goes along with its index
+    keys = chain.from_iterable((slice, index_key(slice)) for slice in slices.keys(start // 2))
+    index = delete_files(s3_client, TMP_LOGS_BUCKET_NAME, islice(keys, start % 2, None), 2 * len(slices),
+                         start, scheduler, force_first=not progress, metrics=metrics)
+    if index is not None:
+        logger.info(f"Lambda might time out, returning continuationMarker for next invocation: {index}")
+        return {'continuationMarker': index, 'phase': 'delete'}
+
+    return {'status': 'done'}
+
+
+def assemble(dest_bucket_name, key, entries, start, state, scheduler):
+    # Returns None when the archive is complete, or else the state to resume from
+    merge = MultipartMerge(
+        s3_client,
+        dest_bucket_name,
+        key,
+        TMP_LOGS_BUCKET_NAME,
+        upload_id=state.get('uploadId'),
+        part_count=state.get('partCount', 0),
+        offset=state.get('offset'),
+        part_size=MERGE_PART_SIZE
+    )
+
+    # The indexes are read along with the fetches, as far ahead of the merge as they are
+    items = ((index, *entry_fields(entry), entry_last_modified(entry)) for index, entry in enumerate(entries, start=start))
+    items, index_items = tee(items)
+    fetched_slices = fetch_in_order(s3_client, TMP_LOGS_BUCKET_NAME, items, DOWNLOAD_CONCURRENCY)
+    indexes = map_in_order(lambda item: read_index(s3_client, TMP_LOGS_BUCKET_NAME, item[1]), index_items, DOWNLOAD_CONCURRENCY)
+
+    try:
+        for n, ((index, slice, size, etag, last_modified, body), slice_index) in enumerate(zip(fetched_slices, indexes)):
+            operation = 'append' if body is not None else 'copy'
+            if n > 0 and not scheduler.fits(operation, size):
+                logger.info(f"Lambda might time out, returning continuationMarker for next invocation: {index}")
+                return {'continuationMarker': index, 'phase': 'combine', **merge.suspend()}
+
+            with scheduler.timed(operation, size):
+                merge.add(TMP_LOGS_BUCKET_NAME, slice, size, etag, body, last_modified, slice_index)
+            metrics.add('SlicesAssembled', 1)
+            metrics.add('BytesMerged', size, 'Bytes')
+
+        merge.complete()
+
+    except Exception:
+        # A failed first invocation will be retried from scratch, so don't leave
+        # an orphaned upload behind
+        if merge.created:
+            merge.abort()
+        raise
+
+    finally:
+        fetched_slices.close()
+        indexes.close()
+
+    return None
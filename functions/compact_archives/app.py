@@ -0,0 +1,130 @@
+import os
+import logging
+import boto3
+from itertools import chain, islice, tee
+from botocore.config import Config
+from common.archive_index import index_key, read_index
+from common.compaction import archive_date
+from common.deletion import delete_files
+from common.manifest import FileList, entry_fields, entry_last_modified
+from common.merge import MultipartMerge, fetch_in_order, map_in_order
+from common.metrics import Metrics
+from common.scheduler import Scheduler
+from common.throttle import RateController
+
+# Configure the logger
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+TMP_LOGS_BUCKET_NAME = os.environ['TMP_LOGS_BUCKET_NAME']
+DEST_LOGS_BUCKET_NAME = os.environ['DEST_LOGS_BUCKET_NAME']
+
+# The size of the parts built from small archives in memory. Must be at least 5 MB.
+MERGE_PART_SIZE = int(os.environ.get('MERGE_PART_SIZE', 8 * 1024 * 1024))
+
+# The maximum number of archives, and of their indexes, being fetched at the same time
+DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', 32))
+
+
+metrics = Metrics('compact_archives')
+rate_controller = RateController(metrics)
+
+s3_client = rate_controller.instrument(metrics.instrument(boto3.client('s3', config=Config(
+                                max_pool_connections=2 * DOWNLOAD_CONCURRENCY,
+                                retries={'max_attempts': 10}))))
+
+
+# Compacts a group of small daily archives, as planned by plan_compaction, into a
+# single archive at key, with the same server-side merge as the daily aggregation.
+# The index of the new archive is made from the indexes of the daily archives, their
+# entries shifted to where each daily archive now begins, so that the original log
+# files can still be fetched one by one; a daily archive without an index is listed as
+# a whole. Where each daily archive begins and ends is recorded in the index as 'days'.
+#
+# Once the new archive and its index are in place, all versions of the daily archives
+# and their indexes are deleted.
+#
+# When the time left runs out, the work left is returned in compactArchivesResult:
+#
+#   {'continuationMarker': index of the next daily archive, 'phase': 'combine',
+#    'uploadId': ..., 'partCount': ..., 'offset': ...}, or
+#   {'continuationMarker': index of the next key to delete, 'phase': 'delete'}
+
+@metrics.handler
+def lambda_handler(data, context):
+    key = data['key']
+    archives = FileList(s3_client, TMP_LOGS_BUCKET_NAME, data['files'])
+    state = data.get('compactArchivesResult', {})
+    phase = state.get('phase', 'combine')
+    start = state.get('continuationMarker', 0)
+
+    scheduler = Scheduler(context)
+    progress = False
+
+    if phase == 'combine':
+        result = compact(key, archives.entries(start), start, state, scheduler)
+        if result:
+            return result
+        progress = True
+        start = 0
+
+    # Each daily archive goes along with its index
+    keys = chain.from_iterable((archive, index_key(archive)) for archive in archives.keys(start // 2))
+    index = delete_files(s3_client, DEST_LOGS_BUCKET_NAME, islice(keys, start % 2, None), 2 * len(archives),
+                         start, scheduler, force_first=not progress, metrics=metrics)
+    if index is not None:
+        logger.info(f"Lambda might time out, returning continuationMarker for next invocation: {index}")
+        return {'continuationMarker': index, 'phase': 'delete'}
+
+    archives.delete()
+    return {'status': 'done'}
+
+
+def compact(key, entries, start, state, scheduler):
+    # Returns None when the compacted archive is complete, or else the state to resume from
+    merge = MultipartMerge(
+        s3_client,
+        DEST_LOGS_BUCKET_NAME,
+        key,
+        TMP_LOGS_BUCKET_NAME,
+        upload_id=state.get('uploadId'),
+        part_count=state.get('partCount', 0),
+        offset=state.get('offset'),
+        part_size=MERGE_PART_SIZE
+    )
+    days = merge.extra.setdefault('days', [])
+
+    # The indexes are read along with the fetches, as far ahead of the merge as they are
+    items = ((index, *entry_fields(entry), entry_last_modified(entry)) for index, entry in enumerate(entries, start=start))
+    items, index_items = tee(items)
+    fetched_archives = fetch_in_order(s3_client, DEST_LOGS_BUCKET_NAME, items, DOWNLOAD_CONCURRENCY)
+    indexes = map_in_order(lambda item: read_index(s3_client, DEST_LOGS_BUCKET_NAME, item[1]), index_items, DOWNLOAD_CONCURRENCY)
+
+    try:
+        for n, ((index, archive, size, etag, last_modified, body), archive_index) in enumerate(zip(fetched_archives, indexes)):
+            operation = 'append' if body is not None else 'copy'
+            if n > 0 and not scheduler.fits(operation, size):
+                logger.info(f"Lambda might time out, returning continuationMarker for next invocation: {index}")
+                return {'continuationMarker': index, 'phase': 'combine', **merge.suspend()}
+
+            with scheduler.timed(operation, size):
+                days.append([archive_date(archive), merge.offset, size, archive])
+                merge.add(DEST_LOGS_BUCKET_NAME, archive, size, etag, body, last_modified, archive_index)
+            metrics.add('ArchivesCompacted', 1)
+            metrics.add('BytesMerged', size, 'Bytes')
+
+        merge.complete()
+
+    except Exception:
+        # A failed first invocation will be retried from scratch, so don't leave
+        # an orphaned upload behind
+        if merge.created:
+            merge.abort()
+        raise
+
+    finally:
+        fetched_archives.close()
+        indexes.close()
+
+    return None
@@ -1,6 +1,11 @@
 import boto3
 from datetime import datetime, timedelta
+from common.metrics import Metrics
 
+metrics = Metrics('compute_date_list')
+
+
+@metrics.handler
 def lambda_handler(data, _context):
     start_date_str = data['start_date']
     end_date_str = data['end_date']
@@ -1,8 +1,13 @@
 import boto3
 import os
-import json
-import time
 import logging
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from common.manifest import FileList, entry_fields
+from common.metrics import Metrics
+from common.scheduler import Scheduler
+from common.throttle import RateController
+from copier import Copier
 
 # Configure the logger
 logger = logging.getLogger()
@@ -12,19 +17,37 @@ logger.setLevel(logging.INFO)
 TMP_LOGS_BUCKET_NAME = os.environ['TMP_LOGS_BUCKET_NAME']
 DEST_LOGS_BUCKET_NAME = os.environ['DEST_LOGS_BUCKET_NAME']
 
+# The number of log files copied at the same time
+COPY_CONCURRENCY = int(os.environ.get('COPY_CONCURRENCY', 16))
+# The number of parts copied at the same time, over all multipart copies
+PART_CONCURRENCY = int(os.environ.get('PART_CONCURRENCY', 16))
+# Log files larger than this are copied in parallel parts. At most 5 GB.
+MULTIPART_THRESHOLD = int(os.environ.get('MULTIPART_THRESHOLD', 256 * 1024 * 1024))
+# The number of attempts made to copy a log file before giving up on it
+MAX_ATTEMPTS = int(os.environ.get('MAX_ATTEMPTS', 5))
+# If more log files than this fail, the whole operation fails
+MAX_FAILED_FILES = 100
 
-s3_client = boto3.client('s3')
 
+metrics = Metrics('copy_log_files')
+rate_controller = RateController(metrics)
 
+s3_client = rate_controller.instrument(metrics.instrument(boto3.client('s3', config=Config(
+                                max_pool_connections=COPY_CONCURRENCY + PART_CONCURRENCY))))
+
+
+@metrics.handler
 def lambda_handler(data, context):
     date = data['date'].replace("-", "/")
     source_bucket_name = data['bucket_name']
     dest_bucket_name = DEST_LOGS_BUCKET_NAME or source_bucket_name
-    log_files = get_files(data['files'])
+    log_files = FileList(s3_client, TMP_LOGS_BUCKET_NAME, data['files'])
 
     # Access continuationMarker from the nested combineMainLogsResult if it exists
     combine_main_logs_result = data.get('combineMainLogsResult', {})
     continuation_marker = combine_main_logs_result.get('continuationMarker', 0)
+    # Files which failed in earlier invocations
+    failed = combine_main_logs_result.get('failed', [])
 
     if continuation_marker > 0:
         logger.info(f"Continuing operation from index {continuation_marker}")
@@ -33,52 +56,75 @@ def lambda_handler(data, context):
         logger.info("No files specified")
         return {'status': 'no-op'}
     
-    start_time = time.time()
-    remaining_time = context.get_remaining_time_in_millis() / 1000.0  # Convert to seconds
-
-    # Resume or start the copy process
-    for index, log_file in enumerate(log_files[continuation_marker:], start=continuation_marker):
-
-        # Check if there is enough time left to process another file
-        elapsed_time = time.time() - start_time
-        if (remaining_time - elapsed_time) < 120:  # Less than 2 minutes left
-            logger.info(f"Lambda might time out, returning continuationMarker for next invocation: {index}")
-            return {'continuationMarker': index}  # Return the index of the next file to process
-
-        # Get the basename of the source file
-        base_name = os.path.basename(log_file)
-
-        # Define the destination key
-        destination_key = f"{source_bucket_name}/{date}/{base_name}"
-
-        # Copy the file from the source to the destination using boto3.copy_object
-        try:
-            s3_client.copy_object(
-                Bucket=dest_bucket_name,
-                Key=destination_key,
-                CopySource={'Bucket': source_bucket_name, 'Key': log_file},
-                StorageClass='STANDARD_IA'
-            )
-            logger.info(f"Successfully copied {log_file} to {dest_bucket_name}/{destination_key}")
-
-        except Exception as e:
-            logger.error(f"Failed to copy {log_file}: {str(e)}")
-            # Depending on the requirements, you might want to raise the exception,
-            # return an error status, or handle it in some other way.
-            # For this example, we'll skip the rest of the files and return an error.
-            return {'status': 'error', 'message': str(e)}
-
-    # All files have now been copied. Return status of done.
-    return {'status': 'done'}
-
-
-def get_files(thing):
-    if isinstance(thing, list):
-        return thing
-    
-    response = s3_client.get_object(
-        Bucket=TMP_LOGS_BUCKET_NAME,
-        Key=thing,
+    # Keeps track of how long copies take, per byte, to tell whether another copy can
+    # be started in the time left
+    scheduler = Scheduler(context)
+
+    copier = Copier(
+        s3_client,
+        multipart_threshold=MULTIPART_THRESHOLD,
+        part_concurrency=PART_CONCURRENCY,
+        max_attempts=MAX_ATTEMPTS
     )
-    files = json.loads(response['Body'].read())
-    return files
+
+    def copy(log_file):
+        log_file, size, etag = entry_fields(log_file)
+        if size is None:
+            size = s3_client.head_object(Bucket=source_bucket_name, Key=log_file)['ContentLength']
+        # Define the destination key from the basename of the source file
+        destination_key = f"{source_bucket_name}/{date}/{os.path.basename(log_file)}"
+        with scheduler.timed('copy', size):
+            error = copier.copy(source_bucket_name, log_file, dest_bucket_name, destination_key, size, etag)
+        if error:
+            logger.error(f"Failed to copy {log_file}: {error}")
+        else:
+            metrics.add('FilesProcessed', 1)
+            metrics.add('BytesCopied', size, 'Bytes')
+        return log_file, error
+
+    try:
+        # Resume or start the copy process, keeping up to COPY_CONCURRENCY copies in flight.
+        # Only the part of the file list from the continuation marker on is read.
+        n_files = len(log_files)
+        remaining_files = log_files.entries(continuation_marker)
+        next_file = None
+        next_index = continuation_marker
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=COPY_CONCURRENCY) as pool:
+            while next_index < n_files or in_flight:
+
+                # Start copies while there is enough time left for them to finish. The
+                # first copy of an invocation is always started, so that progress is made.
+                out_of_time = False
+                while next_index < n_files and len(in_flight) < COPY_CONCURRENCY:
+                    next_file = next_file or next(remaining_files)
+                    out_of_time = (next_index > continuation_marker and
+                                   not scheduler.fits('copy', entry_fields(next_file)[1] or 0))
+                    if out_of_time:
+                        break
+                    in_flight.add(pool.submit(copy, next_file))
+                    next_file = None
+                    next_index += 1
+
+                # Let whatever is in flight finish when out of time
+                done, in_flight = wait(in_flight, return_when=ALL_COMPLETED if out_of_time else FIRST_COMPLETED)
+                failed += [log_file for log_file, error in (future.result() for future in done) if error]
+
+                if len(failed) > MAX_FAILED_FILES:
+                    raise RuntimeError(f"More than {MAX_FAILED_FILES} log files could not be copied")
+
+                if out_of_time and next_index < n_files:
+                    logger.info(f"Lambda might time out, returning continuationMarker for next invocation: {next_index}")
+                    # Return the index of the next file to process
+                    return {'continuationMarker': next_index, 'failed': failed}
+
+    finally:
+        copier.close()
+
+    logger.info(f"Copied {n_files - len(failed)} files, {len(failed)} failed")
+
+    # All files have now been copied. Failed files are listed so that their originals
+    # are kept.
+    if failed:
+        return {'status': 'error', 'failed': failed}
+    return {'status': 'done'}
@@ -0,0 +1,103 @@
+import time
+import random
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# Configure the logger
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+MB = 1024 * 1024
+FIVE_GB = 5 * 1024 * MB
+MAX_PARTS = 10000
+
+
+# Copies objects server-side, choosing per object between a single CopyObject and a
+# multipart copy with ranged UploadPartCopy requests running in parallel. The latter is
+# used for everything above the multipart threshold, which must not exceed 5 GB as that
+# is the limit for CopyObject. Each object is retried individually with exponential
+# backoff, so that one failing object doesn't affect the others.
+class Copier:
+
+    def __init__(self, s3_client, storage_class='STANDARD_IA', multipart_threshold=256 * MB,
+                 part_size=128 * MB, part_concurrency=16, max_attempts=5):
+        self.s3_client = s3_client
+        self.storage_class = storage_class
+        self.multipart_threshold = min(multipart_threshold, FIVE_GB)
+        self.part_size = part_size
+        self.max_attempts = max_attempts
+        self.part_pool = ThreadPoolExecutor(max_workers=part_concurrency)
+
+    def copy(self, source_bucket, source_key, dest_bucket, dest_key, size=None, etag=None):
+        # Returns None on success, or the error message of the last attempt
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self._copy_once(source_bucket, source_key, dest_bucket, dest_key, size, etag)
+                return None
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    return str(e)
+                delay = min(20, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0)
+                logger.warning(f"Attempt {attempt} to copy {source_key} failed, retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+
+    def close(self):
+        self.part_pool.shutdown()
+
+    def _copy_once(self, source_bucket, source_key, dest_bucket, dest_key, size, etag):
+        if size is None:
+            size = self.s3_client.head_object(Bucket=source_bucket, Key=source_key)['ContentLength']
+
+        copy_source = {'Bucket': source_bucket, 'Key': source_key}
+        conditions = {'CopySourceIfMatch': etag} if etag else {}
+
+        if size <= self.multipart_threshold:
+            self.s3_client.copy_object(
+                Bucket=dest_bucket,
+                Key=dest_key,
+                CopySource=copy_source,
+                StorageClass=self.storage_class,
+                **conditions
+            )
+            return
+
+        # A multipart copy doesn't carry over the content headers and metadata by itself
+        head = self.s3_client.head_object(Bucket=source_bucket, Key=source_key)
+        headers = {name: head[name] for name in ('ContentType', 'ContentEncoding', 'Metadata') if head.get(name)}
+
+        part_size = max(self.part_size, -(-size // MAX_PARTS), 5 * MB)
+        ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+        mpu = self.s3_client.create_multipart_upload(
+            Bucket=dest_bucket,
+            Key=dest_key,
+            StorageClass=self.storage_class,
+            **headers
+        )
+        upload_id = mpu['UploadId']
+
+        def copy_part(part):
+            part_number, (first, last) = part
+            response = self.s3_client.upload_part_copy(
+                Bucket=dest_bucket,
+                Key=dest_key,
+                CopySource=copy_source,
+                CopySourceRange=f'bytes={first}-{last}',
+                PartNumber=part_number,
+                UploadId=upload_id,
+                **conditions
+            )
+            return {'ETag': response['CopyPartResult']['ETag'], 'PartNumber': part_number}
+
+        try:
+            parts = list(self.part_pool.map(copy_part, enumerate(ranges, start=1)))
+            self.s3_client.complete_multipart_upload(
+                Bucket=dest_bucket,
+                Key=dest_key,
+                MultipartUpload={'Parts': parts},
+                UploadId=upload_id
+            )
+        except Exception:
+            self.s3_client.abort_multipart_upload(Bucket=dest_bucket, Key=dest_key, UploadId=upload_id)
+            raise
@@ -2,6 +2,7 @@ import os
 import boto3
 import cfnresponse
 import logging
+from common.metrics import NAMESPACE
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -186,11 +187,253 @@ BODY_FIXED = """
                     },
                     "liveData": false
                 }
-            }<BODY_VARIABLE>
+            }<BODY_VARIABLE>,
+            {
+                "height": 6,
+                "width": 8,
+                "y": 22,
+                "x": 0,
+                "type": "metric",
+                "properties": {
+                    "metrics": [
+                        [ { "expression": "SEARCH('{<NAMESPACE>,Function} MetricName=\\"FilesProcessed\\"', 'Sum', 86400)", "id": "e1", "region": "<REGION>" } ]
+                    ],
+                    "view": "timeSeries",
+                    "stacked": false,
+                    "region": "<REGION>",
+                    "period": 86400,
+                    "stat": "Sum",
+                    "title": "Files Processed per Function",
+                    "yAxis": {
+                        "left": {
+                            "min": 0
+                        }
+                    }
+                }
+            },
+            {
+                "height": 6,
+                "width": 8,
+                "y": 22,
+                "x": 8,
+                "type": "metric",
+                "properties": {
+                    "metrics": [
+                        [ { "expression": "SEARCH('{<NAMESPACE>,Function} MetricName=\\"BytesMerged\\"', 'Sum', 86400)", "id": "e1", "region": "<REGION>" } ],
+                        [ { "expression": "SEARCH('{<NAMESPACE>,Function} MetricName=\\"BytesCopied\\"', 'Sum', 86400)", "id": "e2", "region": "<REGION>" } ]
+                    ],
+                    "view": "timeSeries",
+                    "stacked": false,
+                    "region": "<REGION>",
+                    "period": 86400,
+                    "stat": "Sum",
+                    "title": "Bytes Merged and Copied",
+                    "yAxis": {
+                        "left": {
+                            "min": 0
+                        }
+                    }
+                }
+            },
+            {
+                "height": 6,
+                "width": 8,
+                "y": 22,
+                "x": 16,
+                "type": "metric",
+                "properties": {
+                    "metrics": [
+                        [ "<NAMESPACE>", "S3Calls.GetObject", { "region": "<REGION>" } ],
+                        [ "<NAMESPACE>", "S3Calls.PutObject", { "region": "<REGION>" } ],
+                        [ "<NAMESPACE>", "S3Calls.HeadObject", { "region": "<REGION>" } ],
+                        [ "<NAMESPACE>", "S3Calls.ListObjectsV2", { "region": "<REGION>" } ],
+                        [ "<NAMESPACE>", "S3Calls.ListObjectVersions", { "region": "<REGION>" } ],
+                        [ "<NAMESPACE>", "S3Calls.CopyObject", { "region": "<REGION>" } ],
+                        [ "<NAMESPACE>", "S3Calls.UploadPart", { "region": "<REGION>" } ],
+                        [ "<NAMESPACE>", "S3Calls.UploadPartCopy", { "region": "<REGION>" } ],
+                        [ "<NAMESPACE>", "S3Calls.DeleteObjects", { "region": "<REGION>" } ]
+                    ],
+                    "view": "timeSeries",
+                    "stacked": false,
+                    "region": "<REGION>",
+                    "period": 86400,
+                    "stat": "Sum",
+                    "title": "S3 Calls by Operation",
+                    "yAxis": {
+                        "left": {
+                            "min": 0
+                        }
+                    }
+                }
+            },
+            {
+                "height": 6,
+                "width": 8,
+                "y": 28,
+                "x": 0,
+                "type": "metric",
+                "properties": {
+                    "metrics": [
+                        [ { "expression": "SEARCH('{<NAMESPACE>,Function} MetricName=\\"S3Latency\\"', 'p50', 86400)", "id": "p50", "region": "<REGION>" } ],
+                        [ { "expression": "SEARCH('{<NAMESPACE>,Function} MetricName=\\"S3Latency\\"', 'p90', 86400)", "id": "p90", "region": "<REGION>" } ],
+                        [ { "expression": "SEARCH('{<NAMESPACE>,Function} MetricName=\\"S3Latency\\"', 'p99', 86400)", "id": "p99", "region": "<REGION>" } ]
+                    ],
+                    "view": "timeSeries",
+                    "stacked": false,
+                    "region": "<REGION>",
+                    "period": 86400,
+                    "stat": "p90",
+                    "title": "S3 Call Latency (ms)",
+                    "yAxis": {
+                        "left": {
+                            "min": 0
+                        }
+                    }
+                }
+            },
+            {
+                "height": 6,
+                "width": 8,
+                "y": 28,
+                "x": 8,
+                "type": "metric",
+                "properties": {
+                    "metrics": [
+                        [ { "expression": "SEARCH('{<NAMESPACE>,Function} MetricName=\\"Continuations\\"', 'Sum', 86400)", "id": "e1", "region": "<REGION>" } ]
+                    ],
+                    "view": "timeSeries",
+                    "stacked": false,
+                    "region": "<REGION>",
+                    "period": 86400,
+                    "stat": "Sum",
+                    "title": "Continuations per Function",
+                    "yAxis": {
+                        "left": {
+                            "min": 0
+                        }
+                    }
+                }
+            },
+            {
+                "height": 6,
+                "width": 8,
+                "y": 28,
+                "x": 16,
+                "type": "metric",
+                "properties": {
+                    "metrics": [
+                        [ { "expression": "SEARCH('{<NAMESPACE>,Function} MetricName=\\"HeadroomSeconds\\"', 'Minimum', 86400)", "id": "e1", "region": "<REGION>" } ]
+                    ],
+                    "view": "timeSeries",
+                    "stacked": false,
+                    "region": "<REGION>",
+                    "period": 86400,
+                    "stat": "Minimum",
+                    "title": "Minimum Time Left at End of Invocation (s)",
+                    "yAxis": {
+                        "left": {
+                            "min": 0
+                        }
+                    }
+                }
+            },
+            {
+                "height": 6,
+                "width": 12,
+                "y": 34,
+                "x": 0,
+                "type": "metric",
+                "properties": {
+                    "metrics": [
+                        [ { "expression": "SEARCH('{<NAMESPACE>,Function} MetricName=\\"S3Throttles\\"', 'Sum', 86400)", "id": "e1", "region": "<REGION>" } ]
+                    ],
+                    "view": "timeSeries",
+                    "stacked": false,
+                    "region": "<REGION>",
+                    "period": 86400,
+                    "stat": "Sum",
+                    "title": "S3 SlowDown Responses per Function",
+                    "yAxis": {
+                        "left": {
+                            "min": 0
+                        }
+                    }
+                }
+            },
+            {
+                "height": 6,
+                "width": 12,
+                "y": 34,
+                "x": 12,
+                "type": "metric",
+                "properties": {
+                    "metrics": [
+                        [ { "expression": "SEARCH('{<NAMESPACE>,Function} MetricName=\\"S3ThrottleWait\\"', 'Sum', 86400)", "id": "e1", "region": "<REGION>" } ]
+                    ],
+                    "view": "timeSeries",
+                    "stacked": false,
+                    "region": "<REGION>",
+                    "period": 86400,
+                    "stat": "Sum",
+                    "title": "Time Spent Waiting for S3 Request Slots (s)",
+                    "yAxis": {
+                        "left": {
+                            "min": 0
+                        }
+                    }
+                }
+            },
+            {
+                "height": 6,
+                "width": 12,
+                "y": 40,
+                "x": 0,
+                "type": "metric",
+                "properties": {
+                    "metrics": [
+                        [ { "expression": "SUM(SEARCH('{<NAMESPACE>,Function} MetricName=\\"RecompressionBytesIn\\"', 'Sum', 86400)) / SUM(SEARCH('{<NAMESPACE>,Function} MetricName=\\"RecompressionBytesOut\\"', 'Sum', 86400))", "id": "e1", "label": "Ratio", "region": "<REGION>" } ]
+                    ],
+                    "view": "timeSeries",
+                    "stacked": false,
+                    "region": "<REGION>",
+                    "period": 86400,
+                    "stat": "Sum",
+                    "title": "Recompression Ratio",
+                    "yAxis": {
+                        "left": {
+                            "min": 0
+                        }
+                    }
+                }
+            },
+            {
+                "height": 6,
+                "width": 12,
+                "y": 40,
+                "x": 12,
+                "type": "metric",
+                "properties": {
+                    "metrics": [
+                        [ { "expression": "SUM(SEARCH('{<NAMESPACE>,Function} MetricName=\\"RecompressionBytesIn\\"', 'Sum', 86400)) / SUM(SEARCH('{<NAMESPACE>,Function} MetricName=\\"RecompressionSeconds\\"', 'Sum', 86400)) / 1048576", "id": "e1", "label": "MB/s", "region": "<REGION>" } ]
+                    ],
+                    "view": "timeSeries",
+                    "stacked": false,
+                    "region": "<REGION>",
+                    "period": 86400,
+                    "stat": "Sum",
+                    "title": "Recompression Throughput (MB/s per lambda)",
+                    "yAxis": {
+                        "left": {
+                            "min": 0
+                        }
+                    }
+                }
+            }
         ]
     }
 """
 BODY_FIXED = BODY_FIXED.replace('<REGION>', REGION)
+BODY_FIXED = BODY_FIXED.replace('<NAMESPACE>', NAMESPACE)
 BODY_FIXED = BODY_FIXED.replace('<COMBINE_LOG_FILES_SM_ARN>', COMBINE_LOG_FILES_SM_ARN)
 BODY_FIXED = BODY_FIXED.replace('<COMMON_DESTINATION_BUCKET>', COMMON_DESTINATION_BUCKET)
 
@@ -1,85 +1,73 @@
 import os
-import json
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from common.deletion import CONCURRENCY, delete_files
+from common.manifest import FileList
+from common.metrics import Metrics
+from common.scheduler import Scheduler
+from common.throttle import RateController
 
 
 TMP_LOGS_BUCKET_NAME = os.environ['TMP_LOGS_BUCKET_NAME']
 
-s3_client = boto3.client('s3')
+metrics = Metrics('delete_originals')
+rate_controller = RateController(metrics)
 
+s3_client = rate_controller.instrument(metrics.instrument(boto3.client('s3', config=Config(max_pool_connections=CONCURRENCY))))
 
-def lambda_handler(data, _context):
+
+@metrics.handler
+def lambda_handler(data, context):
     bucket_name = data['bucket_name']
-    files = get_files(data['files'])
+    try:
+        files = FileList(s3_client, TMP_LOGS_BUCKET_NAME, data['files'])
+    except ClientError as e:
+        print(f"An error occurred when retrieving the file list: {e}")
+        return {'status': 'error'}
+
+    # Never delete the originals of files which could not be copied
+    failed = set(data.get('combineMainLogsResult', {}).get('failed', []))
+    if failed:
+        print(f"Keeping the originals of {len(failed)} files which could not be copied.")
+
+    # Access continuationMarker from the nested deleteOriginalsResult if it exists
+    delete_originals_result = data.get('deleteOriginalsResult', {})
+    continuation_marker = delete_originals_result.get('continuationMarker', 0)
+    # Files which could not be deleted in earlier invocations
+    not_deleted = delete_originals_result.get('failed', [])
 
     if not files:
         print("No files to delete. Returning.")
-        return
+        return {'status': 'no-op'}
 
     n_files = len(files)
     print(f"{n_files} files to delete...")
+    if continuation_marker > 0:
+        print(f"Continuing from index {continuation_marker}")
 
-    # Prepare a list of objects to delete along with their versions
-    objects_to_delete = []
-    for file_key in files:
-        try:
-            # Handle pagination
-            paginator = s3_client.get_paginator('list_object_versions')
-            page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=file_key)
-            for page in page_iterator:
-                for version in page.get('Versions', []) + page.get('DeleteMarkers', []):
-                    objects_to_delete.append({'Key': file_key, 'VersionId': version['VersionId']})
-        except ClientError as e:
-            print(f"An error occurred: {e}")
-            return
-        
-    print(f"{len(objects_to_delete)} objects to delete...")
+    # Keeps track of how long deleting takes per file, to size each round to the time left
+    scheduler = Scheduler(context)
 
-    # Delete objects in batches
+    # Only the part of the file list from the continuation marker on is read
     try:
-        total_deleted = 0
-        for i in range(0, len(objects_to_delete), 1000):  # S3 delete_objects API allows up to 1000 keys at once
-            batch = objects_to_delete[i:i+1000]
-            if batch:  # Ensure there are objects to delete
-                response = s3_client.delete_objects(
-                    Bucket=bucket_name,
-                    Delete={
-                        'Objects': batch,
-                        'Quiet': False  # Set Quiet to False to get the list of deleted objects
-                    }
-                )
-                deleted_items = response.get('Deleted', [])
-                errors = response.get('Errors', [])
-                total_deleted += len(deleted_items)
-                print(f"Deleted {len(deleted_items)} items.")
-                if errors:
-                    print(f"Errors encountered: {errors}")
+        index = delete_files(s3_client, bucket_name, files.keys(continuation_marker), n_files,
+                             continuation_marker, scheduler, keep=failed, metrics=metrics, failed=not_deleted)
     except ClientError as e:
-        print(f"An error occurred during deletion: {e}")
-
-    if isinstance(data['files'], str):
-        try:
-            s3_client.delete_object(
-                Bucket=TMP_LOGS_BUCKET_NAME,
-                Key=data['files']
-            )
-        except ClientError as e:
-            print(f"An error occurred when deleting the manifest file: {e}")
-
-
-def get_files(thing):
-    if isinstance(thing, list):
-        return thing
+        print(f"An error occurred: {e}")
+        return {'status': 'error'}
+    if index is not None:
+        print(f"Lambda might time out, returning continuationMarker for next invocation: {index}")
+        return {'continuationMarker': index, 'failed': not_deleted}
 
     try:
-        response = s3_client.get_object(
-            Bucket=TMP_LOGS_BUCKET_NAME,
-            Key=thing,
-        )
-        files = json.loads(response['Body'].read())
-        return files
+        files.delete()
     except ClientError as e:
-        print(f"An error occurred when retrieving the file list: {e}")
-        return []
+        print(f"An error occurred when deleting the manifest file: {e}")
 
+    # The bucket isn't recorded as done, so that the next execution for the date
+    # deletes whatever is left
+    if not_deleted:
+        print(f"{len(not_deleted)} files could not be deleted.")
+        return {'status': 'error', 'failed': not_deleted}
+    return {'status': 'done'}
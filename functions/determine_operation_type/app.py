@@ -1,57 +1,76 @@
 import os
-import json
 import re
 import boto3
+from botocore.config import Config
+from common.manifest import FileList, entry_fields
+from common.metrics import Metrics
+from common.throttle import RateController
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 TMP_LOGS_BUCKET_NAME = os.environ['TMP_LOGS_BUCKET_NAME']
 MIN_SIZE = int(os.environ['MIN_SIZE'])
 
-s3_client = boto3.client('s3')
+# The number of sizes looked up at a time, for file lists without them
+HEAD_CONCURRENCY = 32
 
+metrics = Metrics('determine_operation_type')
+rate_controller = RateController(metrics)
 
+s3_client = rate_controller.instrument(metrics.instrument(boto3.client('s3', config=Config(max_pool_connections=HEAD_CONCURRENCY))))
+
+
+@metrics.handler
 def lambda_handler(data, _context):
     # Get the files.
     bucket_name = data['bucket_name']
-    files = get_files(data['files'])
+    files = FileList(s3_client, TMP_LOGS_BUCKET_NAME, data['files'])
 
     # Check for an empty file list
     if len(files) == 0:
         return "none"
 
-    # Check file sizes.
-    if all_files_large(bucket_name, files):
+    print(f"{len(files)} files")
+    metrics.add('FilesProcessed', len(files))
+
+    # Check file sizes, stopping at the first small file.
+    if all(size >= MIN_SIZE for size in get_sizes(bucket_name, files)):
         return "copy_all"
 
-    # Check for AWS account ID pattern in all filenames.
-    if all(re.search(r'\b\d{12}\b', file) for file in files):
+    # Check the AWS account ID pattern and the hourly pattern in the filenames, stopping
+    # as soon as neither holds for a file.
+    all_accounts = all_hours = True
+    for key in files.keys():
+        all_accounts = all_accounts and bool(re.search(r'\b\d{12}\b', key))
+        all_hours = all_hours and bool(re.search(r'\/(0[0-9]|1[0-9]|2[0-3])\/', key))
+        if not (all_accounts or all_hours):
+            break
+
+    if all_accounts:
         return "aggregate_per_account"
 
-    # Check for hourly pattern in all filenames.
-    if all(re.search(r'\/(0[0-9]|1[0-9]|2[0-3])\/', file) for file in files):
+    if all_hours:
         return "aggregate_per_hour"
 
     # If none of the conditions are met, return "aggregate_all".
     return "aggregate_all"
 
 
-def all_files_large(bucket_name, files):
-    for file in files:
-        # Get file size from S3
-        response = s3_client.head_object(Bucket=bucket_name, Key=file)
-        size = response['ContentLength']
-
-        if size < MIN_SIZE:
-            return False
-    return True
-
+def get_sizes(bucket_name, files):
+    # Yields the sizes of the files, in order. The sizes are normally part of the file
+    # list. Older file lists contain just the keys, in which case the sizes are looked
+    # up concurrently, a batch at a time, so that no more are looked up than the caller
+    # reads.
+    def size(entry):
+        key, size, _etag = entry_fields(entry)
+        if size is None:
+            size = s3_client.head_object(Bucket=bucket_name, Key=key)['ContentLength']
+        return size
 
-def get_files(thing):
-    if isinstance(thing, list):
-        return thing
-    
-    response = s3_client.get_object(
-        Bucket=TMP_LOGS_BUCKET_NAME,
-        Key=thing,
-    )
-    files = json.loads(response['Body'].read())
-    return files
+    entries = iter(files)
+    with ThreadPoolExecutor(max_workers=HEAD_CONCURRENCY) as pool:
+        while batch := list(islice(entries, HEAD_CONCURRENCY)):
+            if all(entry_fields(entry)[1] is not None for entry in batch):
+                yield from (entry_fields(entry)[1] for entry in batch)
+            else:
+                yield from pool.map(size, batch)
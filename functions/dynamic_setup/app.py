@@ -1,9 +1,14 @@
 import boto3
 from datetime import date
 from datetime import timedelta
+from common.metrics import Metrics
 
+metrics = Metrics('dynamic_setup')
+
+
+@metrics.handler
 def lambda_handler(data, _context):
-    s3 = boto3.client('s3')
+    s3 = metrics.instrument(boto3.client('s3'))
     all_buckets = s3.list_buckets()
 
     # Split bucket name prefixes and filter out any empty strings
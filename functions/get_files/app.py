@@ -2,28 +2,48 @@ from calendar import month
 import os
 import json
 import boto3
-import random
+from datetime import date as Date
+from botocore.exceptions import ClientError
+from common.journal import Journal
+from common.manifest import save_files
+from common.metrics import Metrics
+from common.throttle import RateController
+from inventory import inventory_entries, NoInventory
+from layout import discover_patterns, expand_patterns, list_entries, DiscoveryBudgetExceeded
 
 TMP_LOGS_BUCKET_NAME = os.environ['TMP_LOGS_BUCKET_NAME']
+STATE_BUCKET_NAME = os.environ['STATE_BUCKET_NAME']
 
-s3_client = boto3.client('s3')
-s3_resource = boto3.resource('s3')
+# The number of days a learned bucket layout is trusted before it is discovered anew
+LAYOUT_CACHE_DAYS = int(os.environ.get('LAYOUT_CACHE_DAYS', 7))
 
+# Whether to read the file list from the S3 Inventory report of a bucket, where there
+# is one, rather than list the bucket
+USE_S3_INVENTORY = os.environ.get('USE_S3_INVENTORY', 'No') == 'Yes'
 
+metrics = Metrics('get_files')
+rate_controller = RateController(metrics)
+
+s3_client = rate_controller.instrument(metrics.instrument(boto3.client('s3')))
+
+
+@metrics.handler
 def lambda_handler(data, _context):
     bucket_name = data['bucket_name']
     prefix = data.get('prefix', '')
     date = data['date']
     only_gz = False
 
+    # A bucket already done for the date, by an earlier execution, has nothing to do
+    if Journal(s3_client, STATE_BUCKET_NAME, bucket_name, date).is_done():
+        print(f"{bucket_name} is already aggregated for {date}")
+        metrics.add('UnitsSkipped', 1)
+        return []
+
     print(f"Checking existence of {bucket_name}...")
     s3_client.head_bucket(Bucket=bucket_name)
     print("Bucket exists.")
 
-    print(f"Getting files with prefix '{prefix}'...")
-    objects = list(s3_resource.Bucket(bucket_name).objects.filter(Prefix=prefix))
-    print(f"Total number of files: {len(objects)}")
-
     year, month, day = date.split('-')
     month_trimmed = month.lstrip('0')
     day_trimmed = day.lstrip('0')
@@ -34,11 +54,69 @@ def lambda_handler(data, _context):
         f'{year}/{month_trimmed}/{day_trimmed}/',
         f'{year}{month}{day}',
     ]
-    objects = list(filter(lambda x: is_wanted(x.key, date_forms, only_gz), objects))
-    print(f"Total number of interesting files: {len(objects)}")
 
-    files = list(map(lambda x: x.key, objects))
-    return save_files(files, bucket_name, prefix, date)
+    # Find out where the date sits in the keys of this bucket, so that only the keys
+    # for the date need to be listed. If no layout can be inferred, the whole bucket
+    # (or rather everything under the prefix) is listed.
+    patterns = get_layout(bucket_name, prefix)
+    if patterns:
+        date_prefixes = expand_patterns(s3_client, bucket_name, prefix, patterns, date)
+    else:
+        date_prefixes = [prefix]
+
+    entries = None
+    if USE_S3_INVENTORY:
+        try:
+            entries = inventory_entries(s3_client, bucket_name, date_prefixes,
+                                        lambda key: is_wanted(key, date_forms, only_gz))
+        except NoInventory as e:
+            print(f"Not using the inventory: {e}")
+    if entries is None:
+        if patterns:
+            print(f"Getting files with {len(date_prefixes)} date-scoped prefixes...")
+        else:
+            print(f"Getting all files with prefix '{prefix}'...")
+        entries = list_entries(s3_client, bucket_name, date_prefixes)
+    print(f"Total number of files: {len(entries)}")
+
+    # The files are passed on with their size, ETag and last modification time, so
+    # that later states don't need to look them up again
+    files = list(filter(lambda x: is_wanted(x[0], date_forms, only_gz), entries))
+    print(f"Total number of interesting files: {len(files)}")
+    metrics.add('FilesProcessed', len(files))
+
+    name = f'{bucket_name}-{prefix}-{date}' if prefix else f'{bucket_name}-{date}'
+    return save_files(s3_client, TMP_LOGS_BUCKET_NAME, files, name)
+
+
+def get_layout(bucket_name, prefix):
+    # The layout of each bucket is cached in the state bucket, and only written when
+    # it has been discovered anew
+    layout_key = f'layouts/{bucket_name}.json'
+    today = Date.today()
+    layout = None
+    try:
+        response = s3_client.get_object(Bucket=STATE_BUCKET_NAME, Key=layout_key)
+        layout = json.loads(response['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+
+    if (not layout or layout['prefix'] != prefix or
+            (today - Date.fromisoformat(layout['discovered'])).days >= LAYOUT_CACHE_DAYS):
+        print(f"Discovering the key layout of {bucket_name}...")
+        try:
+            patterns = discover_patterns(s3_client, bucket_name, prefix)
+        except DiscoveryBudgetExceeded:
+            patterns = None
+        layout = {'prefix': prefix, 'discovered': str(today), 'patterns': patterns}
+        s3_client.put_object(
+            Body=json.dumps(layout),
+            Bucket=STATE_BUCKET_NAME,
+            Key=layout_key,
+        )
+    print(f"Key layout: {layout['patterns']}")
+    return layout['patterns']
 
 
 def is_wanted(key, date_forms, only_gz):
@@ -48,21 +126,3 @@ def is_wanted(key, date_forms, only_gz):
         if f in key:
             return True
     return False
-
-
-def save_files(files, bucket_name, prefix, date):
-    # If the number of files is small, then just return the file list as is
-    if len(files) < 100:
-        return files
-
-    # For a long list, store it in a file and return the key to it
-    noise = random.randint(100000000, 999999999)
-    file_list_key = f'{bucket_name}-{prefix}-{date}-{noise}.json' if prefix else f'{bucket_name}-{date}-{noise}.json'
-
-    response = s3_client.put_object(
-        Body=json.dumps(files),
-        Bucket=TMP_LOGS_BUCKET_NAME,
-        Key=file_list_key,
-    )
-
-    return file_list_key
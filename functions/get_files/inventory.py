@@ -0,0 +1,198 @@
+import io
+import os
+import csv
+import gzip
+import json
+import tempfile
+from bisect import bisect_right
+from datetime import datetime, timezone
+from urllib.parse import unquote_plus
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from layout import manifest_entry
+
+
+# Reads the file list of a bucket from its S3 Inventory report instead of listing the
+# bucket, which for the largest buckets takes minutes of ListObjectsV2 paging.
+#
+# The inventory configuration is looked up on the bucket itself: the first enabled one
+# covering current versions, with the size, ETag and last modification time among its
+# fields, delivered as CSV or Parquet. The latest report is found under
+# {destination prefix}/{bucket}/{configuration ID}/{timestamp}/manifest.json, and its
+# data files are streamed one at a time and filtered, so memory use doesn't grow with
+# the size of the bucket. Parquet reports need pyarrow, which is not part of the
+# function by default; without it, such reports are ignored.
+#
+# As a report is a snapshot, up to a day old, the prefixes are still listed, as only a
+# listing finds every object written or deleted since, including a late log file whose
+# key sorts before keys already in the report. What the report gives is where the keys
+# lie: each prefix is split into ranges of RANGE_KEYS keys of the report, which are
+# listed in parallel, each with StartAfter, rather than paged through one after the
+# other. The listing is what is returned; the report only says how many objects are new.
+
+REQUIRED_FIELDS = {'Size', 'ETag', 'LastModifiedDate'}
+FORMATS = ('CSV', 'Parquet')
+
+# Reports older than this are not used
+MAX_AGE_HOURS = int(os.environ.get('INVENTORY_MAX_AGE_HOURS', 48))
+
+# The number of keys of the report in each range of a prefix listed on its own
+RANGE_KEYS = int(os.environ.get('INVENTORY_RANGE_KEYS', 20000))
+
+
+class NoInventory(Exception):
+    pass
+
+
+def inventory_entries(s3_client, bucket_name, prefixes, wanted):
+    # Returns the file list entries, [key, size, etag, last_modified], of the objects
+    # under the prefixes for which wanted(key) is true, sorted on key. Raises NoInventory
+    # if there is no usable report.
+    configuration = find_configuration(s3_client, bucket_name)
+    manifest = latest_manifest(s3_client, bucket_name, configuration)
+    snapshot = datetime.fromtimestamp(int(manifest['creationTimestamp']) / 1000, timezone.utc)
+    print(f"Reading the {manifest['fileFormat']} inventory of {bucket_name} as of {snapshot}...")
+
+    prefixes = tuple(sorted(prefixes))
+    destination = manifest['destinationBucket'].split(':::')[-1]
+    keys = {prefix: [] for prefix in prefixes}
+    n_files = 0
+    for data_file in manifest['files']:
+        for entry in read_data_file(s3_client, destination, data_file['key'], manifest):
+            key = entry[0]
+            if not key.startswith(prefixes):
+                continue
+            # The prefix a key is under is the last one sorting before it
+            prefix = prefixes[bisect_right(prefixes, key) - 1]
+            if key.startswith(prefix):
+                keys[prefix].append(key)
+                n_files += wanted(key)
+    print(f"{n_files} files found in the inventory")
+
+    ranges = []
+    for prefix in prefixes:
+        bounds = [None] + sorted(keys[prefix])[RANGE_KEYS::RANGE_KEYS] + [None]
+        ranges += [(prefix, start_after, end) for start_after, end in zip(bounds, bounds[1:])]
+    known = {key for prefix_keys in keys.values() for key in prefix_keys}
+    del keys
+
+    entries = {}
+    for entry in list_ranges(s3_client, bucket_name, ranges):
+        if wanted(entry[0]):
+            entries[entry[0]] = entry
+    n_new = sum(1 for key in entries if key not in known)
+    print(f"{n_new} files found since the inventory was taken, in {len(ranges)} ranges")
+    return [entries[key] for key in sorted(entries)]
+
+
+def find_configuration(s3_client, bucket_name):
+    try:
+        response = s3_client.list_bucket_inventory_configurations(Bucket=bucket_name)
+    except ClientError as e:
+        raise NoInventory(f"Can't read the inventory configurations: {e}")
+    for configuration in response.get('InventoryConfigurationList', []):
+        destination = configuration['Destination']['S3BucketDestination']
+        if (configuration['IsEnabled'] and
+                configuration['IncludedObjectVersions'] == 'Current' and
+                destination['Format'] in FORMATS and
+                REQUIRED_FIELDS <= set(configuration.get('OptionalFields', []))):
+            return configuration
+    raise NoInventory(f"{bucket_name} has no inventory with the fields needed")
+
+
+def latest_manifest(s3_client, bucket_name, configuration):
+    destination = configuration['Destination']['S3BucketDestination']
+    destination_bucket = destination['Bucket'].split(':::')[-1]
+    base = f"{destination.get('Prefix', '').strip('/')}/{bucket_name}/{configuration['Id']}/".lstrip('/')
+
+    # The reports are in folders named by their timestamp, e.g. 2024-03-06T01-00Z/
+    folders = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=destination_bucket, Prefix=base, Delimiter='/'):
+        folders += [p['Prefix'] for p in page.get('CommonPrefixes', []) if p['Prefix'][len(base):][:1].isdigit()]
+
+    for folder in sorted(folders, reverse=True):
+        try:
+            response = s3_client.get_object(Bucket=destination_bucket, Key=folder + 'manifest.json')
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            # Not written yet
+            continue
+        manifest = json.loads(response['Body'].read())
+        created = datetime.fromtimestamp(int(manifest['creationTimestamp']) / 1000, timezone.utc)
+        if (datetime.now(timezone.utc) - created).total_seconds() > MAX_AGE_HOURS * 3600:
+            break
+        if manifest['fileFormat'] == 'Parquet' and not parquet_available():
+            raise NoInventory("The inventory is in Parquet, which needs pyarrow")
+        return manifest
+    raise NoInventory(f"No inventory of {bucket_name} younger than {MAX_AGE_HOURS} hours")
+
+
+def read_data_file(s3_client, bucket_name, key, manifest):
+    if manifest['fileFormat'] == 'CSV':
+        yield from read_csv(s3_client, bucket_name, key, manifest['fileSchema'])
+    else:
+        yield from read_parquet(s3_client, bucket_name, key)
+
+
+def read_csv(s3_client, bucket_name, key, schema):
+    # Data files are gzipped CSV without a header, with the columns given by the schema,
+    # and URL-encoded keys
+    columns = [column.strip() for column in schema.split(',')]
+    key_at, size_at, etag_at, modified_at = (columns.index(c) for c in ('Key', 'Size', 'ETag', 'LastModifiedDate'))
+    response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    with gzip.GzipFile(fileobj=response['Body']) as f:
+        for row in csv.reader(io.TextIOWrapper(f, encoding='utf-8')):
+            if not row[size_at]:
+                # A delete marker
+                continue
+            yield [
+                unquote_plus(row[key_at]),
+                int(row[size_at]),
+                row[etag_at].strip('"'),
+                int(datetime.fromisoformat(row[modified_at].replace('Z', '+00:00')).timestamp()),
+            ]
+
+
+def read_parquet(s3_client, bucket_name, key):
+    # Parquet can't be read from a stream, so each data file is downloaded to /tmp and
+    # read a batch of rows at a time
+    import pyarrow.parquet as pq
+    with tempfile.NamedTemporaryFile(suffix='.parquet') as f:
+        s3_client.download_fileobj(bucket_name, key, f)
+        f.flush()
+        parquet = pq.ParquetFile(f.name)
+        for batch in parquet.iter_batches(columns=['key', 'size', 'e_tag', 'last_modified_date']):
+            for row in batch.to_pylist():
+                if row['size'] is None:
+                    continue
+                yield [row['key'], row['size'], row['e_tag'], int(row['last_modified_date'].timestamp())]
+
+
+def parquet_available():
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def list_ranges(s3_client, bucket_name, ranges, max_workers=16):
+    # Lists the objects of each (prefix, start_after, end) range: those under the prefix
+    # sorting after start_after, if any, and up to end, if any
+    def list_range(item):
+        prefix, start_after, end = item
+        entries = []
+        kwargs = {'StartAfter': start_after} if start_after else {}
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, **kwargs):
+            for obj in page.get('Contents', []):
+                if end is not None and obj['Key'] > end:
+                    return entries
+                entries.append(manifest_entry(obj))
+        return entries
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for entries in pool.map(list_range, ranges):
+            yield from entries
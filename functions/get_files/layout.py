@@ -0,0 +1,197 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Learns where the date sits in the keys of a log bucket, so that only the keys for a
+# particular date need to be listed instead of the entire bucket.
+#
+# The bucket is walked one "directory" level at a time using delimiter listings, which
+# cost one request per directory rather than one per 1000 objects. The walk stops at
+# the places where the date appears, which are recorded as anchors in one of three forms:
+#
+#   'path'    - a directory containing YYYY/ subdirectories, e.g. .../eu-west-1/2024/
+#   'dash'    - a directory whose entries contain YYYY-MM-DD after a fixed stem, e.g.
+#               access-logs/2024-03-05-12-00-00-XXXX or dt=2024-03-05/
+#   'compact' - the same, but with YYYYMMDD, e.g. ..._vpcflowlogs_20240305T1230Z_...
+#
+# Within a directory, runs of dated entries sharing a stem are skipped over a year at
+# a time, so that a flat directory with millions of access logs costs a handful of
+# requests. Anchors are then generalised into patterns: path segments that differ
+# between otherwise identical anchors, or that look like account IDs or regions,
+# become wildcards. Patterns are what gets cached, so accounts and regions added
+# after the discovery are still found when the patterns are expanded.
+
+MAX_DEPTH = 12
+
+YEAR_DIR_RE = re.compile(r'^(19|20)\d\d/$')
+DASH_DATE_RE = re.compile(r'(?<!\d)((?:19|20)\d\d)-(\d{1,2})-(\d{1,2})(?!\d)')
+COMPACT_DATE_RE = re.compile(r'(?<!\d)((?:19|20)\d\d)(0[1-9]|1[0-2])(0[1-9]|[12]\d|3[01])(?!\d)')
+WILDCARD_SEGMENT_RE = re.compile(r'^(\d{12}|[a-z]{2}(-gov)?-[a-z]+-\d+)/$')
+
+
+class DiscoveryBudgetExceeded(Exception):
+    pass
+
+
+def discover_patterns(s3_client, bucket_name, prefix, max_requests=500, max_workers=16):
+    walker = _Walker(s3_client, bucket_name, max_requests)
+    anchors = []
+    level = [(prefix, [])]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for _depth in range(MAX_DEPTH):
+            if not level:
+                break
+            next_level = []
+            results = pool.map(lambda item: walker.scan_directory(item[0]), level)
+            for (path, segments), (found, subdirs) in zip(level, results):
+                anchors.extend((segments, stem, form) for stem, form in found)
+                next_level.extend((path + subdir, segments + [subdir]) for subdir in subdirs)
+            level = next_level
+    if not anchors:
+        return None
+    return generalise(anchors)
+
+
+def generalise(anchors):
+    # Group anchors which are identical except for their path segments
+    groups = {}
+    for segments, stem, form in anchors:
+        groups.setdefault((len(segments), stem, form), []).append(segments)
+
+    patterns = []
+    for (depth, stem, form), members in groups.items():
+        pattern = []
+        for position in range(depth):
+            values = {segments[position] for segments in members}
+            value = next(iter(values))
+            if len(values) > 1 or WILDCARD_SEGMENT_RE.match(value):
+                pattern.append('*')
+            else:
+                pattern.append(value)
+        patterns.append({'segments': pattern, 'stem': stem, 'form': form})
+
+    # Identical patterns may result from the generalisation
+    unique = {repr(sorted(p.items())): p for p in patterns}
+    return sorted(unique.values(), key=lambda p: (p['segments'], p['stem']))
+
+
+def expand_patterns(s3_client, bucket_name, prefix, patterns, date, max_workers=16):
+    # Returns the date-scoped prefixes to list for the given date
+    year, month, day = date.split('-')
+    month_trimmed = month.lstrip('0')
+    day_trimmed = day.lstrip('0')
+
+    date_suffixes = {
+        'path': {f'{year}/{month}/{day}/', f'{year}/{month_trimmed}/{day_trimmed}/'},
+        'dash': {f'{year}-{month}-{day}', f'{year}-{month_trimmed}-{day_trimmed}'},
+        'compact': {f'{year}{month}{day}'},
+    }
+
+    date_prefixes = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for pattern in patterns:
+            paths = [prefix]
+            for segment in pattern['segments']:
+                if segment == '*':
+                    paths = [subdir for subdirs in pool.map(
+                                lambda path: list_subdirectories(s3_client, bucket_name, path), paths)
+                             for subdir in subdirs]
+                else:
+                    paths = [path + segment for path in paths]
+            for path in paths:
+                for suffix in date_suffixes[pattern['form']]:
+                    date_prefixes.add(path + pattern['stem'] + suffix)
+    return sorted(date_prefixes)
+
+
+def list_subdirectories(s3_client, bucket_name, path):
+    subdirs = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=path, Delimiter='/'):
+        subdirs.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+    return subdirs
+
+
+def list_entries(s3_client, bucket_name, prefixes, max_workers=16):
+    # Returns the manifest entries, [key, size, etag, last_modified], of all objects
+    # under the prefixes, sorted on key
+    def list_prefix(prefix):
+        entries = []
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            entries.extend(manifest_entry(obj) for obj in page.get('Contents', []))
+        return entries
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        unique = {entry[0]: entry for entries in pool.map(list_prefix, prefixes) for entry in entries}
+    return [unique[key] for key in sorted(unique)]
+
+
+def manifest_entry(obj):
+    return [obj['Key'], obj['Size'], obj['ETag'].strip('"'), int(obj['LastModified'].timestamp())]
+
+
+def date_anchor(name):
+    # Returns (stem, form, year) for a dated entry name, or None
+    if YEAR_DIR_RE.match(name):
+        return ('', 'path', name[:4])
+    for form, regex in (('dash', DASH_DATE_RE), ('compact', COMPACT_DATE_RE)):
+        match = regex.search(name)
+        if match:
+            return (name[:match.start()], form, match.group(1))
+    return None
+
+
+class _Walker:
+
+    def __init__(self, s3_client, bucket_name, max_requests):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.max_requests = max_requests
+        self.n_requests = 0
+
+    def list_page(self, path, **kwargs):
+        # The counter is only approximate when used from several threads, which is fine
+        self.n_requests += 1
+        if self.n_requests > self.max_requests:
+            raise DiscoveryBudgetExceeded()
+        return self.s3_client.list_objects_v2(
+            Bucket=self.bucket_name,
+            Prefix=path,
+            Delimiter='/',
+            **kwargs
+        )
+
+    def scan_directory(self, path):
+        # Returns the date anchors found directly in the directory, and the
+        # undated subdirectories that need to be walked further
+        found = set()
+        subdirs = []
+        kwargs = {}
+        while True:
+            page = self.list_page(path, **kwargs)
+            entries = [p['Prefix'] for p in page.get('CommonPrefixes', [])]
+            entries += [obj['Key'] for obj in page.get('Contents', [])]
+            entries.sort()
+
+            for entry in entries:
+                name = entry[len(path):]
+                anchor = date_anchor(name)
+                if anchor:
+                    found.add(anchor[:2])
+                elif name.endswith('/'):
+                    subdirs.append(name)
+
+            if not page.get('IsTruncated'):
+                break
+
+            # If the last entry is dated, skip the rest of that year for its stem.
+            # Otherwise just carry on with the next page.
+            anchor = date_anchor(entries[-1][len(path):]) if entries else None
+            if anchor:
+                stem, _form, year = anchor
+                kwargs = {'StartAfter': max(entries[-1], path + stem + str(int(year) + 1))}
+            else:
+                kwargs = {'ContinuationToken': page['NextContinuationToken']}
+
+        return found, subdirs
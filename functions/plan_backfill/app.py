@@ -0,0 +1,158 @@
+import os
+import json
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from common.main_logs import list_account_prefixes, list_regions
+from common.metrics import Metrics
+from common.throttle import RateController
+
+STATE_BUCKET_NAME = os.environ['STATE_BUCKET_NAME']
+ORG_ID = os.environ['ORG_ID']
+
+# The global budget of a backfill: the number of lambdas running at a time, and the
+# number of S3 requests per second, over all dates being processed at the same time
+LAMBDA_CONCURRENCY_BUDGET = int(os.environ.get('LAMBDA_CONCURRENCY_BUDGET', 500))
+S3_REQUEST_RATE_BUDGET = int(os.environ.get('S3_REQUEST_RATE_BUDGET', 50000))
+
+# The S3 requests per second made by a single ProcessAccountFunction at full speed,
+# mostly GETs of log files, DOWNLOAD_CONCURRENCY at a time
+REQUESTS_PER_LAMBDA = int(os.environ.get('REQUESTS_PER_LAMBDA', 100))
+
+# The number of accounts per log type whose logs are listed to estimate the size of
+# each day, and the number of listings made at a time
+SAMPLE_ACCOUNTS = int(os.environ.get('SAMPLE_ACCOUNTS', 3))
+LIST_CONCURRENCY = int(os.environ.get('LIST_CONCURRENCY', 16))
+
+# The most dates processed at a time, as for an inline Map in Step Functions
+MAX_CONCURRENT_DATES = 40
+
+LOG_TYPES = ['CloudTrail', 'CloudTrail-Digest', 'Config']
+
+metrics = Metrics('plan_backfill')
+rate_controller = RateController(metrics)
+
+s3_client = rate_controller.instrument(metrics.instrument(boto3.client('s3', config=Config(max_pool_connections=LIST_CONCURRENCY))))
+
+
+# Plans a backfill of the main logs of a date range, as run by ProcessHistoricalMainLogsSM.
+#
+# The number of log files and bytes of each date is estimated from the logs of a few
+# sample accounts per log type, listed a month at a time, and scaled up to all accounts.
+# The dates are then ordered heaviest first, so that the longest ones don't end up
+# running on their own at the end, and the number of dates processed at a time is
+# chosen to keep within the budgets for lambda concurrency and S3 request rate. Each
+# date fans out into one ProcessAccountFunction per account and log type.
+#
+# The plan is stored in the state bucket, which unlike the temp bucket keeps what is
+# written to it, and the state machine records each date done next to it. When a
+# backfill of the same bucket and range is run again, however much later, the stored
+# plan is reused and the dates already done are left out.
+#
+# Returns {'dates': [...], 'concurrency': n, 'prefix': the prefix of the plan}.
+
+@metrics.handler
+def lambda_handler(data, _context):
+    bucket_name = data['bucket_name']
+    date_list = data['date_list']
+    prefix = f"backfills/{bucket_name}/{date_list[0]}_{date_list[-1]}/"
+
+    plan = load_plan(prefix)
+    if plan is None:
+        plan = make_plan(bucket_name, date_list)
+        s3_client.put_object(Body=json.dumps(plan), Bucket=STATE_BUCKET_NAME, Key=prefix + 'plan.json')
+    else:
+        print(f"Resuming the backfill planned in {prefix}plan.json")
+
+    done = completed_dates(prefix)
+    dates = [day['date'] for day in plan['days'] if day['date'] not in done]
+    print(f"{len(done)} dates already done, {len(dates)} to go")
+
+    concurrency = int(data.get('max_concurrent_dates') or plan['concurrency'])
+    print(f"Processing {concurrency} dates at a time")
+    metrics.add('DatesPlanned', len(dates))
+    return {'dates': dates, 'concurrency': concurrency, 'prefix': prefix}
+
+
+def make_plan(bucket_name, date_list):
+    months = sorted({date[:7] for date in date_list})
+    estimates = {date: {'objects': 0, 'bytes': 0} for date in date_list}
+    lambdas_per_date = 0
+
+    # The month prefixes of the sample accounts to list, with the factor by which to
+    # scale what is found
+    listings = []
+    for log_type in LOG_TYPES:
+        account_prefixes = list_account_prefixes(s3_client, bucket_name, ORG_ID, log_type)
+        lambdas_per_date += len(account_prefixes)
+        if not account_prefixes:
+            continue
+        step = max(1, len(account_prefixes) // SAMPLE_ACCOUNTS)
+        sample = account_prefixes[::step][:SAMPLE_ACCOUNTS]
+        scale = len(account_prefixes) / len(sample)
+        for account_prefix in sample:
+            for region_prefix in list_regions(s3_client, bucket_name, account_prefix, log_type):
+                listings += [(region_prefix, month, scale) for month in months]
+    print(f"Listing {len(listings)} month prefixes of {SAMPLE_ACCOUNTS} sample accounts per log type...")
+
+    with ThreadPoolExecutor(max_workers=LIST_CONCURRENCY) as pool:
+        for counts in pool.map(lambda listing: count_month(bucket_name, *listing), listings):
+            for date, (objects, size) in counts.items():
+                if date in estimates:
+                    estimates[date]['objects'] += objects
+                    estimates[date]['bytes'] += size
+
+    days = [{'date': date, 'objects': round(e['objects']), 'bytes': round(e['bytes'])}
+            for date, e in estimates.items()]
+    days.sort(key=lambda day: (-day['bytes'], day['date']))
+    concurrency = plan_concurrency(lambdas_per_date)
+    for day in days[:5]:
+        print(f"{day['date']}: about {day['objects']} files, {day['bytes']} bytes")
+    print(f"{lambdas_per_date} lambdas per date, {concurrency} dates at a time")
+    return {'days': days, 'lambdas_per_date': lambdas_per_date, 'concurrency': concurrency}
+
+
+def count_month(bucket_name, region_prefix, month, scale):
+    # Returns {date: (objects, bytes)} for the log files of a month under a region
+    # prefix, scaled. Both the untrimmed and the trimmed month forms are listed.
+    year, month_number = month.split('-')
+    prefixes = {f'{region_prefix}{year}/{month_number}/', f'{region_prefix}{year}/{month_number.lstrip("0")}/'}
+    counts = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for prefix in prefixes:
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                day = obj['Key'][len(prefix):].split('/')[0]
+                if not obj['Key'].endswith('.gz') or not day.isdigit():
+                    continue
+                date = f'{year}-{month_number}-{int(day):02d}'
+                objects, size = counts.get(date, (0, 0))
+                counts[date] = (objects + scale, size + obj['Size'] * scale)
+    return counts
+
+
+def plan_concurrency(lambdas_per_date):
+    # The number of dates that fit within both budgets, at least one
+    lambdas_per_date = max(1, lambdas_per_date)
+    by_lambdas = LAMBDA_CONCURRENCY_BUDGET // lambdas_per_date
+    by_requests = S3_REQUEST_RATE_BUDGET // (lambdas_per_date * REQUESTS_PER_LAMBDA)
+    return max(1, min(by_lambdas, by_requests, MAX_CONCURRENT_DATES))
+
+
+def load_plan(prefix):
+    try:
+        response = s3_client.get_object(Bucket=STATE_BUCKET_NAME, Key=prefix + 'plan.json')
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        return None
+    return json.loads(response['Body'].read())
+
+
+def completed_dates(prefix):
+    done = set()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=STATE_BUCKET_NAME, Prefix=prefix + 'done/'):
+        done.update(obj['Key'].split('/')[-1] for obj in page.get('Contents', []))
+    return done
@@ -0,0 +1,169 @@
+import os
+import re
+import boto3
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from common.archive_index import is_index_key
+from common.compaction import compacted_prefix, period_dates
+from common.manifest import INLINE_LIMIT, save_files, split_by_size
+from common.metrics import Metrics
+from common.throttle import RateController
+
+TMP_LOGS_BUCKET_NAME = os.environ['TMP_LOGS_BUCKET_NAME']
+DEST_LOGS_BUCKET_NAME = os.environ['DEST_LOGS_BUCKET_NAME']
+MIN_SIZE = int(os.environ['MIN_SIZE'])
+MAX_ARCHIVE_SIZE = max(int(os.environ['MAX_ARCHIVE_SIZE']), 2 * MIN_SIZE)
+
+# Weekly or Monthly
+COMPACTION_PERIOD = os.environ.get('COMPACTION_PERIOD', 'Monthly')
+
+# The age below which archives are not compacted: the minimum storage duration of
+# STANDARD_IA, which deleting them any sooner would be charged for on top of the
+# compacted archive
+MIN_AGE_DAYS = int(os.environ.get('COMPACTION_MIN_AGE_DAYS', 30))
+
+# The number of day prefixes listed at a time
+LIST_CONCURRENCY = int(os.environ.get('LIST_CONCURRENCY', 16))
+
+# Archives which can't be read without being restored first
+ARCHIVED_STORAGE_CLASSES = {'GLACIER', 'DEEP_ARCHIVE'}
+
+# A date in an archive name, 20240305 or 2024-03-05, and the start of a time after it
+DATE_PATTERN = re.compile(r'(?<!\d)(?:19|20)\d\d(-?)[01]\d\1[0-3]\d(?:[T-]\d{0,6}Z?)?(?!\d)')
+
+metrics = Metrics('plan_compaction')
+rate_controller = RateController(metrics)
+
+s3_client = rate_controller.instrument(metrics.instrument(boto3.client('s3', config=Config(max_pool_connections=LIST_CONCURRENCY))))
+
+
+# Plans the compaction of the daily archives of a week or a month in the common
+# destination bucket, as run by CompactArchivesSM.
+#
+# Daily archives smaller than GlacierObjectSize never go to Deep Archive, and pay the
+# minimum object size of STANDARD_IA. Under each root, those of the period are grouped
+# by their name with the digits taken out, which leaves the kind of log (and, for the
+# main logs, the region), so that CloudTrail isn't mixed with Config and the --name of
+# the query tool still works. Each group of two or more is to be merged, in the order
+# of the days, into {root}/{YYYY}/compacted/{period}/{name}, split by MaxArchiveSize.
+#
+# Daily archives younger than MIN_AGE_DAYS are left as they are, so that none is
+# deleted before the end of the minimum storage duration of STANDARD_IA. For the same
+# reason, the period is given as {'period': 'YYYY-MM'} or {'period': 'YYYY-Www'} (an
+# ISO week) and defaults to the last whole month or week, depending on
+# COMPACTION_PERIOD, that ended at least MIN_AGE_DAYS ago: a month is compacted in the
+# second month after it, a week about five weeks after it.
+#
+# Returns {'period': ..., 'groups': [{'key', 'files'}, ...]}.
+
+@metrics.handler
+def lambda_handler(data, _context):
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(days=MIN_AGE_DAYS)
+    period = data.get('period') or previous_period(cutoff.date())
+    dates = period_dates(period)
+    print(f"Compacting the small archives of {period}, {dates[0]} to {dates[-1]}, written before {cutoff}")
+
+    roots = list_roots()
+    listings = [(root, day) for root in roots for day in dates]
+    with ThreadPoolExecutor(max_workers=LIST_CONCURRENCY) as pool:
+        found = list(pool.map(lambda listing: list_small_archives(*listing, cutoff), listings))
+
+    groups = []
+    for root in roots:
+        archives = [archive for (listing_root, _day), day_archives in zip(listings, found)
+                    if listing_root == root for archive in day_archives]
+        groups += plan_root(root, dates[0], period, archives)
+
+    metrics.add('CompactionGroups', len(groups))
+    return {'period': period, 'groups': groups}
+
+
+def previous_period(day):
+    # The last whole period before the day
+    if COMPACTION_PERIOD == 'Weekly':
+        year, week, _ = (day - timedelta(days=7)).isocalendar()
+        return f'{year}-W{week:02d}'
+    return (day.replace(day=1) - timedelta(days=1)).strftime('%Y-%m')
+
+
+def list_roots():
+    paginator = s3_client.get_paginator('list_objects_v2')
+    return [
+        prefix['Prefix'].rstrip('/')
+        for page in paginator.paginate(Bucket=DEST_LOGS_BUCKET_NAME, Delimiter='/')
+        for prefix in page.get('CommonPrefixes', [])
+    ]
+
+
+def list_small_archives(root, day, cutoff):
+    # Returns the file list entries of the archives of a day smaller than MIN_SIZE and
+    # written before the cutoff
+    prefix = f"{root}/{day.strftime('%Y/%m/%d')}/"
+    archives = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=DEST_LOGS_BUCKET_NAME, Prefix=prefix, Delimiter='/'):
+        for obj in page.get('Contents', []):
+            if (is_index_key(obj['Key']) or obj['Size'] == 0 or obj['Size'] >= MIN_SIZE or
+                    obj.get('StorageClass') in ARCHIVED_STORAGE_CLASSES or obj['LastModified'] > cutoff):
+                continue
+            archives.append([obj['Key'], obj['Size'], obj['ETag'].strip('"'),
+                             int(obj['LastModified'].timestamp())])
+    return archives
+
+
+def plan_root(root, first_day, period, archives):
+    by_name = {}
+    for archive in archives:
+        by_name.setdefault(group_name(archive[0].rpartition('/')[2]), []).append(archive)
+
+    prefix = compacted_prefix(root, first_day, period)
+    taken = existing_keys(prefix)
+    groups = []
+    for name, members in sorted(by_name.items()):
+        if len(members) < 2:
+            continue
+        split = split_by_size(members, MAX_ARCHIVE_SIZE)
+        inline_limit = INLINE_LIMIT if len(members) < INLINE_LIMIT else 0
+        for n, part in enumerate(split, start=1):
+            key = free_key(prefix, name, n if len(split) > 1 else None, taken)
+            print(f"{key}: {len(part)} archives, {sum(archive[1] for archive in part)} bytes")
+            list_name = f'compaction-{root}-{period}-{n}'
+            groups.append({'key': key, 'files': save_files(s3_client, TMP_LOGS_BUCKET_NAME, part, list_name, inline_limit)})
+    return groups
+
+
+def group_name(file_name):
+    # The name of an archive without the part number and the date, with whatever is
+    # left of the time after it, which vary from day to day. The account, the region
+    # and the shard stay, as do the extension, e.g.
+    # 123456789012_CloudTrail_eu-north-1_20240305T1.gz -> 123456789012_CloudTrail_eu-north-1.gz
+    stem, dot, extension = file_name.partition('.')
+    stem = re.sub(r'-part-\d+$', '', stem)
+    stem = re.sub(r'[-_]{2,}', '-', DATE_PATTERN.sub('', stem)).strip('-_') or 'Aggregated-Logs'
+    return f'{stem}{dot}{extension}'
+
+
+def existing_keys(prefix):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    return {
+        obj['Key']
+        for page in paginator.paginate(Bucket=DEST_LOGS_BUCKET_NAME, Prefix=prefix)
+        for obj in page.get('Contents', [])
+    }
+
+
+def free_key(prefix, name, part, taken):
+    # A key not used by an earlier compaction of the same period, which would be
+    # overwritten otherwise
+    stem, dot, extension = name.partition('.')
+    if part:
+        stem = f'{stem}-part-{part:04d}'
+    key = f'{prefix}{stem}{dot}{extension}'
+    n = 1
+    while key in taken:
+        n += 1
+        key = f'{prefix}{stem}-{n}{dot}{extension}'
+    taken.add(key)
+    return key
@@ -0,0 +1,239 @@
+import os
+import json
+import logging
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from common.archive_key import archive_key
+from common.deletion import delete_files
+from common.journal import Journal
+from common.main_logs import list_day_files, list_regions
+from common.manifest import FileList, INLINE_LIMIT, entry_key, save_files, split_by_size
+from common.merge import combine_files
+from common.metrics import Metrics
+from common.scheduler import Scheduler
+from common.throttle import RateController
+from parquet_output import SCHEMAS, parquet_available, write_parquet
+
+# Configure the logger
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+TMP_LOGS_BUCKET_NAME = os.environ['TMP_LOGS_BUCKET_NAME']
+STATE_BUCKET_NAME = os.environ['STATE_BUCKET_NAME']
+DEST_LOGS_BUCKET_NAME = os.environ['DEST_LOGS_BUCKET_NAME']
+FINAL_AGGREGATION_PREFIX = os.environ['FINAL_AGGREGATION_PREFIX']
+MIN_SIZE = int(os.environ['MIN_SIZE'])
+
+# The size above which an archive is split into parts, as in shard_files
+MAX_ARCHIVE_SIZE = max(int(os.environ['MAX_ARCHIVE_SIZE']), 2 * MIN_SIZE)
+
+AGGREGATION_REGIONS = os.environ.get('AGGREGATION_REGIONS', "[]")
+AGGREGATION_REGIONS = json.loads(AGGREGATION_REGIONS.replace("'", '"'))
+
+# The size of the parts built from small log files in memory. Must be at least 5 MB.
+MERGE_PART_SIZE = int(os.environ.get('MERGE_PART_SIZE', 8 * 1024 * 1024))
+
+# The maximum number of log files being fetched at the same time
+DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', 32))
+
+# The gzip level, 1 to 9, at which to recompress the log files, or 0 to concatenate them
+# as they are
+RECOMPRESSION_LEVEL = int(os.environ.get('RECOMPRESSION_LEVEL', 0))
+
+# No, Alongside or Instead: whether the records of CloudTrail and Config logs are
+# written as Parquet too, or only as Parquet
+PARQUET_OUTPUT = os.environ.get('PARQUET_OUTPUT', 'No')
+if PARQUET_OUTPUT != 'No' and not parquet_available():
+    logger.warning("PARQUET_OUTPUT is set, but pyarrow is missing: log files are only combined")
+    PARQUET_OUTPUT = 'No'
+
+
+metrics = Metrics('process_account')
+rate_controller = RateController(metrics)
+
+s3_client = rate_controller.instrument(metrics.instrument(boto3.client('s3', config=Config(
+                                max_pool_connections=50,
+                                retries={'max_attempts': 10}))))
+
+
+# Processes the main logs of one log type of one account for a day, all in one go:
+# finds the regions and the log files, splits them into parts by size, and for each
+# part determines the archive key, combines the log files into the archive, writes
+# their records as Parquet if asked to, and deletes the originals. This does in a
+# single invocation what the chain of GetRegions, GetExactFiles, ShardFiles,
+# DetermineArchiveKey, CombineLogFiles and DeleteOriginals does in many, without the
+# state transitions in between and without reading the file lists back from the temp
+# bucket.
+#
+# When the time left runs out, the work left is returned as a continuation marker
+# along with the parts, in processAccountResult, and the next invocation resumes it:
+#
+#   {'continuationMarker': index of the current part, 'parts': [{'key', 'files'}, ...],
+#    'phase': 'combine', 'parquet' or 'delete', 'combine': the state of the combine,
+#    'parquet': the state of the Parquet output, 'deleteMarker': the index of the next
+#    file to delete, as the phase requires, 'outputs': the archives completed so far}
+#
+# The same state is recorded in the journal of the date, as are the planned parts and
+# each part done, and the archives once the account is done. A new execution picks up
+# from there: an account already done returns at once, and one left part of the way
+# through is resumed rather than begun again.
+
+@metrics.handler
+def lambda_handler(data, context):
+    bucket_name = data['bucket_name']
+    dest_bucket_name = DEST_LOGS_BUCKET_NAME or bucket_name
+    log_type = data['log_type']
+    date = data['date']
+    account = data['account_prefix'].strip('/').split('/')[-1]
+    state = data.get('processAccountResult', {})
+    parquet = PARQUET_OUTPUT != 'No' and log_type in SCHEMAS
+    combine = not (parquet and PARQUET_OUTPUT == 'Instead')
+
+    journal = Journal(s3_client, STATE_BUCKET_NAME, bucket_name, date)
+    unit = (log_type, account)
+    if 'processAccountResult' not in data:
+        entry = journal.get(unit)
+        if entry and entry['status'] == 'done':
+            print(f"The {log_type} logs of {account} for {date} are already aggregated")
+            metrics.add('UnitsSkipped', 1)
+            return {'status': 'done'}
+        if entry:
+            print(f"Resuming the {log_type} logs of {account} for {date} from the journal")
+            state = entry['state']
+
+    def checkpoint(result):
+        journal.checkpoint(unit, result)
+        return result
+
+    # Keeps track of how long each kind of operation takes, to tell whether the next
+    # one fits in the time left
+    scheduler = Scheduler(context)
+
+    parts = state.get('parts')
+    outputs = state.get('outputs', [])
+    if parts is None:
+        parts = plan_parts(bucket_name, data['account_prefix'], log_type, date)
+        checkpoint({'continuationMarker': 0, 'parts': parts})
+        # Listing counts as progress, so from here on nothing more need be done
+        # before returning a continuation marker
+        progress = True
+    else:
+        progress = False
+
+    for part_index in range(state.get('continuationMarker', 0), len(parts)):
+        part = parts[part_index]
+        files = FileList(s3_client, TMP_LOGS_BUCKET_NAME, part['files'])
+        resuming = state.get('continuationMarker') == part_index
+        phase = state.get('phase', 'combine') if resuming else 'combine'
+
+        if phase == 'combine' and combine:
+            combine_state = state.get('combine', {}) if resuming else {}
+            start = combine_state.get('continuationMarker', 0)
+            result = combine_files(
+                s3_client,
+                bucket_name,
+                dest_bucket_name,
+                part['key'],
+                TMP_LOGS_BUCKET_NAME,
+                files.entries(start),
+                start,
+                combine_state,
+                scheduler,
+                part_size=MERGE_PART_SIZE,
+                concurrency=DOWNLOAD_CONCURRENCY,
+                wanted=aggregatable,
+                force_first=not progress,
+                metrics=metrics,
+                compression_level=RECOMPRESSION_LEVEL
+            )
+            if result:
+                return checkpoint({'continuationMarker': part_index, 'parts': parts, 'phase': 'combine',
+                                   'combine': result, 'outputs': outputs})
+            outputs = outputs + archive_output(dest_bucket_name, part['key'])
+            progress = True
+
+        if phase in ('combine', 'parquet') and parquet:
+            parquet_state = state.get('parquet', {}) if resuming and phase == 'parquet' else {}
+            start = parquet_state.get('continuationMarker', 0)
+            result = write_parquet(
+                s3_client,
+                bucket_name,
+                dest_bucket_name,
+                bucket_name if DEST_LOGS_BUCKET_NAME else FINAL_AGGREGATION_PREFIX,
+                log_type,
+                account,
+                date,
+                f'part-{part_index + 1:04d}',
+                files.entries(start),
+                start,
+                parquet_state.get('fileNumber', 0),
+                scheduler,
+                concurrency=DOWNLOAD_CONCURRENCY,
+                wanted=aggregatable,
+                force_first=not progress,
+                metrics=metrics
+            )
+            if result:
+                return checkpoint({'continuationMarker': part_index, 'parts': parts, 'phase': 'parquet',
+                                   'parquet': result, 'outputs': outputs})
+            progress = True
+
+        start = state.get('deleteMarker', 0) if resuming and phase == 'delete' else 0
+        index = delete_files(s3_client, bucket_name, files.keys(start), len(files), start, scheduler,
+                             force_first=not progress, metrics=metrics)
+        if index is not None:
+            logger.info(f"Lambda might time out, returning continuationMarker for next invocation: {index}")
+            return checkpoint({'continuationMarker': part_index, 'parts': parts, 'phase': 'delete',
+                               'deleteMarker': index, 'outputs': outputs})
+        progress = True
+        checkpoint({'continuationMarker': part_index + 1, 'parts': parts, 'outputs': outputs})
+        files.delete()
+
+    journal.done(unit, outputs)
+    return {'status': 'done'}
+
+
+def archive_output(dest_bucket_name, key):
+    # The archive of a part as recorded in the journal, or nothing if no log file of
+    # the part was aggregated
+    try:
+        response = s3_client.head_object(Bucket=dest_bucket_name, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+        return []
+    return [{'key': key, 'etag': response['ETag']}]
+
+
+def plan_parts(bucket_name, account_prefix, log_type, date):
+    region_prefixes = list_regions(s3_client, bucket_name, account_prefix, log_type)
+    print(f"Regions: {region_prefixes}")
+    files = list_day_files(s3_client, bucket_name, region_prefixes, date)
+    if not files:
+        return []
+
+    # The file lists of the parts are passed inline only if the whole list would have
+    # been, so that the continuation marker stays within the Step Functions payload limit
+    inline_limit = INLINE_LIMIT if len(files) < INLINE_LIMIT else 0
+    split = split_by_size(files, MAX_ARCHIVE_SIZE)
+    parts = []
+    for n, part in enumerate(split, start=1):
+        part_number = n if len(split) > 1 else None
+        key = archive_key(map(entry_key, part), bucket_name, date, DEST_LOGS_BUCKET_NAME,
+                          FINAL_AGGREGATION_PREFIX, log_type=log_type, part=part_number,
+                          recompressed=RECOMPRESSION_LEVEL > 0)
+        print(f"Archive {key}: {len(part)} files")
+        name = f'{bucket_name}-{log_type}-{date}-{account_prefix.strip("/").replace("/", "-")}-{n}'
+        parts.append({'key': key, 'files': save_files(s3_client, TMP_LOGS_BUCKET_NAME, part, name, inline_limit)})
+    return parts
+
+
+def aggregatable(log_file):
+    if not AGGREGATION_REGIONS:
+        return True
+    for region in AGGREGATION_REGIONS:
+        if region in log_file:
+            return True
+    return False
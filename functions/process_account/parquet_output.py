@@ -0,0 +1,221 @@
+import os
+import json
+import tempfile
+from datetime import datetime
+from common.merge import decompressed, fetch_in_order
+from common.manifest import entry_fields, entry_last_modified
+
+
+# Writes the records of CloudTrail and Config log files as Parquet, for Athena, DuckDB
+# or pyarrow to read only the columns and row groups a query needs.
+#
+# The files go under {root}/parquet/{log type}/account={account}/region={region}/
+# date={YYYY-MM-DD}/, partitioned the way Athena expects. The well-known top-level
+# fields of the records each get a column of their own, the time as a timestamp and the
+# others as strings, with nested values as JSON. Any other fields are kept, as JSON, in
+# the column 'other', so that no part of a record is lost.
+#
+# Memory use is bounded: each log file is parsed on its own, its records are held until
+# they make up a row group of ROW_GROUP_BYTES of JSON, and row groups are sorted on the
+# time before they are written. As log files are listed in key order, which is close to
+# time order, the row groups then have narrow time ranges too, which readers use to skip
+# them. Files are written to /tmp, a row group at a time, and uploaded once they reach
+# FILE_SIZE, when the region changes, and when the lambda runs out of time.
+#
+# pyarrow is not part of the function by default, as it is large. Without it, no
+# Parquet is written.
+
+ROW_GROUP_BYTES = int(os.environ.get('PARQUET_ROW_GROUP_BYTES', 32 * 1024 * 1024))
+FILE_SIZE = int(os.environ.get('PARQUET_FILE_SIZE', 128 * 1024 * 1024))
+
+SCHEMAS = {
+    'CloudTrail': {
+        'records': 'Records',
+        'time': 'eventTime',
+        'columns': [
+            'eventVersion', 'eventSource', 'eventName', 'awsRegion', 'sourceIPAddress', 'userAgent',
+            'errorCode', 'errorMessage', 'requestID', 'eventID', 'eventType', 'readOnly',
+            'recipientAccountId', 'managementEvent', 'eventCategory', 'sharedEventID', 'vpcEndpointId',
+            'userIdentity', 'requestParameters', 'responseElements', 'resources', 'additionalEventData',
+            'tlsDetails', 'serviceEventDetails',
+        ],
+    },
+    'Config': {
+        'records': 'configurationItems',
+        'time': 'configurationItemCaptureTime',
+        'columns': [
+            'configurationItemVersion', 'configurationItemStatus', 'configurationStateId', 'awsAccountId',
+            'awsRegion', 'resourceType', 'resourceId', 'resourceName', 'ARN', 'availabilityZone',
+            'resourceCreationTime', 'configurationItemMD5Hash', 'configuration',
+            'supplementaryConfiguration', 'tags', 'relationships', 'relatedEvents',
+        ],
+    },
+}
+
+
+def parquet_available():
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def parquet_prefix(root, log_type, account, region, date):
+    return f'{root}/parquet/{log_type}/account={account}/region={region}/date={date}/'
+
+
+# Writes the records of the log files of a file list as Parquet, starting with the
+# entry at index start, into files named {name}-{number}.parquet. file_number is the
+# number of the last file written by an earlier invocation, so that its files aren't
+# overwritten. A log file is only begun if the scheduler predicts that it fits in the
+# time left, except for the first one when force_first is set.
+#
+# Returns None when all log files are done, or else the state to resume from:
+# {'continuationMarker': index of the next entry, 'fileNumber': ...}.
+def write_parquet(s3_client, source_bucket, dest_bucket, root, log_type, account, date, name, entries, start,
+                  file_number, scheduler, concurrency=32, wanted=None, force_first=True, metrics=None):
+    writer = ParquetFiles(s3_client, dest_bucket, root, log_type, account, date, name, file_number, metrics)
+    wanted_files = (
+        (index, *entry_fields(entry), entry_last_modified(entry))
+        for index, entry in enumerate(entries, start=start)
+        if wanted is None or wanted(entry_fields(entry)[0])
+    )
+    fetched_files = fetch_in_order(s3_client, source_bucket, wanted_files, concurrency)
+    try:
+        for n, (index, log_file, size, etag, _last_modified, body) in enumerate(fetched_files):
+            if (n > 0 or not force_first) and not scheduler.fits('parquet', size):
+                writer.close()
+                return {'continuationMarker': index, 'fileNumber': writer.file_number}
+
+            with scheduler.timed('parquet', size):
+                if body is None:
+                    kwargs = {'IfMatch': etag} if etag else {}
+                    body = s3_client.get_object(Bucket=source_bucket, Key=log_file, **kwargs)['Body'].read()
+                writer.add(region_of(log_file, log_type), b''.join(decompressed([body])))
+        writer.close()
+    finally:
+        fetched_files.close()
+        writer.discard()
+    return None
+
+
+def region_of(log_file, log_type):
+    # The region of a main log file, from .../{log type}/{region}/{YYYY}/...
+    return log_file.split(f'/{log_type}/', 1)[1].split('/')[0]
+
+
+class ParquetFiles:
+
+    def __init__(self, s3_client, bucket, root, log_type, account, date, name, file_number=0, metrics=None):
+        import pyarrow as pa
+        self.pa = pa
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.root = root
+        self.log_type = log_type
+        self.account = account
+        self.date = date
+        self.name = name
+        self.file_number = file_number
+        self.metrics = metrics
+
+        self.schema = SCHEMAS[log_type]
+        self.arrow_schema = pa.schema(
+            [(self.schema['time'], pa.timestamp('ms', tz='UTC'))] +
+            [(column, pa.string()) for column in self.schema['columns']] +
+            [('other', pa.string())]
+        )
+        self.region = None
+        self.rows = []
+        self.row_bytes = 0
+        self.writer = None
+        self.path = None
+
+    def add(self, region, data):
+        # Adds the records of a log file, given as its decompressed JSON
+        if region != self.region:
+            self.close()
+            self.region = region
+        try:
+            records = json.loads(data).get(self.schema['records']) or []
+        except (ValueError, AttributeError):
+            # Not a log file of records, e.g. a ConfigWritabilityCheckFile
+            return
+        self.rows += [self.row(record) for record in records]
+        self.row_bytes += len(data)
+        if self.row_bytes >= ROW_GROUP_BYTES:
+            self.flush()
+
+    def row(self, record):
+        fields = dict(record)
+        row = {self.schema['time']: parse_time(fields.pop(self.schema['time'], None))}
+        for column in self.schema['columns']:
+            row[column] = as_string(fields.pop(column, None))
+        row['other'] = json.dumps(fields) if fields else None
+        return row
+
+    def flush(self):
+        # Writes the records held as a row group, sorted on the time
+        if not self.rows:
+            return
+        import pyarrow.parquet as pq
+        time = self.schema['time']
+        self.rows.sort(key=lambda row: (row[time] is None, row[time] or 0))
+        table = self.pa.Table.from_pylist(self.rows, schema=self.arrow_schema)
+        if self.writer is None:
+            fd, self.path = tempfile.mkstemp(suffix='.parquet')
+            os.close(fd)
+            self.writer = pq.ParquetWriter(self.path, self.arrow_schema, compression='zstd')
+        self.writer.write_table(table, row_group_size=len(self.rows))
+        if self.metrics:
+            self.metrics.add('ParquetRows', len(self.rows))
+        self.rows = []
+        self.row_bytes = 0
+        if os.path.getsize(self.path) >= FILE_SIZE:
+            self.upload()
+
+    def upload(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.writer = None
+        self.file_number += 1
+        prefix = parquet_prefix(self.root, self.log_type, self.account, self.region, self.date)
+        key = f'{prefix}{self.name}-{self.file_number:05d}.parquet'
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as f:
+            self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=f, StorageClass='STANDARD_IA')
+        print(f"Wrote {key}, {size} bytes")
+        if self.metrics:
+            self.metrics.add('ParquetBytes', size, 'Bytes')
+        os.remove(self.path)
+        self.path = None
+
+    def close(self):
+        self.flush()
+        self.upload()
+
+    def discard(self):
+        # Removes what is left in /tmp after a failure
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+            self.path = None
+
+
+def parse_time(value):
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+
+
+def as_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
@@ -0,0 +1,25 @@
+import os
+import boto3
+from common.journal import Journal
+from common.metrics import Metrics
+from common.throttle import RateController
+
+STATE_BUCKET_NAME = os.environ['STATE_BUCKET_NAME']
+
+metrics = Metrics('record_done')
+rate_controller = RateController(metrics)
+
+s3_client = rate_controller.instrument(metrics.instrument(boto3.client('s3')))
+
+
+# Records in the journal of the date that a bucket other than the Control Tower log
+# bucket has been aggregated and its originals deleted, so that GetFilesFunction
+# skips it when the date is run again.
+
+@metrics.handler
+def lambda_handler(data, _context):
+    bucket_name = data['bucket_name']
+    date = data['date']
+    Journal(s3_client, STATE_BUCKET_NAME, bucket_name, date).done()
+    print(f"{bucket_name} is done for {date}")
+    return {'status': 'done'}
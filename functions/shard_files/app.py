@@ -0,0 +1,173 @@
+import os
+import re
+import json
+import random
+import boto3
+from common.archive_key import archive_key, slice_key
+from common.manifest import FileList, INLINE_LIMIT, entry_key, save_files, split_by_size
+from common.metrics import Metrics
+from common.throttle import RateController
+
+TMP_LOGS_BUCKET_NAME = os.environ['TMP_LOGS_BUCKET_NAME']
+DEST_LOGS_BUCKET_NAME = os.environ.get('DEST_LOGS_BUCKET_NAME', '')
+FINAL_AGGREGATION_PREFIX = os.environ.get('FINAL_AGGREGATION_PREFIX', '')
+RECOMPRESSION_LEVEL = int(os.environ.get('RECOMPRESSION_LEVEL', 0))
+MIN_SIZE = int(os.environ['MIN_SIZE'])
+
+# The size above which an archive is split into parts. It is never taken to be less
+# than twice the minimum size, so that the parts stay above the minimum size.
+MAX_ARCHIVE_SIZE = max(int(os.environ['MAX_ARCHIVE_SIZE']), 2 * MIN_SIZE)
+
+# The number of files above which the parts are handed to a Distributed Map rather
+# than to the inline one, and the most files each of its parts may then hold
+DISTRIBUTED_MAP_THRESHOLD = int(os.environ.get('DISTRIBUTED_MAP_THRESHOLD', 100000))
+MAX_FILES_PER_PART = int(os.environ.get('MAX_FILES_PER_PART', 20000))
+
+# The most parts returned inline, a few hundred bytes each, so that the list stays well
+# within the 256 KB Step Functions payload limit. More parts than this, as with an
+# organisation of thousands of accounts, are handed to the Distributed Map too.
+MAX_INLINE_PARTS = int(os.environ.get('MAX_INLINE_PARTS', 500))
+
+metrics = Metrics('shard_files')
+rate_controller = RateController(metrics)
+
+s3_client = rate_controller.instrument(metrics.instrument(boto3.client('s3')))
+
+
+# Splits a file list into shards, one per AWS account ID or one per hour, so that each
+# shard can be combined into an archive of its own, in parallel with the others. Files
+# in which no account ID or hour can be found go into an unlabelled shard. When all
+# files are to be aggregated together, there is just the one unlabelled shard.
+#
+# Shards larger than the maximum archive size are further split into parts of about
+# the same size, which are also combined in parallel, each into an archive of its own.
+#
+# Returns a list of {'shard': label, 'part': n, 'files': file list}. The label is the
+# account ID, or the hour as 'T14', and the part number is None unless the shard was
+# split. Both become part of the archive key.
+#
+# Buckets with more than DISTRIBUTED_MAP_THRESHOLD files are too much for the inline
+# Map, as each of its iterations is a single serial chain, and more than
+# MAX_INLINE_PARTS parts are too many to return inline. Their shards are also split
+# into parts of at most MAX_FILES_PER_PART files, and the list of parts is written to
+# the temp bucket as a JSON array, for a Distributed Map to read. As these slices are
+# only there to spread the work, they don't show in the archive keys: each is given an
+# explicit key, that of the archive it belongs to with a slice number, and is combined
+# into the temp bucket, marked 'slice'. The slices of each archive are then assembled
+# into it, in the destination bucket, as listed in a second JSON array of
+# {'key': archive key, 'files': slice keys}. What is returned is then
+# {'slicesKey': key of the list of slices, 'assembliesKey': key of the list of
+# assemblies, 'count': number of slices}.
+
+@metrics.handler
+def lambda_handler(data, _context):
+    bucket_name = data['bucket_name']
+    date = data['date']
+    operation_type = data.get('operation_type', 'aggregate_all')
+    files = FileList(s3_client, TMP_LOGS_BUCKET_NAME, data['files'])
+
+    if operation_type == 'aggregate_all':
+        shard_of = lambda key: ''
+    elif operation_type == 'aggregate_per_account':
+        shard_of = account_of
+    elif operation_type == 'aggregate_per_hour':
+        shard_of = hour_patterns(date)
+    else:
+        raise ValueError(f"Can't shard files for operation type {operation_type}")
+
+    shards = {}
+    for entry in files:
+        shards.setdefault(shard_of(entry_key(entry)), []).append(entry)
+    print(f"{len(files)} files in {len(shards)} shards")
+    metrics.add('FilesProcessed', len(files))
+
+    parts = []
+    for shard in sorted(shards):
+        shard_parts = split_by_size(shards[shard], MAX_ARCHIVE_SIZE)
+        if len(shard_parts) > 1:
+            print(f"Shard '{shard}' split into {len(shard_parts)} parts")
+        parts += [(shard, n if len(shard_parts) > 1 else None, n, part) for n, part in enumerate(shard_parts, start=1)]
+
+    # The shards are passed inline only if the whole list was, so that the total stays
+    # within the Step Functions payload limit
+    inline_limit = INLINE_LIMIT if len(files) < INLINE_LIMIT else 0
+    distributed = len(files) > DISTRIBUTED_MAP_THRESHOLD or len(parts) > MAX_INLINE_PARTS
+    result = []
+    assemblies = []
+    for shard, part_number, n, part in parts:
+        name = f'{bucket_name}-{date}-{shard or "all"}-{n}'
+        if not distributed:
+            result.append({
+                'shard': shard,
+                'part': part_number,
+                'files': save_files(s3_client, TMP_LOGS_BUCKET_NAME, part, name, inline_limit),
+            })
+            continue
+
+        key = archive_key(
+            (entry_key(entry) for entry in part),
+            bucket_name,
+            date,
+            DEST_LOGS_BUCKET_NAME,
+            FINAL_AGGREGATION_PREFIX,
+            shard=shard,
+            part=part_number,
+            recompressed=RECOMPRESSION_LEVEL > 0,
+        )
+        slices = [part[i:i + MAX_FILES_PER_PART] for i in range(0, len(part), MAX_FILES_PER_PART)]
+        slice_keys = [slice_key(key, m) for m in range(1, len(slices) + 1)] if len(slices) > 1 else [key]
+        for m, (slice_files, files_key) in enumerate(zip(slices, slice_keys), start=1):
+            result.append({
+                'key': files_key,
+                'slice': len(slices) > 1,
+                'files': save_files(s3_client, TMP_LOGS_BUCKET_NAME, slice_files, f'{name}-{m}', 0),
+            })
+        if len(slices) > 1:
+            assemblies.append({'key': key, 'files': slice_keys})
+
+    if distributed:
+        return save_slices(bucket_name, date, result, assemblies)
+    return result
+
+
+def save_slices(bucket_name, date, slices, assemblies):
+    # The lists, like the file lists of the slices, are left to expire from the temp bucket
+    noise = random.randint(100000000, 999999999)
+    slices_key = f'slices/{bucket_name}-{date}-{noise}.json'
+    assemblies_key = f'slices/{bucket_name}-{date}-{noise}-assemblies.json'
+    for key, items in ((slices_key, slices), (assemblies_key, assemblies)):
+        s3_client.put_object(
+            Body=json.dumps(items),
+            Bucket=TMP_LOGS_BUCKET_NAME,
+            Key=key,
+        )
+    print(f"{len(slices)} slices handed to the Distributed Map in {slices_key}, "
+          f"{len(assemblies)} archives to assemble from them in {assemblies_key}")
+    return {'slicesKey': slices_key, 'assembliesKey': assemblies_key, 'count': len(slices)}
+
+
+def account_of(key):
+    # Twelve digits on their own, which may be followed by an underscore, as in the
+    # names of VPC Flow Logs and ELB log files
+    match = re.search(r'(?<!\d)\d{12}(?!\d)', key)
+    return match.group(0) if match else ''
+
+
+def hour_patterns(date):
+    # The hour is looked for right after the date, in the key forms used by the
+    # AWS services: 2024/03/05/14/, 2024-03-05-14, 20240305T1405Z, and so on
+    year, month, day = date.split('-')
+    month, day = int(month), int(day)
+    patterns = [
+        re.compile(rf'{year}/0?{month}/0?{day}/(\d\d)/'),
+        re.compile(rf'{year}-?{month:02d}-?{day:02d}[T-](\d\d)'),
+    ]
+
+    def hour_of(key):
+        for pattern in patterns:
+            match = pattern.search(key)
+            if match and int(match.group(1)) < 24:
+                return f'T{match.group(1)}'
+        return ''
+
+    return hour_of
@@ -0,0 +1,57 @@
+import gzip
+import json
+from common.manifest import encode_chunk, decode_chunk
+
+
+# Each combined archive gets a small sidecar index, stored next to it, which lists the
+# original log files it was made from: their keys, where in the archive they start,
+# their lengths and their last modification times. As the archive is a plain
+# concatenation of the original files, any one of them can be retrieved with a ranged
+# GET, without downloading the whole archive.
+#
+# Indexes are stored as STANDARD, whatever the storage class of their archive: they
+# are far smaller than the 128 KB minimum billed for STANDARD_IA, and they must stay
+# readable to tell what to restore once the archive is in Glacier.
+#
+# The index uses the same compact encoding as the chunks of file list manifests, with
+# entries of [key, offset, length, last_modified]. An archive compacted from daily
+# archives also has 'days': [date, offset, length, daily archive key] for each of
+# them.
+
+SUFFIX = '.index.json.gz'
+FORMAT = 1
+
+
+def index_key(archive_key):
+    return f'{archive_key}{SUFFIX}'
+
+
+def is_index_key(key):
+    return key.endswith(SUFFIX)
+
+
+def write_index(s3_client, bucket, archive_key, entries, size, extra=None):
+    body = {'format': FORMAT, 'size': size, **encode_chunk(entries), **(extra or {})}
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=index_key(archive_key),
+        Body=gzip.compress(json.dumps(body).encode()),
+        ContentType='application/json'
+    )
+
+
+def read_index(s3_client, bucket, archive_key):
+    # Returns the entries of the index of the archive, or None if it has no index
+    document = read_index_document(s3_client, bucket, archive_key)
+    if document is None:
+        return None
+    return list(decode_chunk(document))
+
+
+def read_index_document(s3_client, bucket, archive_key):
+    # Returns the whole index of the archive, as stored, or None if it has no index
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=index_key(archive_key))
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    return json.loads(gzip.decompress(response['Body'].read()))
@@ -0,0 +1,47 @@
+import os
+
+
+# Determines the key of the archive into which log files are combined, from the keys of
+# the log files. The name of the archive is the base name the log files have in common,
+# or the log type if they have none, followed by the shard and the part number, if any.
+# The archive is stored under {root}/{YYYY}/{MM}/{DD}/, where the root is the name of
+# the source bucket when a common destination bucket is used, and the final aggregation
+# prefix otherwise. Archives get the .gz extension unless made from S3 access logs, which
+# are plain text, and not recompressed.
+def archive_key(keys, bucket_name, date, dest_bucket_name, final_aggregation_prefix,
+                log_type=None, shard=None, part=None, recompressed=False):
+    prefix = None
+    for file in keys:
+        base_name = (file.split('/')[-1]).split('.')[0]
+        prefix = base_name if prefix is None else os.path.commonprefix([prefix, base_name])
+    prefix = (prefix or '').strip('-_')
+    if not prefix:
+        # No common prefix, use what we have
+        prefix = log_type or 'Aggregated-Logs'
+
+    # Each shard of a sharded aggregation gets an archive of its own
+    if shard and shard not in prefix:
+        prefix = f"{prefix}-{shard}"
+
+    # As does each part of an archive which was split by size
+    if part:
+        prefix = f"{prefix}-part-{part:04d}"
+
+    # If this is an S3 access log bucket, there's no gzip encryption, unless recompressed
+    only_gz = recompressed or 's3-access-logs' not in bucket_name
+
+    # If we have a destination bucket, the prefix is the origin bucket name
+    aggregation_prefix = bucket_name if dest_bucket_name else final_aggregation_prefix
+
+    year, month, day = date.split('-')
+    prefix = f"{aggregation_prefix}/{year}/{month}/{day}/{prefix}"
+    if only_gz:
+        prefix += '.gz'
+    return prefix
+
+
+def slice_key(key, n):
+    # The key of the nth slice of the archive at key, which is combined on its own
+    # and then assembled into the archive with the other slices
+    stem, gz, _ = key.rpartition('.gz') if key.endswith('.gz') else (key, '', '')
+    return f"{stem}-slice-{n:05d}{gz}"
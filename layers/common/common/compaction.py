@@ -0,0 +1,38 @@
+import calendar
+from datetime import date, timedelta
+
+
+# Daily archives too small to go to Deep Archive are compacted, a week or a month at a
+# time, into {root}/{YYYY}/compacted/{period}/, where the period is YYYY-MM for a month
+# or YYYY-Www for an ISO week, and YYYY is the year of its first day. The index of a
+# compacted archive lists the original log files, like that of a daily archive, along
+# with 'days': where each of the daily archives it was made from begins and ends.
+
+
+def compacted_prefix(root, first_day, period):
+    return f'{root}/{first_day.year}/compacted/{period}/'
+
+
+def period_dates(period):
+    # The dates of a period, YYYY-MM or YYYY-Www
+    if '-W' in period:
+        year, week = period.split('-W')
+        monday = date.fromisocalendar(int(year), int(week), 1)
+        return [monday + timedelta(days=n) for n in range(7)]
+    year, month = map(int, period.split('-'))
+    n_days = calendar.monthrange(year, month)[1]
+    return [date(year, month, day) for day in range(1, n_days + 1)]
+
+
+def periods_of(day):
+    # The (first day, period) of the month and the week a date belongs to
+    year, week, weekday = day.isocalendar()
+    return [
+        (day.replace(day=1), day.strftime('%Y-%m')),
+        (day - timedelta(days=weekday - 1), f'{year}-W{week:02d}'),
+    ]
+
+
+def archive_date(key):
+    # The date of a daily archive, from its {YYYY}/{MM}/{DD}/ folder
+    return '-'.join(key.split('/')[-4:-1])
@@ -0,0 +1,107 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from botocore.exceptions import ClientError
+
+
+# The largest number of files whose versions are looked up and deleted in one go,
+# between checks of the remaining time
+FILES_PER_ROUND = 10000
+# The number of listings or delete_objects calls made at the same time
+CONCURRENCY = 16
+# If more files than this can't be deleted, the whole operation fails
+MAX_FAILED_FILES = 100
+
+
+# Deletes all versions of the files whose keys are given, the first of which is the
+# entry at index start of a file list of n_files entries. Keys in keep are left alone.
+# Each round deletes as many files as the scheduler predicts can be deleted in the time
+# left; the first round always deletes something when force_first is set, so that every
+# invocation makes progress.
+#
+# Returns None when all files are deleted, or else the index of the next file to delete.
+# A ClientError from looking up the versions is passed on. The keys of files some
+# version of which could not be deleted are added to failed; without a failed list to
+# add them to, or when there are more than MAX_FAILED_FILES of them, a RuntimeError is
+# raised instead, so that the deletion is retried rather than silently left undone.
+def delete_files(s3_client, bucket_name, keys, n_files, start, scheduler, keep=(), force_first=True,
+                 files_per_round=FILES_PER_ROUND, concurrency=CONCURRENCY, metrics=None, failed=None):
+    index = start
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while index < n_files:
+
+            n_round = scheduler.claim('delete', files_per_round)
+            if n_round == 0 and (index > start or not force_first):
+                return index
+            n_round = max(n_round, 1)
+
+            with scheduler.timed('delete', min(n_round, n_files - index)):
+                # Prepare a list of objects to delete along with their versions
+                round_files = [key for key in islice(keys, n_round) if key not in keep]
+                objects_to_delete = find_versions(s3_client, pool, bucket_name, round_files)
+                print(f"{len(objects_to_delete)} objects to delete...")
+
+                # Delete objects in concurrent batches. The S3 delete_objects API allows up
+                # to 1000 keys at once.
+                batches = [objects_to_delete[i:i+1000] for i in range(0, len(objects_to_delete), 1000)]
+                round_failed = []
+                for n_deleted, batch_failed in pool.map(lambda batch: delete_batch(s3_client, bucket_name, batch),
+                                                        batches):
+                    print(f"Deleted {n_deleted} items.")
+                    round_failed += batch_failed
+                    if metrics:
+                        metrics.add('VersionsDeleted', n_deleted)
+                if metrics:
+                    metrics.add('FilesProcessed', len(round_files))
+
+            if round_failed:
+                if failed is None:
+                    raise RuntimeError(f"{len(round_failed)} files could not be deleted from {bucket_name}")
+                failed += [key for key in dict.fromkeys(round_failed) if key not in failed]
+                if len(failed) > MAX_FAILED_FILES:
+                    raise RuntimeError(f"More than {MAX_FAILED_FILES} files could not be deleted from {bucket_name}")
+
+            index += n_round
+    return None
+
+
+def find_versions(s3_client, pool, bucket_name, files):
+    # Rather than listing the versions of each file separately, the versions of all
+    # files in the same "directory" are listed together, using the longest prefix
+    # they have in common. The delimiter keeps the listing from descending into
+    # subdirectories. Only versions of the exact keys given are returned.
+    wanted = set(files)
+    groups = {}
+    for key in files:
+        groups.setdefault(key.rpartition('/')[0], []).append(key)
+    prefixes = [os.path.commonprefix(keys) for keys in groups.values()]
+
+    def list_versions(prefix):
+        versions = []
+        paginator = s3_client.get_paginator('list_object_versions')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+            for version in page.get('Versions', []) + page.get('DeleteMarkers', []):
+                if version['Key'] in wanted:
+                    versions.append({'Key': version['Key'], 'VersionId': version['VersionId']})
+        return versions
+
+    return [version for versions in pool.map(list_versions, prefixes) for version in versions]
+
+
+# Returns the number of versions deleted, and the keys of those which were not
+def delete_batch(s3_client, bucket_name, batch):
+    try:
+        response = s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={
+                'Objects': batch,
+                'Quiet': False  # Set Quiet to False to get the list of deleted objects
+            }
+        )
+    except ClientError as e:
+        print(f"An error occurred during deletion: {e}")
+        return 0, [version['Key'] for version in batch]
+    errors = response.get('Errors', [])
+    if errors:
+        print(f"Errors encountered: {errors}")
+    return len(response.get('Deleted', [])), [error['Key'] for error in errors]
@@ -0,0 +1,76 @@
+import json
+import time
+from botocore.exceptions import ClientError
+
+
+# A journal of the units of work of a date, kept in the state bucket, so that an
+# execution which is re-run after failing part of the way, or a historical run over
+# dates partly done, only does the work that is left.
+#
+# A unit is the main logs of one log type of one account, (log type, account), or all
+# of another bucket, (). Its entry is at journal/{bucket}/{date}/{log type}/{account}.json,
+# or journal/{bucket}/{date}/bucket.json, and is either
+#
+#   {'status': 'done', 'outputs': [{'key': ..., 'etag': ...}, ...]}, written once the
+#   unit is complete, its originals deleted, or
+#   {'status': 'running', 'state': ..., 'written': ...}, the state to resume from,
+#   written whenever an invocation hands its work over to the next.
+#
+# The entries are keyed by bucket and date rather than by execution, so that a new
+# execution for the same date finds them. Unlike the temp bucket, the state bucket
+# keeps them long after the day; a state, however, refers to the file lists and partly
+# merged archives of the temp bucket, which expire after a day, so states older than
+# MAX_STATE_AGE are ignored, so that one is never resumed without them. A unit without
+# an entry is simply done from the start, which once its originals are deleted costs
+# no more than listing them.
+#
+# Only the two units that are read back have entries: the accounts, by
+# ProcessAccountFunction, which resumes or skips them, and the other buckets, by
+# GetFilesFunction, which skips those done. The stages within the aggregation of
+# another bucket are not journalled; when it is run again, they start over from its
+# listing, which only finds the originals not yet deleted.
+
+MAX_STATE_AGE = 12 * 60 * 60
+
+
+class Journal:
+
+    def __init__(self, s3_client, state_bucket_name, bucket_name, date):
+        self.s3_client = s3_client
+        self.state_bucket_name = state_bucket_name
+        self.bucket_name = bucket_name
+        self.date = date
+
+    def key(self, unit=()):
+        name = '/'.join(unit) if unit else 'bucket'
+        return f'journal/{self.bucket_name}/{self.date}/{name}.json'
+
+    def get(self, unit=()):
+        # Returns the entry of a unit, or None if there is none to go by
+        try:
+            response = self.s3_client.get_object(Bucket=self.state_bucket_name, Key=self.key(unit))
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            return None
+        entry = json.loads(response['Body'].read())
+        if entry['status'] == 'running' and time.time() - entry['written'] > MAX_STATE_AGE:
+            return None
+        return entry
+
+    def is_done(self, unit=()):
+        entry = self.get(unit)
+        return entry is not None and entry['status'] == 'done'
+
+    def checkpoint(self, unit, state):
+        self._put(unit, {'status': 'running', 'state': state, 'written': time.time()})
+
+    def done(self, unit=(), outputs=None):
+        self._put(unit, {'status': 'done', 'outputs': outputs or []})
+
+    def _put(self, unit, entry):
+        self.s3_client.put_object(
+            Body=json.dumps(entry),
+            Bucket=self.state_bucket_name,
+            Key=self.key(unit),
+        )
@@ -0,0 +1,106 @@
+# Lists the main log files of an account in the Control Tower log bucket, i.e. the
+# CloudTrail, CloudTrail-Digest and Config logs, which are stored under
+# {account prefix}{log type}/{region}/{YYYY}/{MM}/{DD}/.
+
+from concurrent.futures import ThreadPoolExecutor
+
+# The number of prefixes listed at a time
+LIST_CONCURRENCY = 16
+
+
+def list_account_prefixes(s3_client, bucket_name, org_id, log_type):
+    # Returns the prefixes of the accounts which have logs of the given type
+    if log_type in ['CloudTrail', 'CloudTrail-Digest']:
+        print(f"Checking whether the {log_type} log structure is that of Control Tower v3.0 or higher...")
+
+        prefix = f'{org_id}/AWSLogs/{org_id}/'
+        response = s3_client.list_objects_v2(
+            Bucket=bucket_name,
+            Delimiter='/',
+            Prefix=prefix
+        )
+        account_prefixes = list(map(lambda x: x['Prefix'], response.get('CommonPrefixes', [])))
+        if account_prefixes:
+            print(f"Version 3.0+ detected: logs found under {prefix}.")
+            return account_prefixes
+        print(f"No logs found under {prefix}, assuming Control Tower < v3.0.")
+
+    prefix = f'{org_id}/AWSLogs/'
+    response = s3_client.list_objects_v2(
+        Bucket=bucket_name,
+        Delimiter='/',
+        Prefix=prefix
+    )
+    return list(map(lambda x: x['Prefix'], response['CommonPrefixes']))
+
+
+def list_regions(s3_client, bucket_name, account_prefix, log_type):
+    # Returns the region prefixes under which an account has logs of the given type
+    response = s3_client.list_objects_v2(
+        Bucket=bucket_name,
+        Delimiter='/',
+        Prefix=account_prefix + log_type + '/'
+    )
+    return list(map(lambda x: x['Prefix'], response.get('CommonPrefixes', [])))
+
+
+def list_day_files(s3_client, bucket_name, region_prefixes, date, concurrency=LIST_CONCURRENCY):
+    # Returns the file list entries, [key, size, ETag, last modified], of the .gz log
+    # files of the date under the region prefixes. The prefixes of all regions, in both
+    # date forms, are listed concurrently, and each page is filtered as it arrives, so
+    # that only the entries wanted are ever held. The entries are returned in the order
+    # of the prefixes.
+    year, month, day = date.split('-')
+    month_trimmed = month.lstrip('0')
+    day_trimmed = day.lstrip('0')
+
+    date_forms = [
+        f'{year}-{month}-{day}',
+        f'{year}-{month_trimmed}-{day_trimmed}',
+        f'{year}/{month}/{day}/',
+        f'{year}/{month_trimmed}/{day_trimmed}/',
+        f'{year}{month}{day}',
+    ]
+
+    prefixes = []
+    for raw_prefix in region_prefixes:
+        # Since the Control Tower team is known to do unannounced breaking changes, play safe:
+        prefixes.append(f'{raw_prefix}{year}/{month}/{day}/')
+        trimmed_prefix = f'{raw_prefix}{year}/{month_trimmed}/{day_trimmed}/'
+        if trimmed_prefix != prefixes[-1]:
+            prefixes.append(trimmed_prefix)
+
+    def list_prefix(prefix):
+        print(f"Finding files with the prefix {prefix}")
+        n_found = 0
+        wanted = []
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            contents = page.get('Contents', [])
+            n_found += len(contents)
+            wanted += [manifest_entry(obj) for obj in contents if is_wanted(obj['Key'], date_forms)]
+        return n_found, wanted
+
+    entries = []
+    n_found = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(prefixes)))) as pool:
+        for n, found in pool.map(list_prefix, prefixes):
+            n_found += n
+            entries += found
+
+    print(f"Total number of files found: {n_found}")
+    print(f"Total number of interesting files: {len(entries)}")
+    return entries
+
+
+def manifest_entry(obj):
+    return [obj['Key'], obj['Size'], obj['ETag'].strip('"'), int(obj['LastModified'].timestamp())]
+
+
+def is_wanted(key, date_forms):
+    if not key.endswith('.gz'):
+        return False
+    for f in date_forms:
+        if f in key:
+            return True
+    return False
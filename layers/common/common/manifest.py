@@ -0,0 +1,182 @@
+import gzip
+import json
+import random
+from common.throttle import spread_key
+
+
+# File lists are passed between the states of the state machines. Short lists are passed
+# inline, as JSON lists. Longer ones are stored in the temp bucket as manifests, and only
+# the key of the manifest is passed.
+#
+# Each file list entry is [key, size, etag, last_modified] as returned by the listing, or
+# just the key. A manifest consists of a small header object holding the number of
+# entries and the chunk size, followed by gzipped chunks of chunk_size entries each. As
+# log file keys are long and very repetitive, each chunk stores the "directory" part of
+# its keys once, in a table, and the entries refer to it by index. A reader resuming at
+# a particular index only needs to fetch the header and the chunks from that index on.
+#
+# Manifests written by earlier versions, plain JSON lists of keys, can still be read.
+
+INLINE_LIMIT = 100
+CHUNK_SIZE = 2000
+FORMAT = 2
+
+
+def entry_key(entry):
+    return entry if isinstance(entry, str) else entry[0]
+
+
+def entry_fields(entry):
+    # Returns (key, size, etag), where the size and the etag are None for plain keys
+    if isinstance(entry, str):
+        return entry, None, None
+    return entry[0], entry[1], entry[2]
+
+
+def entry_last_modified(entry):
+    # The last modification time as a Unix timestamp, or None if not known
+    return None if isinstance(entry, str) or len(entry) < 4 else entry[3]
+
+
+def save_files(s3_client, tmp_bucket_name, files, name, inline_limit=INLINE_LIMIT):
+    # If the number of files is small, then just return the file list as is
+    if len(files) < inline_limit:
+        return files
+
+    # For a long list, store it as a manifest and return the key to it
+    noise = random.randint(100000000, 999999999)
+    manifest_key = spread_key(f'{name}-{noise}.manifest')
+    write_manifest(s3_client, tmp_bucket_name, manifest_key, files)
+    return manifest_key
+
+
+def write_manifest(s3_client, tmp_bucket_name, manifest_key, files, chunk_size=CHUNK_SIZE):
+    n_chunks = 0
+    for start in range(0, len(files), chunk_size):
+        s3_client.put_object(
+            Body=gzip.compress(json.dumps(encode_chunk(files[start:start + chunk_size])).encode()),
+            Bucket=tmp_bucket_name,
+            Key=chunk_key(manifest_key, n_chunks),
+        )
+        n_chunks += 1
+
+    # The header is written last, so that a manifest is never seen half-written
+    s3_client.put_object(
+        Body=json.dumps({
+            'format': FORMAT,
+            'count': len(files),
+            'chunk_size': chunk_size,
+            'chunks': n_chunks,
+        }),
+        Bucket=tmp_bucket_name,
+        Key=manifest_key,
+    )
+
+
+def chunk_key(manifest_key, n):
+    return f'{manifest_key}.{n:05d}.json.gz'
+
+
+def encode_chunk(files):
+    directories = {}
+    entries = []
+    for entry in files:
+        key = entry_key(entry)
+        directory, slash, name = key.rpartition('/')
+        index = directories.setdefault(directory + slash, len(directories))
+        if isinstance(entry, str):
+            entries.append([index, name])
+        else:
+            entries.append([index, name, *entry[1:]])
+    return {'directories': list(directories), 'entries': entries}
+
+
+def decode_chunk(chunk):
+    directories = chunk['directories']
+    for entry in chunk['entries']:
+        key = directories[entry[0]] + entry[1]
+        yield [key, *entry[2:]] if len(entry) > 2 else key
+
+
+# A read-only view of a file list, whichever way it was passed. Entries are streamed
+# one chunk at a time, so memory use doesn't grow with the length of the list.
+class FileList:
+
+    def __init__(self, s3_client, tmp_bucket_name, thing):
+        self.s3_client = s3_client
+        self.tmp_bucket_name = tmp_bucket_name
+        self.manifest_key = thing if isinstance(thing, str) else None
+        self.inline = thing if isinstance(thing, list) else None
+        self.header = None
+
+        if self.manifest_key:
+            response = s3_client.get_object(Bucket=tmp_bucket_name, Key=self.manifest_key)
+            header = json.loads(response['Body'].read())
+            if isinstance(header, list):
+                # A manifest written by an earlier version
+                self.inline = header
+            else:
+                self.header = header
+
+    def __len__(self):
+        if self.header:
+            return self.header['count']
+        return len(self.inline)
+
+    def __iter__(self):
+        return self.entries()
+
+    def entries(self, start=0):
+        # Yields the entries from index start onwards
+        if not self.header:
+            yield from self.inline[start:]
+            return
+
+        chunk_size = self.header['chunk_size']
+        skip = start % chunk_size
+        for n in range(start // chunk_size, self.header['chunks']):
+            response = self.s3_client.get_object(
+                Bucket=self.tmp_bucket_name,
+                Key=chunk_key(self.manifest_key, n)
+            )
+            chunk = json.loads(gzip.decompress(response['Body'].read()))
+            for entry in decode_chunk(chunk):
+                if skip:
+                    skip -= 1
+                    continue
+                yield entry
+
+    def keys(self, start=0):
+        return map(entry_key, self.entries(start))
+
+    def delete(self):
+        # Deletes the manifest, if there is one
+        if not self.manifest_key:
+            return
+        keys = [self.manifest_key]
+        if self.header:
+            keys += [chunk_key(self.manifest_key, n) for n in range(self.header['chunks'])]
+        for i in range(0, len(keys), 1000):
+            self.s3_client.delete_objects(
+                Bucket=self.tmp_bucket_name,
+                Delete={'Objects': [{'Key': key} for key in keys[i:i+1000]], 'Quiet': True}
+            )
+
+
+def split_by_size(files, max_size):
+    # Splits the files, in order, into as few parts as needed to stay below max_size,
+    # making the parts about the same size. Each file goes into the part in which its
+    # midpoint falls. Files of unknown size count as empty.
+    sizes = [entry_fields(entry)[1] or 0 for entry in files]
+    total = sum(sizes)
+    n_parts = max(1, -(-total // max_size))
+    if n_parts == 1:
+        return [files]
+
+    target = total / n_parts
+    parts = [[] for _ in range(n_parts)]
+    offset = 0
+    for entry, size in zip(files, sizes):
+        parts[min(n_parts - 1, int((offset + size / 2) / target))].append(entry)
+        offset += size
+    return [part for part in parts if part]
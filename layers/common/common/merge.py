@@ -0,0 +1,571 @@
+import json
+import time
+import zlib
+import logging
+from collections import deque
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
+from common.archive_index import write_index
+from common.manifest import entry_fields, entry_key, entry_last_modified
+from common.throttle import spread_key
+
+# Configure the logger
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+FIVE_MB = 5 * 1024 * 1024
+FIVE_GB = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# The most data decompressed from a chunk at a time, so that a chunk of highly
+# compressed data doesn't expand into hundreds of MB at once
+MAX_DECOMPRESSED = 1024 * 1024
+
+
+# Concatenates any number of S3 objects into one object using a single multipart upload.
+#
+# All parts of a multipart upload except the last one must be at least 5 MB. Objects
+# large enough to stand on their own are added server-side with UploadPartCopy. Small
+# objects are read into an in-memory buffer which is uploaded as a part of its own as
+# soon as it has reached the part size. When a large object follows a partially filled
+# buffer, the buffer is topped up with the first bytes of the large object and the rest
+# of it is then copied server-side. This keeps the original order of the objects, and
+# every byte is read or copied exactly once, so the cost is linear in the total size.
+#
+# The merge can be suspended between two objects and resumed in a later invocation:
+# the parts already uploaded are recovered from S3 using the upload ID, and whatever
+# is left in the buffer is parked in the temp bucket in the meantime. Parts beyond the
+# count recorded at suspension time come from an attempt that failed and was retried;
+# they are ignored and will be overwritten. The parked buffer is named after the offset
+# reached when suspending, which is returned along with the upload ID and the part
+# count, so that a state saved by the caller always resumes with its own buffer: should
+# the state of a later suspension fail to be saved, resuming from the earlier one doesn't
+# pick up the buffer of the later one.
+#
+# The offset and length of every object added are recorded, and written as a sidecar
+# index next to the result when the merge is completed. While suspended, the index so
+# far is parked in the temp bucket along with the buffer. An object which has an index
+# of its own can pass its entries to add(), to be recorded instead of the object; extra
+# holds anything else to write with the index.
+class MultipartMerge:
+
+    def __init__(self, s3_client, bucket, key, tmp_bucket, upload_id=None, part_count=0,
+                 part_size=FIVE_MB, storage_class='STANDARD_IA', offset=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.tmp_bucket = tmp_bucket
+        self.part_size = max(part_size, FIVE_MB)
+        self.storage_class = storage_class
+        self.parts = []
+        self.buffer = bytearray()
+        self.index = []
+        self.extra = {}
+        self.offset = 0
+        self.suspended_at = offset
+        self.created = False
+
+        if upload_id:
+            self.upload_id = upload_id
+            self._recover_state(part_count)
+        else:
+            mpu = s3_client.create_multipart_upload(
+                Bucket=bucket,
+                Key=key,
+                StorageClass=storage_class
+            )
+            self.upload_id = mpu['UploadId']
+            self.created = True
+
+    # All that is parked for a merge shares one prefix, whatever the offset. Merges
+    # suspended by an earlier version returned no offset, and parked it at the prefix.
+    @property
+    def pending_key(self):
+        return self._at_offset(spread_key(f'{self.key}.pending'))
+
+    @property
+    def pending_index_key(self):
+        return self._at_offset(spread_key(f'{self.key}.index.pending'))
+
+    def _at_offset(self, prefix):
+        return prefix if self.suspended_at is None else f'{prefix}.{self.suspended_at}'
+
+    # When the ETag of the object is given, the object must not have changed since it
+    # was listed, as any change would make the size and the ranges used here invalid.
+    def add(self, bucket, key, size=None, etag=None, body=None, last_modified=None, index_entries=None):
+        if size is None:
+            size = self.s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        if size == 0:
+            return
+
+        if self.index is not None and index_entries is not None:
+            self.index += [[log_file, self.offset + offset, length, modified]
+                           for log_file, offset, length, modified in index_entries]
+        elif self.index is not None:
+            self.index.append([key, self.offset, size, last_modified])
+        self.offset += size
+
+        # Small objects always go into the buffer, and may already have been downloaded
+        if size < FIVE_MB:
+            if body is not None:
+                self.buffer += body
+            else:
+                self._read_into_buffer(bucket, key, etag, 0, size, size)
+            if len(self.buffer) >= self.part_size:
+                self._upload_buffer()
+            return
+
+        # A large object. If there is something in the buffer, that data must be sent
+        # first, which requires the buffer to reach the minimum part size.
+        offset = 0
+        if self.buffer:
+            needed = max(0, FIVE_MB - len(self.buffer))
+            if size - needed < FIVE_MB:
+                # What would remain isn't large enough to copy, so read all of it
+                self._read_into_buffer(bucket, key, etag, 0, size, size)
+                if len(self.buffer) >= self.part_size:
+                    self._upload_buffer()
+                return
+            if needed:
+                self._read_into_buffer(bucket, key, etag, 0, needed, size)
+                offset = needed
+            self._upload_buffer()
+
+        self._copy_range(bucket, key, etag, offset, size)
+
+    def suspend(self):
+        # Park the buffer in the temp bucket until the next invocation. An empty
+        # buffer is parked too, as resuming requires it. Whatever was parked at
+        # earlier offsets is kept until the merge ends, as the state pointing at it
+        # may still be the last one saved.
+        self.suspended_at = self.offset
+        self.s3_client.put_object(
+            Bucket=self.tmp_bucket,
+            Key=self.pending_key,
+            Body=bytes(self.buffer)
+        )
+        self.s3_client.put_object(
+            Bucket=self.tmp_bucket,
+            Key=self.pending_index_key,
+            Body=json.dumps({'offset': self.offset, 'index': self.index, 'extra': self.extra})
+        )
+        return {'uploadId': self.upload_id, 'partCount': len(self.parts), 'offset': self.offset}
+
+    def complete(self):
+        if self.buffer:
+            self._upload_buffer()
+
+        if not self.parts:
+            # Nothing was added. An empty multipart upload can't be completed.
+            logger.info(f"Nothing to combine into {self.key}, aborting the upload")
+            self.abort()
+            return None
+
+        response = self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            MultipartUpload={'Parts': self.parts},
+            UploadId=self.upload_id
+        )
+        if self.index is not None:
+            write_index(self.s3_client, self.bucket, self.key, self.index, self.offset, self.extra)
+        self._delete_pending()
+        return response
+
+    def abort(self):
+        self.s3_client.abort_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id
+        )
+        self._delete_pending()
+
+    def _next_part_number(self):
+        part_number = len(self.parts) + 1
+        if part_number > MAX_PARTS:
+            raise RuntimeError(f"{self.key} would need more than {MAX_PARTS} parts")
+        return part_number
+
+    def _read_into_buffer(self, bucket, key, etag, start, end, size):
+        kwargs = {}
+        if etag:
+            kwargs['IfMatch'] = etag
+        if start > 0 or end < size:
+            kwargs['Range'] = f'bytes={start}-{end-1}'
+        response = self.s3_client.get_object(Bucket=bucket, Key=key, **kwargs)
+        self.buffer += response['Body'].read()
+
+    def _upload_buffer(self):
+        part_number = self._next_part_number()
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=part_number,
+            UploadId=self.upload_id,
+            Body=bytes(self.buffer)
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = bytearray()
+
+    def _copy_range(self, bucket, key, etag, start, end):
+        # A single UploadPartCopy can't exceed 5 GB, so split larger ranges into equal
+        # chunks, all of which will then be well above the 5 MB minimum.
+        kwargs = {'CopySourceIfMatch': etag} if etag else {}
+        length = end - start
+        n_chunks = -(-length // FIVE_GB)
+        chunk_size = -(-length // n_chunks)
+        for chunk_start in range(start, end, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, end)
+            part_number = self._next_part_number()
+            response = self.s3_client.upload_part_copy(
+                Bucket=self.bucket,
+                Key=self.key,
+                CopySource={'Bucket': bucket, 'Key': key},
+                CopySourceRange=f'bytes={chunk_start}-{chunk_end-1}',
+                PartNumber=part_number,
+                UploadId=self.upload_id,
+                **kwargs
+            )
+            self.parts.append({
+                'ETag': response['CopyPartResult']['ETag'],
+                'PartNumber': part_number
+            })
+
+    def _recover_state(self, part_count):
+        paginator = self.s3_client.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id):
+            for part in page.get('Parts', []):
+                if part['PartNumber'] <= part_count:
+                    self.parts.append({'ETag': part['ETag'], 'PartNumber': part['PartNumber']})
+        self.parts.sort(key=lambda x: x['PartNumber'])
+        if len(self.parts) != part_count:
+            raise RuntimeError(f"Expected {part_count} parts for {self.key}, found {len(self.parts)}")
+
+        try:
+            response = self.s3_client.get_object(Bucket=self.tmp_bucket, Key=self.pending_key)
+            self.buffer = bytearray(response['Body'].read())
+        except self.s3_client.exceptions.NoSuchKey:
+            if self.suspended_at is not None:
+                raise RuntimeError(f"No buffer parked for {self.key} at offset {self.suspended_at}")
+
+        try:
+            response = self.s3_client.get_object(Bucket=self.tmp_bucket, Key=self.pending_index_key)
+            pending_index = json.loads(response['Body'].read())
+            self.offset = pending_index['offset']
+            self.index = pending_index['index']
+            self.extra = pending_index.get('extra', {})
+        except self.s3_client.exceptions.NoSuchKey:
+            if self.suspended_at is not None:
+                raise RuntimeError(f"No index parked for {self.key} at offset {self.suspended_at}")
+            # Suspended by an earlier version. The index would be incomplete, so none
+            # is written for this merge.
+            logger.warning(f"No pending index for {self.key}, no index will be written")
+            self.index = None
+            return
+
+        if self.suspended_at is not None and self.offset != self.suspended_at:
+            raise RuntimeError(f"The index parked for {self.key} ends at {self.offset}, "
+                               f"not at offset {self.suspended_at}")
+
+    def _delete_pending(self):
+        # Whatever was parked at any offset
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        keys = [obj['Key']
+                for prefix in (spread_key(f'{self.key}.pending'), spread_key(f'{self.key}.index.pending'))
+                for page in paginator.paginate(Bucket=self.tmp_bucket, Prefix=prefix)
+                for obj in page.get('Contents', [])]
+        for n in range(0, len(keys), 1000):
+            self.s3_client.delete_objects(
+                Bucket=self.tmp_bucket,
+                Delete={'Objects': [{'Key': key} for key in keys[n:n + 1000]], 'Quiet': True}
+            )
+
+
+# A MultipartMerge which, rather than concatenating the objects as they are, passes
+# their contents through a gzip compressor. Gzipped objects are decompressed first, so
+# thousands of tiny gzip members become a few large ones, which compress much better,
+# and plain text objects, such as S3 access logs, are compressed.
+#
+# The output is a series of gzip members, each closed once it holds member_size bytes
+# of uncompressed data, and always between two objects, so that every object lies
+# within a single member. The index entry of an object is the member holding it, as
+# that is the smallest range which can be decompressed on its own; for an object which
+# has an index of its own, such as an archive, each of the log files listed in it gets
+# an entry for that member instead. A newline is added
+# after each object not ending with one, as the objects are no longer separated by the
+# ends of their own gzip members.
+#
+# Objects are streamed a chunk at a time, large ones included, so memory use is bounded
+# by the part size, whatever the size of the objects. As the state of the compressor
+# can't be kept between invocations, the current member is closed when suspending.
+#
+# The bytes read, the bytes written and the time spent compressing are reported as the
+# RecompressionBytesIn, RecompressionBytesOut and RecompressionSeconds metrics.
+class RecompressingMerge(MultipartMerge):
+
+    MEMBER_SIZE = 16 * 1024 * 1024
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, s3_client, bucket, key, tmp_bucket, upload_id=None, part_count=0,
+                 part_size=FIVE_MB, storage_class='STANDARD_IA', offset=None, level=6, member_size=MEMBER_SIZE,
+                 metrics=None):
+        super().__init__(s3_client, bucket, key, tmp_bucket, upload_id, part_count, part_size, storage_class, offset)
+        self.level = level
+        self.member_size = member_size
+        self.metrics = metrics
+        self.compressor = None
+        self.member_start = self.offset
+        self.member_raw = 0
+        self.member_objects = []
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def add(self, bucket, key, size=None, etag=None, body=None, last_modified=None, index_entries=None):
+        if size is None:
+            size = self.s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        if size == 0:
+            return
+
+        start = time.monotonic()
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+            self.member_start = self.offset
+
+        last = b'\n'
+        chunks = [body] if body is not None else self._stream(bucket, key, etag)
+        for data in decompressed(chunks):
+            if data:
+                self._write(self.compressor.compress(data))
+                self.member_raw += len(data)
+                last = data[-1:]
+        if last != b'\n':
+            self._write(self.compressor.compress(b'\n'))
+            self.member_raw += 1
+
+        if index_entries is not None:
+            self.member_objects += [[log_file, modified] for log_file, _, _, modified in index_entries]
+        else:
+            self.member_objects.append([key, last_modified])
+        self.bytes_in += size
+        if self.member_raw >= self.member_size:
+            self._end_member()
+        self.seconds += time.monotonic() - start
+
+    def suspend(self):
+        self._end_member()
+        self._report()
+        return super().suspend()
+
+    def complete(self):
+        self._end_member()
+        self._report()
+        return super().complete()
+
+    def _stream(self, bucket, key, etag):
+        kwargs = {'IfMatch': etag} if etag else {}
+        response = self.s3_client.get_object(Bucket=bucket, Key=key, **kwargs)
+        return response['Body'].iter_chunks(self.CHUNK_SIZE)
+
+    def _write(self, data):
+        if not data:
+            return
+        self.buffer += data
+        self.offset += len(data)
+        self.bytes_out += len(data)
+        if len(self.buffer) >= self.part_size:
+            self._upload_buffer()
+
+    def _end_member(self):
+        if self.compressor is None:
+            return
+        self._write(self.compressor.flush())
+        if self.index is not None:
+            length = self.offset - self.member_start
+            self.index += [[key, self.member_start, length, last_modified]
+                           for key, last_modified in self.member_objects]
+        self.compressor = None
+        self.member_raw = 0
+        self.member_objects = []
+
+    def _report(self):
+        if not self.bytes_out:
+            return
+        ratio = self.bytes_in / self.bytes_out
+        rate = self.bytes_in / self.seconds / (1024 * 1024) if self.seconds else 0.0
+        logger.info(f"Recompressed {self.bytes_in} bytes into {self.bytes_out}, "
+                    f"{ratio:.1f} times smaller, at {rate:.1f} MB/s")
+        if self.metrics:
+            self.metrics.add('RecompressionBytesIn', self.bytes_in, 'Bytes')
+            self.metrics.add('RecompressionBytesOut', self.bytes_out, 'Bytes')
+            self.metrics.add('RecompressionSeconds', self.seconds, 'Seconds')
+
+
+def decompressed(chunks, separator=b'', max_length=MAX_DECOMPRESSED):
+    # Yields the data of a stream of any number of concatenated gzip members, or of
+    # plain data, as it is given. The separator, if any, is yielded after each member.
+    # Compressed data is yielded at most max_length bytes at a time.
+    chunks = iter(chunks)
+    first = next(chunks, b'')
+    if not first.startswith(GZIP_MAGIC):
+        yield first
+        yield from chunks
+        return
+
+    decompressor = zlib.decompressobj(wbits=31)
+    for data in chain([first], chunks):
+        while True:
+            output = decompressor.decompress(data, max_length)
+            yield output
+            data = decompressor.unconsumed_tail
+            if decompressor.eof:
+                if separator:
+                    yield separator
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits=31)
+                if not data:
+                    break
+            elif not data and len(output) < max_length:
+                # All of the chunk is consumed, and nothing more is held back
+                break
+    yield decompressor.flush()
+
+
+# Fetches log files concurrently while yielding them strictly in their original order.
+#
+# The items are (index, key, size, etag, last_modified) tuples, where all but the index
+# and the key may be None if they aren't known.
+# Objects smaller than 5 MB are downloaded in their entirety, as they will have to pass
+# through the merge buffer anyway; for the others only the size is determined, as they
+# will be copied server-side. At most max_in_flight objects are fetched or held at any
+# one time, so memory use stays bounded regardless of the number of files. The result
+# is a stream of (index, key, size, etag, last_modified, body) tuples, where body is None
+# for large objects.
+def fetch_in_order(s3_client, bucket, items, max_in_flight=32):
+
+    def fetch(key, size, etag):
+        if size is None:
+            size = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        body = None
+        if 0 < size < FIVE_MB:
+            kwargs = {'IfMatch': etag} if etag else {}
+            body = s3_client.get_object(Bucket=bucket, Key=key, **kwargs)['Body'].read()
+        return size, body
+
+    items = iter(items)
+    window = deque()
+    pool = ThreadPoolExecutor(max_workers=max_in_flight)
+    try:
+        for index, key, size, etag, last_modified in items:
+            window.append((index, key, etag, last_modified, pool.submit(fetch, key, size, etag)))
+            if len(window) >= max_in_flight:
+                break
+        while window:
+            index, key, etag, last_modified, future = window.popleft()
+            size, body = future.result()
+            # Top up the window before handing over the result
+            for next_index, next_key, next_size, next_etag, next_last_modified in items:
+                window.append((next_index, next_key, next_etag, next_last_modified,
+                               pool.submit(fetch, next_key, next_size, next_etag)))
+                break
+            yield index, key, size, etag, last_modified, body
+    finally:
+        # Don't fetch anything more if the consumer stops early
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+# Like the map of a thread pool, but calling fn on the items as they are consumed, with
+# at most max_in_flight calls ahead of the consumer, rather than on all items at once.
+def map_in_order(fn, items, max_in_flight=32):
+    items = iter(items)
+    window = deque()
+    pool = ThreadPoolExecutor(max_workers=max_in_flight)
+    try:
+        for item in islice(items, max_in_flight):
+            window.append(pool.submit(fn, item))
+        while window:
+            result = window.popleft().result()
+            for item in islice(items, 1):
+                window.append(pool.submit(fn, item))
+            yield result
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+# Combines the log files of a file list into the object at key, starting with the entry
+# at index start, and resuming the multipart upload of an earlier invocation if state
+# holds one. Log files for which wanted(key) is false are skipped. Adding a log file is
+# only begun if the scheduler predicts that it fits in the time left, except for the
+# first one when force_first is set, so that every invocation makes progress.
+#
+# With a compression level, 1 to 9, the log files are recompressed into gzip by a
+# RecompressingMerge rather than concatenated.
+#
+# Returns None when the combined object is complete, or else the state to resume from:
+# {'continuationMarker': index of the next entry, 'uploadId': ..., 'partCount': ...}.
+def combine_files(s3_client, source_bucket, dest_bucket, key, tmp_bucket, entries, start, state,
+                  scheduler, part_size=FIVE_MB, concurrency=32, wanted=None, force_first=True, metrics=None,
+                  compression_level=None, storage_class='STANDARD_IA'):
+    if compression_level:
+        merge_class, options = RecompressingMerge, {'level': compression_level, 'metrics': metrics}
+    else:
+        merge_class, options = MultipartMerge, {}
+    merge = merge_class(
+        s3_client,
+        dest_bucket,
+        key,
+        tmp_bucket,
+        upload_id=state.get('uploadId'),
+        part_count=state.get('partCount', 0),
+        part_size=part_size,
+        storage_class=storage_class,
+        offset=state.get('offset'),
+        **options
+    )
+
+    # Small log files are downloaded concurrently ahead of the merge, which receives
+    # them in order. Large ones are copied server-side by the merge itself.
+    wanted_files = (
+        (index, *entry_fields(entry), entry_last_modified(entry))
+        for index, entry in enumerate(entries, start=start)
+        if wanted is None or wanted(entry_key(entry))
+    )
+    fetched_files = fetch_in_order(s3_client, source_bucket, wanted_files, concurrency)
+
+    try:
+        for n, (index, log_file, size, etag, last_modified, body) in enumerate(fetched_files):
+
+            # Downloaded log files are appended to the in-memory part; others are copied
+            # server-side, unless everything is recompressed
+            if compression_level:
+                operation = 'recompress'
+            else:
+                operation = 'append' if body is not None else 'copy'
+            if (n > 0 or not force_first) and not scheduler.fits(operation, size):
+                logger.info(f"Lambda might time out, returning continuationMarker for next invocation: {index}")
+                return {'continuationMarker': index, **merge.suspend()}
+
+            with scheduler.timed(operation, size):
+                merge.add(source_bucket, log_file, size, etag, body, last_modified)
+            if metrics:
+                metrics.add('FilesProcessed', 1)
+                metrics.add('BytesMerged', size, 'Bytes')
+
+        # All log files have now been added. Completing the upload puts the final
+        # result in place in the destination bucket.
+        merge.complete()
+
+    except Exception:
+        # A failed first invocation will be retried from scratch, so don't leave
+        # an orphaned upload behind.
+        if merge.created:
+            merge.abort()
+        raise
+
+    finally:
+        fetched_files.close()
+
+    return None
@@ -0,0 +1,166 @@
+import os
+import re
+import json
+import time
+import random
+import threading
+from collections import Counter
+from functools import wraps
+
+
+# Emits one record per invocation in the CloudWatch Embedded Metric Format (EMF), which
+# CloudWatch Logs turns into metrics without any API calls being made. A record holds
+# what the handler reports through add(), e.g. files processed and bytes merged, along
+# with the S3 calls made by the instrumented clients, by operation, a sample of their
+# latencies, whether a continuation marker was returned, and the time left of the
+# invocation when it ended.
+#
+# Metrics are given per function, and per function and bucket. Records are tagged with
+# the bucket, log type and account of the invocation, where known, so that they can be
+# looked into with CloudWatch Logs Insights. Accounts are not made a dimension, as each
+# would add a set of custom metrics.
+#
+# Usage:
+#
+#   metrics = Metrics('combine_log_files')
+#   s3_client = metrics.instrument(boto3.client('s3'))
+#
+#   @metrics.handler
+#   def lambda_handler(data, context):
+#       ...
+#       metrics.add('FilesProcessed', 1)
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'ControlTowerLogAggregator')
+
+# The most values EMF accepts for a metric in a single record
+MAX_VALUES = 100
+
+ACCOUNT_ID = re.compile(r'\b\d{12}\b')
+
+
+class Metrics:
+
+    def __init__(self, function, namespace=NAMESPACE):
+        self.function = function
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+            self.calls = Counter()
+            self.latencies = []
+            self.n_latencies = 0
+            self.tags = {}
+
+    def instrument(self, client):
+        # Counts and times the S3 calls made by a boto3 client, or by the client of a
+        # boto3 resource
+        events = client.meta.events
+        events.register('before-call.s3', self._before_call)
+        events.register('after-call.s3', self._after_call)
+        events.register('after-call-error.s3', self._after_call)
+        return client
+
+    def add(self, name, value, unit='Count'):
+        with self.lock:
+            total = self.values.get(name, (0, unit))[0]
+            self.values[name] = (total + value, unit)
+
+    def tag(self, **tags):
+        with self.lock:
+            self.tags.update({name: value for name, value in tags.items() if value})
+
+    def handler(self, function):
+        # Wraps a lambda handler, emitting a record when it returns or fails
+        @wraps(function)
+        def wrapper(data, context):
+            self.reset()
+            if isinstance(data, dict):
+                self.tag_invocation(data)
+            result = None
+            failed = True
+            try:
+                result = function(data, context)
+                failed = False
+                return result
+            finally:
+                self.emit(context, result, failed)
+        return wrapper
+
+    def tag_invocation(self, data):
+        account = ACCOUNT_ID.search(data.get('account_prefix') or data.get('shard') or '')
+        self.tag(
+            Bucket=data.get('bucket_name'),
+            LogType=data.get('log_type'),
+            Account=account.group(0) if account else None,
+        )
+
+    def emit(self, context, result=None, failed=False):
+        with self.lock:
+            values = dict(self.values)
+            calls = dict(self.calls)
+            latencies = list(self.latencies)
+            tags = dict(self.tags)
+
+        values['S3Calls'] = (sum(calls.values()), 'Count')
+        values['Continuations'] = (int(isinstance(result, dict) and 'continuationMarker' in result), 'Count')
+        values['Errors'] = (int(failed), 'Count')
+        if context is not None:
+            values['HeadroomSeconds'] = (context.get_remaining_time_in_millis() / 1000.0, 'Seconds')
+        if latencies:
+            values['S3Latency'] = (latencies, 'Milliseconds')
+        operations = {f'S3Calls.{operation}': n for operation, n in calls.items()}
+
+        dimension_sets = [['Function']]
+        if 'Bucket' in tags:
+            dimension_sets.append(['Function', 'Bucket'])
+            if 'LogType' in tags:
+                dimension_sets.append(['Function', 'Bucket', 'LogType'])
+
+        directives = [{
+            'Namespace': self.namespace,
+            'Dimensions': dimension_sets,
+            'Metrics': [{'Name': name, 'Unit': unit} for name, (_value, unit) in values.items()],
+        }]
+        if operations:
+            # The calls by operation are summed over all functions, to keep the number
+            # of custom metrics down
+            directives.append({
+                'Namespace': self.namespace,
+                'Dimensions': [[]],
+                'Metrics': [{'Name': name, 'Unit': 'Count'} for name in operations],
+            })
+
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': directives,
+            },
+            'Function': self.function,
+            **tags,
+            **{name: value for name, (value, _unit) in values.items()},
+            **operations,
+        }
+        print(json.dumps(record), flush=True)
+
+    def _before_call(self, model, context, **_kwargs):
+        context['metrics_start'] = time.monotonic()
+        with self.lock:
+            self.calls[model.name] += 1
+
+    def _after_call(self, context, **_kwargs):
+        start = context.get('metrics_start')
+        if start is None:
+            return
+        latency = (time.monotonic() - start) * 1000
+        with self.lock:
+            # A uniform sample of the latencies, as EMF takes at most MAX_VALUES of them
+            self.n_latencies += 1
+            if len(self.latencies) < MAX_VALUES:
+                self.latencies.append(latency)
+            else:
+                n = random.randrange(self.n_latencies)
+                if n < MAX_VALUES:
+                    self.latencies[n] = latency
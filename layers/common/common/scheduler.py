@@ -0,0 +1,71 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+# Decides whether more work fits in the time left of an invocation, so that a function
+# can return a continuation marker before it times out. Instead of stopping at a fixed
+# margin, the time taken by each kind of operation is recorded per unit of work (a file,
+# a byte) and the next one is predicted from a high percentile of the recent samples.
+# Until an operation has been measured a few times, the old fixed margin applies to it.
+#
+# The reserve is the time kept back for wrapping up, e.g. parking a partial merge.
+
+RESERVE = 20
+UNMEASURED = 120
+PERCENTILE = 95
+WINDOW = 100
+MIN_SAMPLES = 3
+
+
+class Scheduler:
+
+    def __init__(self, context, reserve=RESERVE, unmeasured=UNMEASURED, percentile=PERCENTILE,
+                 window=WINDOW, min_samples=MIN_SAMPLES):
+        self.context = context
+        self.reserve = reserve
+        self.unmeasured = unmeasured
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self.samples = {}
+
+    def remaining(self):
+        return self.context.get_remaining_time_in_millis() / 1000.0
+
+    def record(self, operation, seconds, units=1):
+        if units > 0:
+            self.samples.setdefault(operation, deque(maxlen=self.window)).append(seconds / units)
+
+    @contextmanager
+    def timed(self, operation, units=1):
+        start = time.monotonic()
+        yield
+        self.record(operation, time.monotonic() - start, units)
+
+    def rate(self, operation):
+        # The predicted seconds per unit, or None if not measured enough yet
+        samples = self.samples.get(operation)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, len(ordered) * self.percentile // 100)]
+
+    def predict(self, operation, units=1):
+        rate = self.rate(operation)
+        return self.unmeasured if rate is None else rate * units
+
+    def fits(self, operation, units=1):
+        return self.remaining() - self.reserve >= self.predict(operation, units)
+
+    def claim(self, operation, limit):
+        # Returns the number of units, at most limit, expected to fit in the time left.
+        # Until the operation has been measured, a whole claim is assumed to take the
+        # unmeasured time.
+        available = self.remaining() - self.reserve
+        rate = self.rate(operation)
+        if rate is None:
+            return limit if available >= self.unmeasured else 0
+        if rate == 0:
+            return limit
+        return max(0, min(limit, int(available / rate)))
@@ -0,0 +1,138 @@
+import os
+import time
+import hashlib
+import threading
+
+
+# Keeps the S3 requests made by a lambda within what S3 will take, instead of leaving
+# it to the retries of botocore once S3 starts answering SlowDown.
+#
+# Requests are grouped by bucket and the first PREFIX_DEPTH segments of their key or
+# prefix, as S3 scales its request rate per prefix. Each group has a window: the most
+# requests it may have in flight at a time. Windows start at INITIAL_WINDOW, about the
+# number of threads a lambda makes requests from, so that the first SlowDown already
+# holds it back. Each request answered with SlowDown halves the window of its group (at
+# most once per
+# DECREASE_INTERVAL, as a burst of them is a single event), and each request that
+# succeeds widens it by 1/window, i.e. by about one per window of requests, the
+# additive-increase, multiplicative-decrease scheme of TCP. Requests beyond the
+# window wait for one to finish.
+#
+# The SlowDown answers and the time spent waiting are reported as the S3Throttles and
+# S3ThrottleWait metrics.
+#
+# The windows are those of a single lambda invocation environment: they are not shared
+# with the other lambdas working on the same prefixes at the same time, which S3 sees
+# the sum of. Each of them slows down on the SlowDown answers it gets itself, so that
+# together they back off as S3 asks, but a lambda starting while S3 is throttling the
+# others starts at INITIAL_WINDOW all the same.
+#
+# Usage:
+#
+#   controller = RateController(metrics)
+#   s3_client = controller.instrument(metrics.instrument(boto3.client('s3')))
+
+PREFIX_DEPTH = int(os.environ.get('THROTTLE_PREFIX_DEPTH', 1))
+MAX_WINDOW = int(os.environ.get('THROTTLE_MAX_WINDOW', 256))
+INITIAL_WINDOW = min(int(os.environ.get('THROTTLE_INITIAL_WINDOW', 32)), MAX_WINDOW)
+DECREASE_INTERVAL = 0.5
+
+THROTTLE_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests'}
+
+
+def spread_key(key, width=2):
+    # Puts a key of the temp bucket under one of 16 ** width prefixes, chosen by its
+    # hash, so that the temp objects of different log files don't share one prefix
+    return f'{hashlib.md5(key.encode()).hexdigest()[:width]}/{key}'
+
+
+class Window:
+
+    def __init__(self, size):
+        self.size = float(size)
+        self.in_flight = 0
+        self.decreased = 0.0
+
+
+class RateController:
+
+    def __init__(self, metrics=None, max_window=MAX_WINDOW, prefix_depth=PREFIX_DEPTH, initial_window=INITIAL_WINDOW):
+        self.metrics = metrics
+        self.max_window = max_window
+        self.initial_window = min(initial_window, max_window)
+        self.prefix_depth = prefix_depth
+        self.windows = {}
+        self.condition = threading.Condition()
+
+    def instrument(self, client):
+        events = client.meta.events
+        events.register('before-parameter-build.s3', self._before_parameter_build)
+        events.register('before-call.s3', self._before_call)
+        events.register('response-received.s3', self._response_received)
+        events.register('after-call.s3', self._after_call)
+        events.register('after-call-error.s3', self._after_call)
+        return client
+
+    def group(self, params):
+        path = params.get('Key') or params.get('Prefix') or ''
+        return (params.get('Bucket', ''), '/'.join(path.split('/')[:self.prefix_depth]))
+
+    def acquire(self, group):
+        waited = 0.0
+        with self.condition:
+            window = self.windows.setdefault(group, Window(self.initial_window))
+            if window.in_flight >= int(window.size):
+                start = time.monotonic()
+                while window.in_flight >= int(window.size):
+                    self.condition.wait()
+                waited = time.monotonic() - start
+            window.in_flight += 1
+        if waited and self.metrics:
+            self.metrics.add('S3ThrottleWait', waited, 'Seconds')
+
+    def release(self, group):
+        with self.condition:
+            self.windows[group].in_flight -= 1
+            self.condition.notify_all()
+
+    def succeeded(self, group):
+        with self.condition:
+            window = self.windows[group]
+            window.size = min(self.max_window, window.size + 1 / window.size)
+            self.condition.notify_all()
+
+    def throttled(self, group):
+        now = time.monotonic()
+        with self.condition:
+            window = self.windows[group]
+            if now - window.decreased >= DECREASE_INTERVAL:
+                window.size = max(1.0, window.size / 2)
+                window.decreased = now
+                print(f"S3 throttling on {group[0]}/{group[1]}, now at most {int(window.size)} requests at a time")
+        if self.metrics:
+            self.metrics.add('S3Throttles', 1)
+
+    def _before_parameter_build(self, params, context, **_kwargs):
+        context['throttle_group'] = self.group(params)
+
+    def _before_call(self, context, **_kwargs):
+        group = context.get('throttle_group')
+        if group is not None:
+            self.acquire(group)
+            context['throttle_acquired'] = True
+
+    def _response_received(self, context, response_dict=None, parsed_response=None, exception=None, **_kwargs):
+        # Called once per attempt, retries included
+        group = context.get('throttle_group')
+        if group is None or not context.get('throttle_acquired'):
+            return
+        code = (parsed_response or {}).get('Error', {}).get('Code')
+        status = (response_dict or {}).get('status_code')
+        if code in THROTTLE_CODES or status == 503:
+            self.throttled(group)
+        elif exception is None and status is not None and status < 500:
+            self.succeeded(group)
+
+    def _after_call(self, context, **_kwargs):
+        if context.pop('throttle_acquired', False):
+            self.release(context['throttle_group'])
@@ -0,0 +1,70 @@
+import os
+import sys
+from pathlib import Path
+import boto3
+import pytest
+from moto import mock_aws
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT / 'layers' / 'common'), str(ROOT / 'benchmarks')]
+
+
+# The tests run the lambda handlers and the code of the common layer against moto's
+# in-process S3. The environment of the handlers is that of the template, with the
+# bucket names below.
+
+TMP_BUCKET = 'test-tmp-logs'
+STATE_BUCKET = 'test-log-aggregator-state'
+DEST_BUCKET = 'test-all-aggregated-logs'
+SOURCE_BUCKET = 'test-source-logs'
+
+os.environ.update({
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_SECURITY_TOKEN': 'testing',
+    'AWS_SESSION_TOKEN': 'testing',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'TMP_LOGS_BUCKET_NAME': TMP_BUCKET,
+    'STATE_BUCKET_NAME': STATE_BUCKET,
+    'DEST_LOGS_BUCKET_NAME': DEST_BUCKET,
+    'FINAL_AGGREGATION_PREFIX': 'AggregatedLogs',
+    'MIN_SIZE': str(200 * 1024),
+    'MAX_ARCHIVE_SIZE': str(2 * 1024 * 1024 * 1024),
+    'ORG_ID': 'o-test',
+})
+os.environ.pop('AWS_ENDPOINT_URL_S3', None)
+
+
+# A stand-in for the Lambda context with a fixed amount of time left, or one that runs
+# out after a number of calls, to exercise the continuation paths
+class FakeContext:
+
+    def __init__(self, seconds=900, calls=None):
+        self.seconds = seconds
+        self.calls = calls
+
+    def get_remaining_time_in_millis(self):
+        if self.calls is not None:
+            self.calls -= 1
+            if self.calls < 0:
+                return 0
+        return self.seconds * 1000
+
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        boto3.setup_default_session()
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=TMP_BUCKET)
+        client.create_bucket(Bucket=STATE_BUCKET)
+        for bucket in (DEST_BUCKET, SOURCE_BUCKET):
+            client.create_bucket(Bucket=bucket)
+            client.put_bucket_versioning(Bucket=bucket, VersioningConfiguration={'Status': 'Enabled'})
+        yield client
+
+
+def keys_of(s3_client, bucket, prefix=''):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    return [obj['Key'] for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+            for obj in page.get('Contents', [])]
@@ -0,0 +1,41 @@
+import gzip
+import json
+import random
+import boto3
+from datetime import datetime
+from conftest import DEST_BUCKET, SOURCE_BUCKET, FakeContext, keys_of
+from harness import S3Meter, copy_source, load_handler
+from synthetic import LogContents, SizeDistribution, populate, stream_keys
+
+
+def test_copy_source_forms():
+    assert copy_source({'Bucket': 'b', 'Key': 'a/b c'}) == ('b', 'a/b c')
+    assert copy_source('b/a/b%20c') == ('b', 'a/b c')
+    assert copy_source('b/a/key?versionId=v1') == ('b', 'a/key')
+
+
+def test_copy_path_is_metered(s3):
+    # The copy path of the benchmark: large streamed log files copied with CopyObject,
+    # with the copied bytes counted by the meter
+    date = datetime(2024, 3, 5)
+    sizes = SizeDistribution(300 * 1024, 0.2, minimum=250 * 1024, maximum=400 * 1024)
+    objects = populate(s3, SOURCE_BUCKET, list(stream_keys(date, streams=1))[:8], sizes, date)
+
+    meter = S3Meter({(SOURCE_BUCKET, key): size for key, size in objects.items()})
+    meter.install(boto3.DEFAULT_SESSION)
+    handler = load_handler('copy_log_files')
+    files = [[key, size, None] for key, size in objects.items()]
+    result = handler({'bucket_name': SOURCE_BUCKET, 'date': '2024-03-05', 'files': files}, FakeContext())
+
+    assert result == {'status': 'done'}
+    assert meter.calls['CopyObject'] == len(objects)
+    assert meter.bytes['copied'] == sum(objects.values())
+    assert len(keys_of(s3, DEST_BUCKET, f'{SOURCE_BUCKET}/2024/03/05/')) == len(objects)
+
+
+def test_synthetic_log_files_are_gzipped_json():
+    contents = LogContents('CloudTrail', datetime(2024, 3, 5))
+    body = contents.make(50000, random.Random(1))
+    records = json.loads(gzip.decompress(body))['Records']
+    assert records and all(record['eventTime'].startswith('2024-03-05') for record in records)
+    assert 40000 < len(body) < 60000
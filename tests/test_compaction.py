@@ -0,0 +1,75 @@
+import threading
+import time
+from common.archive_index import index_key, read_index, write_index
+from common.merge import map_in_order
+from conftest import DEST_BUCKET, FakeContext, keys_of
+from harness import load_handler
+
+
+def test_group_name_keeps_account_and_region():
+    handler = load_handler('plan_compaction')
+    group_name = handler.__wrapped__.__globals__['group_name']
+    assert group_name('123456789012_CloudTrail_us-east-1_20240305T.gz') == '123456789012_CloudTrail_us-east-1.gz'
+    assert group_name('123456789012_CloudTrail_us-east-1_20240306T2.gz') == '123456789012_CloudTrail_us-east-1.gz'
+    assert group_name('123456789012_CloudTrail_us-east-2_20240305T.gz') == '123456789012_CloudTrail_us-east-2.gz'
+    assert group_name('cloudwatch-stream-2024-03-05-T07-part-0002.gz') == 'cloudwatch-stream-T07.gz'
+    assert group_name('2024-03-05-1') == 'Aggregated-Logs'
+
+
+def test_map_in_order_keeps_a_bounded_window():
+    in_flight = []
+    lock = threading.Lock()
+    current = 0
+
+    def work(n):
+        nonlocal current
+        with lock:
+            current += 1
+            in_flight.append(current)
+        time.sleep(0.001)
+        with lock:
+            current -= 1
+        return n * 2
+
+    assert list(map_in_order(work, range(200), 8)) == [n * 2 for n in range(200)]
+    assert max(in_flight) <= 8
+
+
+def test_compacted_index_points_at_the_original_log_files(s3):
+    archives = []
+    for day in (1, 2, 3):
+        key = f'bucket/2024/03/0{day}/Logs.gz'
+        logs = [(f'logs/{day}-{n}', f'log {day} {n}\n'.encode() * (n + 1)) for n in range(3)]
+        body = b''.join(data for _, data in logs)
+        s3.put_object(Bucket=DEST_BUCKET, Key=key, Body=body)
+        offsets = [sum(len(data) for _, data in logs[:n]) for n in range(3)]
+        write_index(s3, DEST_BUCKET, key, [[name, offset, len(data), None]
+                                           for (name, data), offset in zip(logs, offsets)], len(body))
+        archives.append([key, len(body), None])
+
+    key = 'bucket/2024/compacted/2024-03/Logs.gz'
+    result = load_handler('compact_archives')({'key': key, 'files': archives}, FakeContext())
+    assert result == {'status': 'done'}
+    assert sorted(keys_of(s3, DEST_BUCKET)) == [key, index_key(key)]
+
+    body = s3.get_object(Bucket=DEST_BUCKET, Key=key)['Body'].read()
+    entries = read_index(s3, DEST_BUCKET, key)
+    assert len(entries) == 9
+    for name, offset, length, _ in entries:
+        day, n = map(int, name.split('/')[1].split('-'))
+        assert body[offset:offset + length] == f'log {day} {n}\n'.encode() * (n + 1)
+
+
+def test_archives_younger_than_the_minimum_age_are_not_compacted(s3, monkeypatch):
+    for day in (1, 2, 3):
+        s3.put_object(Bucket=DEST_BUCKET, Key=f'bucket/2024/03/0{day}/Logs-2024030{day}.gz', Body=b'log\n' * 10)
+
+    # Just written, they would be charged the 30 days of STANDARD_IA if deleted now
+    plan = load_handler('plan_compaction')({'period': '2024-03'}, FakeContext())
+    assert plan == {'period': '2024-03', 'groups': []}
+
+    monkeypatch.setenv('COMPACTION_MIN_AGE_DAYS', '0')
+    plan = load_handler('plan_compaction')({'period': '2024-03'}, FakeContext())
+    assert [group['key'] for group in plan['groups']] == ['bucket/2024/compacted/2024-03/Logs.gz']
+    assert [entry[0] for entry in plan['groups'][0]['files']] == \
+        [f'bucket/2024/03/0{day}/Logs-2024030{day}.gz' for day in (1, 2, 3)]
@@ -0,0 +1,108 @@
+import importlib.util
+import os
+from concurrent.futures import ThreadPoolExecutor
+from common.deletion import find_versions
+from common.manifest import save_files
+from common.merge import combine_files
+from common.scheduler import Scheduler
+from conftest import DEST_BUCKET, ROOT, SOURCE_BUCKET, TMP_BUCKET, FakeContext, keys_of
+from harness import load_handler
+
+MB = 1024 * 1024
+
+
+def load_copier():
+    spec = importlib.util.spec_from_file_location('copier', ROOT / 'functions' / 'copy_log_files' / 'copier.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Copier
+
+
+def test_combine_files_resumes_where_it_left_off(s3):
+    # Small log files appended in memory, and one large enough to be copied server-side
+    sizes = [1000 + n for n in range(20)]
+    sizes[10] = 6 * MB
+    files = []
+    for n, size in enumerate(sizes):
+        key = f'logs/{n:03d}.gz'
+        s3.put_object(Bucket=SOURCE_BUCKET, Key=key, Body=os.urandom(size))
+        files.append([key, size, None])
+
+    # Each invocation only has time for a few log files, and hands its state over
+    state, start, invocations = {}, 0, 0
+    while True:
+        invocations += 1
+        result = combine_files(s3, SOURCE_BUCKET, DEST_BUCKET, 'combined.gz', TMP_BUCKET, files[start:], start,
+                               state, Scheduler(FakeContext(calls=3), unmeasured=0, reserve=0), concurrency=4)
+        if result is None:
+            break
+        state, start = result, result['continuationMarker']
+    assert invocations > 1
+
+    combined = s3.get_object(Bucket=DEST_BUCKET, Key='combined.gz')['Body'].read()
+    originals = b''.join(s3.get_object(Bucket=SOURCE_BUCKET, Key=key)['Body'].read() for key, _, _ in files)
+    assert combined == originals
+    # Nothing parked between invocations is left in the temp bucket
+    assert keys_of(s3, TMP_BUCKET) == []
+
+
+def test_copier_copies_in_one_request_or_in_parts(s3):
+    Copier = load_copier()
+    small = os.urandom(1000)
+    large = os.urandom(11 * MB)
+    s3.put_object(Bucket=SOURCE_BUCKET, Key='small.gz', Body=small)
+    s3.put_object(Bucket=SOURCE_BUCKET, Key='large.gz', Body=large, ContentType='application/gzip')
+
+    copier = Copier(s3, multipart_threshold=5 * MB, part_size=5 * MB, max_attempts=1)
+    try:
+        assert copier.copy(SOURCE_BUCKET, 'small.gz', DEST_BUCKET, 'copies/small.gz', len(small)) is None
+        assert copier.copy(SOURCE_BUCKET, 'large.gz', DEST_BUCKET, 'copies/large.gz', len(large)) is None
+        # A failed copy is reported rather than raised
+        assert copier.copy(SOURCE_BUCKET, 'missing.gz', DEST_BUCKET, 'copies/missing.gz') is not None
+    finally:
+        copier.close()
+
+    assert s3.get_object(Bucket=DEST_BUCKET, Key='copies/small.gz')['Body'].read() == small
+    response = s3.get_object(Bucket=DEST_BUCKET, Key='copies/large.gz')
+    assert response['Body'].read() == large
+    assert response['ContentType'] == 'application/gzip'
+    assert s3.list_multipart_uploads(Bucket=DEST_BUCKET).get('Uploads', []) == []
+
+
+def test_find_versions_returns_all_versions_of_the_keys_given_only(s3):
+    for key in ('a/1.gz', 'a/1.gz', 'a/2.gz', 'a/10.gz', 'a/b/1.gz', 'c/1.gz'):
+        s3.put_object(Bucket=SOURCE_BUCKET, Key=key, Body=b'data')
+    s3.delete_object(Bucket=SOURCE_BUCKET, Key='a/2.gz')
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        versions = find_versions(s3, pool, SOURCE_BUCKET, ['a/1.gz', 'a/2.gz', 'c/1.gz'])
+
+    # Two versions of a/1.gz, a/2.gz and its delete marker, and c/1.gz, but neither
+    # a/10.gz, which shares the prefix, nor a/b/1.gz, in a subdirectory
+    keys = sorted(version['Key'] for version in versions)
+    assert keys == ['a/1.gz', 'a/1.gz', 'a/2.gz', 'a/2.gz', 'c/1.gz']
+    assert len({version['VersionId'] for version in versions}) == 5
+
+
+def test_delete_originals_reports_the_files_it_could_not_delete(s3):
+    keys = [f'logs/{n:03d}.gz' for n in range(10)]
+    for key in keys:
+        s3.put_object(Bucket=SOURCE_BUCKET, Key=key, Body=b'log')
+    data = {'bucket_name': SOURCE_BUCKET, 'files': save_files(s3, TMP_BUCKET, [[key, 3, None] for key in keys], 'test')}
+    handler = load_handler('delete_originals')
+
+    # S3 reports an error for one of the keys
+    stuck = keys[4]
+
+    def drop_stuck(params, **kwargs):
+        params['Delete']['Objects'] = [obj for obj in params['Delete']['Objects'] if obj['Key'] != stuck]
+
+    def report_stuck(parsed, **kwargs):
+        parsed.setdefault('Errors', []).append({'Key': stuck, 'Code': 'AccessDenied', 'Message': 'Access Denied'})
+
+    events = handler.__wrapped__.__globals__['s3_client'].meta.events
+    events.register('before-parameter-build.s3.DeleteObjects', drop_stuck)
+    events.register('after-call.s3.DeleteObjects', report_stuck)
+
+    assert handler(data, FakeContext()) == {'status': 'error', 'failed': [stuck]}
+    assert keys_of(s3, SOURCE_BUCKET) == [stuck]
@@ -0,0 +1,120 @@
+import gzip
+import json
+import sys
+import time
+from conftest import ROOT, SOURCE_BUCKET, STATE_BUCKET, TMP_BUCKET, FakeContext, keys_of
+from harness import load_handler
+
+sys.path.insert(0, str(ROOT / 'functions' / 'get_files'))
+import inventory  # noqa: E402
+from layout import discover_patterns, expand_patterns, list_entries  # noqa: E402
+
+INVENTORY_BUCKET = 'test-inventory-reports'
+
+
+def put_keys(s3, keys):
+    for key in keys:
+        s3.put_object(Bucket=SOURCE_BUCKET, Key=key, Body=b'log')
+
+
+def flow_log_keys(accounts, regions, days):
+    return [f'AWSLogs/{account}/vpcflowlogs/{region}/2024/03/{day:02d}/{account}_vpcflowlogs_{region}_{n}.log.gz'
+            for account in accounts for region in regions for day in days for n in range(2)]
+
+
+def access_keys(days):
+    return [f'access/2024-03-{day:02d}-{hour:02d}-00-00-{hour:04X}' for day in days for hour in range(3)]
+
+
+def test_layout_is_discovered_and_expanded_to_the_prefixes_of_a_date(s3):
+    put_keys(s3, flow_log_keys(['111122223333', '444455556666'], ['eu-west-1', 'us-east-1'], [4, 5, 6]))
+    put_keys(s3, access_keys([4, 5, 6]))
+
+    patterns = discover_patterns(s3, SOURCE_BUCKET, '')
+    assert {'segments': ['AWSLogs/', '*', 'vpcflowlogs/', '*'], 'stem': '', 'form': 'path'} in patterns
+    assert {'segments': ['access/'], 'stem': '', 'form': 'dash'} in patterns
+
+    # An account added after the discovery is still found, as account IDs are wildcards
+    put_keys(s3, flow_log_keys(['777788889999'], ['eu-west-1'], [5]))
+    prefixes = expand_patterns(s3, SOURCE_BUCKET, '', patterns, '2024-03-05')
+    assert 'AWSLogs/777788889999/vpcflowlogs/eu-west-1/2024/03/05/' in prefixes
+    assert 'access/2024-03-05' in prefixes
+
+    listed = [entry[0] for entry in list_entries(s3, SOURCE_BUCKET, prefixes)]
+    expected = (flow_log_keys(['111122223333', '444455556666'], ['eu-west-1', 'us-east-1'], [5]) +
+                flow_log_keys(['777788889999'], ['eu-west-1'], [5]) + access_keys([5]))
+    assert listed == sorted(expected)
+
+
+def test_cached_layout_is_reused_without_being_written_again(s3):
+    put_keys(s3, access_keys([4, 5, 6]))
+    handler = load_handler('get_files')
+    calls = []
+    events = handler.__wrapped__.__globals__['s3_client'].meta.events
+    events.register('provide-client-params.s3', lambda params, model, **kwargs: calls.append(
+        (model.name, params.get('Bucket'), params.get('Key'))))
+
+    def run(date):
+        calls.clear()
+        handler({'bucket_name': SOURCE_BUCKET, 'date': date}, FakeContext())
+        return list(calls)
+
+    # The layout is discovered, and cached in the state bucket, on the first run only
+    first = run('2024-03-05')
+    layout = json.loads(s3.get_object(Bucket=STATE_BUCKET, Key=f'layouts/{SOURCE_BUCKET}.json')['Body'].read())
+    assert layout['patterns'] == [{'segments': ['access/'], 'stem': '', 'form': 'dash'}]
+    assert not any(key.startswith('layouts/') for key in keys_of(s3, TMP_BUCKET))
+    assert ('PutObject', STATE_BUCKET, f'layouts/{SOURCE_BUCKET}.json') in first
+
+    # The second run lists only the prefixes of its date, and writes nothing, as its
+    # file list is small enough to be passed on inline
+    second = run('2024-03-06')
+    assert ('GetObject', STATE_BUCKET, f'layouts/{SOURCE_BUCKET}.json') in second
+    assert [call for call in second if call[0] == 'PutObject'] == []
+    assert len([call for call in second if call[0] == 'ListObjectsV2']) < \
+        len([call for call in first if call[0] == 'ListObjectsV2'])
+
+
+def put_inventory(s3, keys):
+    # A CSV report of the source bucket, as S3 Inventory writes them
+    s3.create_bucket(Bucket=INVENTORY_BUCKET)
+    folder = f'reports/{SOURCE_BUCKET}/daily/2024-03-06T01-00Z/'
+    rows = []
+    for key in keys:
+        head = s3.head_object(Bucket=SOURCE_BUCKET, Key=key)
+        rows.append(f'"{SOURCE_BUCKET}","{key}","{head["ContentLength"]}",'
+                    f'"{head["LastModified"].strftime("%Y-%m-%dT%H:%M:%S.000Z")}",{head["ETag"]}\n')
+    s3.put_object(Bucket=INVENTORY_BUCKET, Key=folder + 'data/0.csv.gz', Body=gzip.compress(''.join(rows).encode()))
+    s3.put_object(Bucket=INVENTORY_BUCKET, Key=folder + 'manifest.json', Body=json.dumps({
+        'sourceBucket': SOURCE_BUCKET,
+        'destinationBucket': f'arn:aws:s3:::{INVENTORY_BUCKET}',
+        'fileFormat': 'CSV',
+        'fileSchema': 'Bucket, Key, Size, LastModifiedDate, ETag',
+        'creationTimestamp': str(int(time.time() * 1000)),
+        'files': [{'key': folder + 'data/0.csv.gz'}],
+    }))
+    return {
+        'Id': 'daily', 'IsEnabled': True, 'IncludedObjectVersions': 'Current',
+        'OptionalFields': ['Size', 'ETag', 'LastModifiedDate'],
+        'Destination': {'S3BucketDestination': {'Bucket': f'arn:aws:s3:::{INVENTORY_BUCKET}', 'Format': 'CSV',
+                                                'Prefix': 'reports'}},
+    }
+
+
+def test_inventory_listing_finds_late_files_sorting_before_those_in_the_report(s3, monkeypatch):
+    keys = access_keys([5]) + [f'access/2024-03-05-{hour:02d}-00-00-{hour:04X}' for hour in range(3, 9)]
+    put_keys(s3, keys)
+    configuration = put_inventory(s3, keys)
+    # moto doesn't keep the fields of inventory configurations
+    monkeypatch.setattr(inventory, 'find_configuration', lambda s3_client, bucket_name: configuration)
+    monkeypatch.setattr(inventory, 'RANGE_KEYS', 3)
+
+    # After the report was taken, a log file is delivered late, with a key sorting
+    # before the last one in the report, and another one is deleted
+    late = 'access/2024-03-05-01-30-00-LATE'
+    put_keys(s3, [late])
+    s3.delete_object(Bucket=SOURCE_BUCKET, Key=keys[4])
+
+    entries = inventory.inventory_entries(s3, SOURCE_BUCKET, ['access/2024-03-05'], lambda key: True)
+    assert [entry[0] for entry in entries] == sorted(set(keys + [late]) - {keys[4]})
+    assert entries == list_entries(s3, SOURCE_BUCKET, ['access/2024-03-05'])
@@ -0,0 +1,30 @@
+from datetime import datetime
+from common.journal import Journal
+from conftest import SOURCE_BUCKET, STATE_BUCKET, TMP_BUCKET, FakeContext, keys_of
+from harness import load_handler
+from synthetic import SizeDistribution, access_log_keys, populate
+
+
+def test_bucket_recorded_done_is_skipped(s3):
+    date = datetime(2024, 3, 5)
+    populate(s3, SOURCE_BUCKET, list(access_log_keys(date, files_per_hour=1))[:4],
+             SizeDistribution(1000, 0.2, minimum=500, maximum=2000), date)
+    data = {'bucket_name': SOURCE_BUCKET, 'date': '2024-03-05'}
+    get_files = load_handler('get_files')
+    assert len(get_files(data, FakeContext())) == 4
+
+    assert load_handler('record_done')(data, FakeContext()) == {'status': 'done'}
+    assert Journal(s3, STATE_BUCKET, SOURCE_BUCKET, '2024-03-05').is_done()
+    assert not any(key.startswith('journal/') for key in keys_of(s3, TMP_BUCKET))
+    assert get_files(data, FakeContext()) == []
+
+
+def test_old_running_states_are_ignored(s3, monkeypatch):
+    journal = Journal(s3, STATE_BUCKET, SOURCE_BUCKET, '2024-03-05')
+    unit = ('CloudTrail', '111122223333')
+    journal.checkpoint(unit, {'continuationMarker': 3})
+    assert journal.get(unit)['state'] == {'continuationMarker': 3}
+
+    # The temp bucket objects such a state refers to are gone after a day
+    monkeypatch.setattr('common.journal.time.time', lambda: 2e9)
+    assert journal.get(unit) is None
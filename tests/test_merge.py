@@ -0,0 +1,69 @@
+import gzip
+import os
+import zlib
+from common.archive_index import read_index
+from common.merge import MultipartMerge, RecompressingMerge, decompressed
+from conftest import DEST_BUCKET, SOURCE_BUCKET, TMP_BUCKET, keys_of
+
+
+def test_decompressed_is_bounded_for_any_chunking():
+    members = [b'x' * (2 * 1024 * 1024), os.urandom(100000), b'hello\n' * 10000]
+    stream = b''.join(gzip.compress(member) for member in members)
+    for chunk_size in (len(stream), 65536, 1000, 7):
+        chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+        pieces = list(decompressed(chunks, separator=b'|', max_length=4096))
+        assert b''.join(pieces) == b'|'.join(members) + b'|'
+        assert max(map(len, pieces)) <= 4096
+
+
+def test_recompressed_archive_index_lists_the_log_files_of_indexed_objects(s3):
+    # Two archives, each with an index of the log files it holds
+    archives = []
+    for n in range(2):
+        logs = [(f'logs/{n}-{m}', f'archive {n} log {m}\n'.encode() * 100) for m in range(2)]
+        body = b''.join(gzip.compress(data) for _, data in logs)
+        key = f'archives/{n}.gz'
+        s3.put_object(Bucket=SOURCE_BUCKET, Key=key, Body=body)
+        archives.append((key, body, [[name, 0, len(body), None] for name, _ in logs], logs))
+
+    merge = RecompressingMerge(s3, DEST_BUCKET, 'merged.gz', TMP_BUCKET, member_size=1)
+    for key, body, entries, _ in archives:
+        merge.add(SOURCE_BUCKET, key, len(body), None, body, None, entries)
+    merge.complete()
+
+    merged = s3.get_object(Bucket=DEST_BUCKET, Key='merged.gz')['Body'].read()
+    index = {name: (offset, length) for name, offset, length, _ in read_index(s3, DEST_BUCKET, 'merged.gz')}
+    assert sorted(index) == ['logs/0-0', 'logs/0-1', 'logs/1-0', 'logs/1-1']
+    for _, _, _, logs in archives:
+        for name, data in logs:
+            offset, length = index[name]
+            assert data in zlib.decompress(merged[offset:offset + length], wbits=31)
+
+
+def test_resuming_from_an_earlier_state_uses_its_own_parked_buffer(s3):
+    logs = [(f'logs/{n}', f'log {n}\n'.encode() * (100 + n)) for n in range(6)]
+    for key, body in logs:
+        s3.put_object(Bucket=SOURCE_BUCKET, Key=key, Body=body)
+
+    def resume(state, start, end):
+        merge = MultipartMerge(s3, DEST_BUCKET, 'merged', TMP_BUCKET, state['uploadId'], state['partCount'],
+                               offset=state['offset'])
+        for key, body in logs[start:end]:
+            merge.add(SOURCE_BUCKET, key, len(body), None, body)
+        return merge
+
+    merge = MultipartMerge(s3, DEST_BUCKET, 'merged', TMP_BUCKET)
+    for key, body in logs[:2]:
+        merge.add(SOURCE_BUCKET, key, len(body), None, body)
+    state = merge.suspend()
+
+    # The state of the next suspension is lost, as if the checkpoint had failed, so
+    # the merge is resumed from the first state once more
+    resume(state, 2, 4).suspend()
+    resume(state, 2, 6).complete()
+
+    merged = s3.get_object(Bucket=DEST_BUCKET, Key='merged')['Body'].read()
+    assert merged == b''.join(body for _, body in logs)
+    for (key, body), (name, offset, length, _) in zip(logs, read_index(s3, DEST_BUCKET, 'merged')):
+        assert name == key and merged[offset:offset + length] == body
+    assert keys_of(s3, TMP_BUCKET) == []
@@ -0,0 +1,69 @@
+import gzip
+import io
+import json
+import sys
+import pytest
+from common.scheduler import Scheduler
+from conftest import DEST_BUCKET, ROOT, SOURCE_BUCKET, FakeContext, keys_of
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+sys.path.insert(0, str(ROOT / 'functions' / 'process_account'))
+from parquet_output import parquet_prefix, write_parquet  # noqa: E402
+
+ACCOUNT = '111122223333'
+
+
+def cloudtrail_file(n, events):
+    # A CloudTrail log file, with the events of an hour in reverse order of time
+    return {'Records': [{
+        'eventVersion': '1.09',
+        'eventTime': f'2024-03-05T{n:02d}:{59 - m:02d}:00Z',
+        'eventName': f'Event{n}-{m}',
+        'readOnly': m % 2 == 0,
+        'userIdentity': {'type': 'AssumedRole', 'accountId': ACCOUNT},
+        'customField': n,
+    } for m in range(events)]}
+
+
+def test_cloudtrail_is_written_as_parquet_across_invocations(s3):
+    files = []
+    for n in range(4):
+        key = f'o-test/AWSLogs/o-test/{ACCOUNT}/CloudTrail/eu-west-1/2024/03/05/{ACCOUNT}_CloudTrail_{n}.json.gz'
+        body = gzip.compress(json.dumps(cloudtrail_file(n, 10 + n)).encode())
+        s3.put_object(Bucket=SOURCE_BUCKET, Key=key, Body=body)
+        files.append([key, len(body), None])
+
+    # Each invocation only has time for a few log files, and hands its state over
+    state, start, invocations = {}, 0, 0
+    while True:
+        invocations += 1
+        state = write_parquet(s3, SOURCE_BUCKET, DEST_BUCKET, 'o-test', 'CloudTrail', ACCOUNT, '2024-03-05', 'Trail',
+                              files[start:], start, state.get('fileNumber', 0),
+                              Scheduler(FakeContext(calls=2), unmeasured=0, reserve=0), concurrency=4)
+        if state is None:
+            break
+        start = state['continuationMarker']
+    assert invocations > 1
+
+    # Each invocation wrote files of its own, numbered on from those of the one before,
+    # in the partition of the account, region and date
+    prefix = parquet_prefix('o-test', 'CloudTrail', ACCOUNT, 'eu-west-1', '2024-03-05')
+    assert prefix == f'o-test/parquet/CloudTrail/account={ACCOUNT}/region=eu-west-1/date=2024-03-05/'
+    keys = keys_of(s3, DEST_BUCKET)
+    assert keys == [f'{prefix}Trail-{n:05d}.parquet' for n in range(1, len(keys) + 1)]
+    assert len(keys) == invocations
+
+    tables = [pq.read_table(io.BytesIO(s3.get_object(Bucket=DEST_BUCKET, Key=key)['Body'].read())) for key in keys]
+    assert sum(table.num_rows for table in tables) == sum(10 + n for n in range(4))
+    rows = [row for table in tables for row in table.to_pylist()]
+    assert sorted(row['eventName'] for row in rows) == sorted(f'Event{n}-{m}' for n in range(4) for m in range(10 + n))
+
+    # Sorted on the time within each row group, with the other fields kept as JSON
+    for table in tables:
+        times = table.column('eventTime').to_pylist()
+        assert times == sorted(times)
+    row = rows[0]
+    assert json.loads(row['userIdentity']) == {'type': 'AssumedRole', 'accountId': ACCOUNT}
+    assert row['readOnly'] in ('true', 'false')
+    assert 'customField' in json.loads(row['other'])
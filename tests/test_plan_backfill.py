@@ -0,0 +1,22 @@
+from datetime import datetime
+from conftest import SOURCE_BUCKET, STATE_BUCKET, TMP_BUCKET, FakeContext, keys_of
+from harness import load_handler
+from synthetic import SizeDistribution, control_tower_keys, populate
+
+
+def test_backfill_plan_is_kept_and_dates_done_are_left_out(s3):
+    date = datetime(2024, 3, 5)
+    keys = list(control_tower_keys('o-test', ['111122223333'], ['us-east-1'], date, files_per_hour=1))
+    populate(s3, SOURCE_BUCKET, keys, SizeDistribution(1000, 0.2, minimum=500, maximum=2000), date)
+
+    handler = load_handler('plan_backfill')
+    data = {'bucket_name': SOURCE_BUCKET, 'date_list': ['2024-03-04', '2024-03-05', '2024-03-06']}
+    plan = handler(data, FakeContext())
+    assert sorted(plan['dates']) == data['date_list']
+
+    # The plan and the dates done, as recorded by the state machine, are in the state
+    # bucket, which doesn't expire them with the temp bucket
+    s3.put_object(Bucket=STATE_BUCKET, Key=f"{plan['prefix']}done/2024-03-05", Body=b'')
+    assert keys_of(s3, TMP_BUCKET) == []
+    resumed = handler(data, FakeContext())
+    assert sorted(resumed['dates']) == ['2024-03-04', '2024-03-06']
@@ -0,0 +1,90 @@
+import gzip
+import json
+import sys
+from datetime import date
+from common.archive_index import index_key, is_index_key, write_index
+from conftest import DEST_BUCKET, ROOT, FakeContext, keys_of
+from harness import load_handler
+
+sys.path.insert(0, str(ROOT / 'tools'))
+from query_logs import Predicate, query
+
+ACCOUNTS = ['111111111111', '222222222222', '333333333333']
+
+
+def put_daily_archive(s3, day):
+    # A daily archive of one gzipped CloudTrail log file per account, with its index
+    key = f'bucket/2024/03/0{day}/CloudTrail.gz'
+    logs = []
+    for account in ACCOUNTS:
+        log_file = f'AWSLogs/o-test/{account}/CloudTrail/us-east-1/2024/03/0{day}/{account}_CloudTrail_0{day}.json.gz'
+        records = [{'eventTime': f'2024-03-0{day}T0{n}:00:00Z', 'eventName': f'Event{n}',
+                    'recipientAccountId': account} for n in range(3)]
+        logs.append((log_file, gzip.compress(json.dumps({'Records': records}).encode())))
+    body = b''.join(data for _, data in logs)
+    s3.put_object(Bucket=DEST_BUCKET, Key=key, Body=body)
+
+    entries = []
+    for log_file, data in logs:
+        entries.append([log_file, sum(entry[2] for entry in entries), len(data), None])
+    write_index(s3, DEST_BUCKET, key, entries, len(body))
+    return key, len(body), entries
+
+
+def record_ranges(s3):
+    # The (key, Range) of every GetObject of an archive, as requested
+    ranges = []
+
+    def record(params, **kwargs):
+        if not is_index_key(params['Key']):
+            ranges.append((params['Key'], params.get('Range')))
+
+    s3.meta.events.register('provide-client-params.s3.GetObject', record)
+    return ranges
+
+
+def test_a_single_log_file_is_read_out_of_a_daily_archive(s3):
+    key, _, entries = put_daily_archive(s3, 5)
+    ranges = record_ranges(s3)
+
+    records = list(query(s3, DEST_BUCKET, [date(2024, 3, 5)], key_contains='222222222222'))
+    assert [record['recipientAccountId'] for record in records] == ['222222222222'] * 3
+    assert [record['eventName'] for record in records] == ['Event0', 'Event1', 'Event2']
+
+    # Only the bytes of that log file are fetched
+    _, offset, length, _ = entries[1]
+    assert ranges == [(key, f'bytes={offset}-{offset + length - 1}')]
+
+    # Adjacent log files are fetched together, and the predicate applies to their records
+    ranges.clear()
+    records = list(query(s3, DEST_BUCKET, [date(2024, 3, 5)], predicate=Predicate({'eventName': 'Event1'})))
+    assert sorted(record['recipientAccountId'] for record in records) == ACCOUNTS
+    assert ranges == [(key, f'bytes=0-{sum(entry[2] for entry in entries) - 1}')]
+
+
+def test_a_single_day_is_read_out_of_a_compacted_archive(s3):
+    archives = [put_daily_archive(s3, day) for day in (1, 2, 3)]
+    key = 'bucket/2024/compacted/2024-03/CloudTrail.gz'
+    result = load_handler('compact_archives')(
+        {'key': key, 'files': [[archive, size, None] for archive, size, _ in archives]}, FakeContext())
+    assert result == {'status': 'done'}
+    assert sorted(keys_of(s3, DEST_BUCKET)) == [key, index_key(key)]
+
+    ranges = record_ranges(s3)
+    records = list(query(s3, DEST_BUCKET, [date(2024, 3, 2)], roots=['bucket']))
+    assert len(records) == 9
+    assert {record['eventTime'][:10] for record in records} == {'2024-03-02'}
+
+    # Only the part of the archive which came from the daily archive of that day is fetched
+    document = json.loads(gzip.decompress(s3.get_object(Bucket=DEST_BUCKET, Key=index_key(key))['Body'].read()))
+    [(_, start, length, _)] = [day for day in document['days'] if day[0] == '2024-03-02']
+    assert ranges == [(key, f'bytes={start}-{start + length - 1}')]
+
+    # And out of it, only the log file asked for
+    ranges.clear()
+    records = list(query(s3, DEST_BUCKET, [date(2024, 3, 2)], roots=['bucket'], key_contains='333333333333'))
+    assert {(record['recipientAccountId'], record['eventTime'][:10]) for record in records} == \
+        {('333333333333', '2024-03-02')}
+    [(_, byte_range)] = ranges
+    first, last = map(int, byte_range[len('bytes='):].split('-'))
+    assert start < first and last == start + length - 1
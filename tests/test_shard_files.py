@@ -0,0 +1,60 @@
+import json
+from datetime import datetime
+from conftest import SOURCE_BUCKET, TMP_BUCKET, FakeContext
+from harness import load_handler
+from synthetic import SizeDistribution, populate
+
+ACCOUNTS = ['111122223333', '444455556666', '777788889999']
+
+
+def shard(handler, files, operation_type):
+    return handler({'bucket_name': SOURCE_BUCKET, 'date': '2024-03-05', 'files': files,
+                    'operation_type': operation_type}, FakeContext())
+
+
+def read_list(s3, key):
+    return json.loads(s3.get_object(Bucket=TMP_BUCKET, Key=key)['Body'].read())
+
+
+def test_accounts_are_found_in_keys():
+    account_of = load_handler('shard_files').__wrapped__.__globals__['account_of']
+    assert account_of('AWSLogs/111122223333/vpcflowlogs/eu-west-1/2024/03/05/x.log.gz') == '111122223333'
+    assert account_of('elb/AWSLogs/444455556666_elasticloadbalancing_eu-west-1_app.log.gz') == '444455556666'
+    # Longer runs of digits are not account IDs
+    assert account_of('stream-1709596800123456/part-0001.gz') == ''
+    assert account_of('access/2024-03-05-14-00-00-ABCDEF') == ''
+
+
+def test_hours_are_found_right_after_the_date():
+    hour_of = load_handler('shard_files').__wrapped__.__globals__['hour_patterns']('2024-03-05')
+    assert hour_of('AWSLogs/111122223333/vpcflowlogs/eu-west-1/2024/03/05/14/x.log.gz') == 'T14'
+    assert hour_of('flows/2024/3/5/09/x.log.gz') == 'T09'
+    assert hour_of('access/2024-03-05-14-00-00-ABCDEF') == 'T14'
+    assert hour_of('111122223333_vpcflowlogs_eu-west-1_fl-1_20240305T2355Z_hash.log.gz') == 'T23'
+    # Another date, no hour, or no valid hour
+    assert hour_of('access/2024-03-06-14-00-00-ABCDEF') == ''
+    assert hour_of('AWSLogs/111122223333/vpcflowlogs/eu-west-1/2024/03/05/x.log.gz') == ''
+    assert hour_of('access/2024-03-05-31-00-00-ABCDEF') == ''
+
+
+def test_too_many_parts_to_return_inline_are_handed_to_the_distributed_map(s3, monkeypatch):
+    date = datetime(2024, 3, 5)
+    keys = [f'AWSLogs/{account}/vpcflowlogs/eu-west-1/2024/03/05/{account}_{n}.log.gz'
+            for account in ACCOUNTS for n in range(4)]
+    objects = populate(s3, SOURCE_BUCKET, keys, SizeDistribution(2000, 0.2, minimum=1000, maximum=4000), date)
+    files = [[key, size, None] for key, size in sorted(objects.items())]
+
+    # One part per account, returned inline
+    parts = shard(load_handler('shard_files'), files, 'aggregate_per_account')
+    assert [(part['shard'], part['part']) for part in parts] == [(account, None) for account in ACCOUNTS]
+
+    # More parts than may be returned inline: the same parts, each an archive of its
+    # own, are listed in the temp bucket instead
+    monkeypatch.setenv('MAX_INLINE_PARTS', '2')
+    result = shard(load_handler('shard_files'), files, 'aggregate_per_account')
+    assert result['count'] == len(ACCOUNTS)
+    slices = read_list(s3, result['slicesKey'])
+    assert read_list(s3, result['assembliesKey']) == []
+    assert [item['slice'] for item in slices] == [False] * len(ACCOUNTS)
+    for account, item in zip(ACCOUNTS, slices):
+        assert account in item['key']
@@ -0,0 +1,68 @@
+import json
+from datetime import datetime
+from common.archive_index import index_key, read_index
+from conftest import DEST_BUCKET, SOURCE_BUCKET, TMP_BUCKET, FakeContext, keys_of
+from harness import load_handler
+from synthetic import SizeDistribution, access_log_keys, populate
+
+
+def run(handler, data, result_name):
+    # Invokes a handler until it no longer hands a continuationMarker over, as the
+    # Choice states of the state machines do
+    while True:
+        data[result_name] = handler(data, FakeContext())
+        if 'continuationMarker' not in data[result_name]:
+            return data[result_name]
+
+
+def read_list(s3, key):
+    return json.loads(s3.get_object(Bucket=TMP_BUCKET, Key=key)['Body'].read())
+
+
+def test_slices_are_assembled_into_their_archive(s3, monkeypatch):
+    monkeypatch.setenv('DISTRIBUTED_MAP_THRESHOLD', '10')
+    monkeypatch.setenv('MAX_FILES_PER_PART', '5')
+    date = datetime(2024, 3, 5)
+    sizes = SizeDistribution(2000, 0.2, minimum=1000, maximum=4000)
+    objects = populate(s3, SOURCE_BUCKET, list(access_log_keys(date, files_per_hour=1))[:12], sizes, date)
+    files = [[key, size, None] for key, size in sorted(objects.items())]
+
+    shards = load_handler('shard_files')({'bucket_name': SOURCE_BUCKET, 'date': '2024-03-05', 'files': files,
+                                          'operation_type': 'aggregate_all'}, FakeContext())
+    slices = read_list(s3, shards['slicesKey'])
+    assemblies = read_list(s3, shards['assembliesKey'])
+    assert shards['count'] == len(slices) == 3
+    assert [item['key'] for item in slices] == assemblies[0]['files']
+
+    combine = load_handler('combine_log_files')
+    for item in slices:
+        data = {'bucket_name': SOURCE_BUCKET, 'date': '2024-03-05', **item}
+        run(combine, data, 'combineMainLogsResult')
+
+    # The slices are combined into the temp bucket, as STANDARD, never into the archive bucket
+    archive = assemblies[0]['key']
+    assert all(item['slice'] for item in slices)
+    assert keys_of(s3, DEST_BUCKET) == []
+    listed = s3.list_objects_v2(Bucket=TMP_BUCKET, Prefix=archive.rpartition('/')[0])['Contents']
+    classes = {entry['Key']: entry['StorageClass'] for entry in listed}
+    for item in slices:
+        assert classes[item['key']] == classes[index_key(item['key'])] == 'STANDARD'
+
+    assemble = load_handler('assemble_slices')
+    result = run(assemble, {'bucket_name': SOURCE_BUCKET, **assemblies[0]}, 'assembleSlicesResult')
+
+    # Only the archive and its index are left, and the index points at every original
+    assert result == {'status': 'done'}
+    assert sorted(keys_of(s3, DEST_BUCKET)) == [archive, index_key(archive)]
+    assert not any(key in classes for key in keys_of(s3, TMP_BUCKET))
+    # The archive is STANDARD_IA, its small index STANDARD
+    stored = {obj['Key']: obj['StorageClass'] for obj in s3.list_objects_v2(Bucket=DEST_BUCKET)['Contents']}
+    assert stored == {archive: 'STANDARD_IA', index_key(archive): 'STANDARD'}
+    versions = s3.list_object_versions(Bucket=DEST_BUCKET)
+    assert len(versions['Versions']) == 2 and 'DeleteMarkers' not in versions
+    body = s3.get_object(Bucket=DEST_BUCKET, Key=archive)['Body'].read()
+    entries = read_index(s3, DEST_BUCKET, archive)
+    assert [entry[0] for entry in entries] == [entry[0] for entry in files]
+    for key, offset, length, _ in entries:
+        original = s3.get_object(Bucket=SOURCE_BUCKET, Key=key)['Body'].read()
+        assert body[offset:offset + length] == original
@@ -0,0 +1,18 @@
+from common.throttle import RateController
+
+
+def test_window_starts_small_and_backs_off():
+    controller = RateController(max_window=256, initial_window=32)
+    group = ('bucket', 'prefix')
+    controller.acquire(group)
+    assert controller.windows[group].size == 32
+
+    # The first SlowDown already holds back a lambda with 32 threads
+    controller.throttled(group)
+    assert controller.windows[group].size == 16
+    controller.release(group)
+
+    # It widens by about one per window of requests that succeed, up to the largest
+    for _ in range(40000):
+        controller.succeeded(group)
+    assert controller.windows[group].size == 256
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# The code shared by the lambdas
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'layers', 'common'))
+from common.archive_index import is_index_key, read_index_document
+from common.compaction import compacted_prefix, periods_of
+from common.manifest import decode_chunk
+from common.merge import decompressed
+
+
+# Retrieves log records from the aggregated log archives, fetching as little as possible.
+#
+# Archives are found under {root}/{YYYY}/{MM}/{DD}/, where the root is the name of the
+# source bucket when a common destination bucket is used, or the final aggregation
+# prefix when working in place, or, once compacted, under {root}/{YYYY}/compacted/
+# {period}/, where the index tells which part of an archive holds which day. For
+# archives with an index, only the original log files which can contain matching
+# records are fetched, using ranged GETs, adjacent ones together. Archives without an index are streamed in full. Either way, the data
+# is decompressed one gzip member at a time as it arrives, and each line is checked
+# for the literal values of the predicate before it is parsed, so most lines never are.
+#
+# Example, as a command:
+#
+#   tools/query_logs.py --bucket all-aggregated-logs-111122223333-xx-xxxxx-1 \
+#       --root aws-controltower-logs-111122223333-xx-xxxxx-1 --name CloudTrail \
+#       --start 2024-03-05T02:00:00Z --end 2024-03-05T03:00:00Z \
+#       --key-contains 123456789012 --where eventName=ConsoleLogin
+#
+# Matching records are written to standard output as JSON lines. The same is available
+# from Python through query(), which yields the records.
+
+MB = 1024 * 1024
+
+# Adjacent original log files are fetched together, up to this many bytes at a time
+MAX_RANGE_SIZE = 8 * MB
+
+# Log files are delivered some time after the events they contain: CloudTrail logs
+# usually within 15 minutes, but at times hours late, and Config history files every
+# 6 hours. An original log file last modified more than this after the end of the time
+# window is skipped.
+DELIVERY_SLACK = {
+    'CloudTrail': timedelta(hours=12),
+    'Config': timedelta(hours=24),
+}
+DEFAULT_DELIVERY_SLACK = timedelta(hours=24)
+
+
+# A conjunction of field equalities and a time window. Fields are given as dotted
+# paths, e.g. 'userIdentity.accountId'. Lines which aren't JSON, like those of S3 access
+# logs, are matched on the values alone.
+class Predicate:
+
+    def __init__(self, equals=None, start=None, end=None, time_field='eventTime'):
+        self.equals = equals or {}
+        self.start = start
+        self.end = end
+        self.time_field = time_field
+
+        # The values which must occur literally in the raw text of a matching line.
+        # Values which would be escaped in JSON can't be looked for like this.
+        self.needles = []
+        for value in self.equals.values():
+            text = value if isinstance(value, str) else json.dumps(value)
+            if json.dumps(text)[1:-1] == text and '/' not in text:
+                self.needles.append(text.encode())
+
+    def may_match_line(self, line):
+        return all(needle in line for needle in self.needles)
+
+    def may_match_log_file(self, log_file, last_modified):
+        # Whether an original log file last modified at the given Unix time can hold
+        # records within the time window
+        if last_modified is None:
+            return True
+        modified = datetime.fromtimestamp(last_modified, timezone.utc)
+        if self.start and modified < self.start:
+            return False
+        if self.end and modified > self.end + delivery_slack(log_file):
+            return False
+        return True
+
+    def matches(self, record):
+        if isinstance(record, str):
+            return True
+        for field, value in self.equals.items():
+            actual = get_field(record, field)
+            if actual != value and str(actual) != str(value):
+                return False
+        if self.start or self.end:
+            time = parse_time(get_field(record, self.time_field))
+            if time is None:
+                return False
+            if self.start and time < self.start:
+                return False
+            if self.end and time >= self.end:
+                return False
+        return True
+
+
+def delivery_slack(log_file):
+    # The delivery slack for the log type of a Control Tower main log file, from
+    # .../{log type}/{region}/..., or the default for other log files
+    for log_type, slack in DELIVERY_SLACK.items():
+        if f'/{log_type}/' in log_file:
+            return slack
+    return DEFAULT_DELIVERY_SLACK
+
+
+def get_field(record, path):
+    for name in path.split('.'):
+        if not isinstance(record, dict):
+            return None
+        record = record.get(name)
+    return record
+
+
+def parse_time(value):
+    if not isinstance(value, str):
+        return None
+    try:
+        time = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return time if time.tzinfo else time.replace(tzinfo=timezone.utc)
+
+
+def query(s3_client, bucket, dates, roots=None, name=None, key_contains=None, predicate=None,
+          concurrency=16):
+    # Yields the records matching the predicate from the archives of the given dates.
+    # The roots default to all of them, and name, if given, must occur in the file
+    # name of an archive. key_contains, if given, must occur in the keys of the
+    # original log files; this can only be checked for archives with an index.
+    predicate = predicate or Predicate()
+    if roots is None:
+        roots = list_roots(s3_client, bucket)
+    archives = [
+        (archive, None)
+        for root in roots
+        for date in dates
+        for archive in list_archives(s3_client, bucket, f"{root}/{date.strftime('%Y/%m/%d')}/", name)
+    ]
+
+    # The compacted archives of the weeks and months of the dates, each listed once, along
+    # with the dates wanted from them
+    compacted = {}
+    for root in roots:
+        for date in dates:
+            for first_day, period in periods_of(date):
+                compacted.setdefault(compacted_prefix(root, first_day, period), set()).add(date.strftime('%Y-%m-%d'))
+    archives += [
+        (archive, days)
+        for prefix, days in compacted.items()
+        for archive in list_archives(s3_client, bucket, prefix, name)
+    ]
+
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        plans = pool.map(lambda archive: plan_ranges(s3_client, bucket, *archive, key_contains, predicate),
+                         archives)
+        ranges = (r for plan in plans for r in plan)
+
+        # Fetch ranges concurrently, handing over the results in order, with a bounded
+        # number of ranges in flight
+        window = deque()
+        for key, byte_range in ranges:
+            window.append(pool.submit(fetch_records, s3_client, bucket, key, byte_range, predicate))
+            if len(window) >= concurrency:
+                yield from window.popleft().result()
+        while window:
+            yield from window.popleft().result()
+    finally:
+        # Don't plan or fetch anything more if the consumer stops early, e.g. at --limit
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def list_roots(s3_client, bucket):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    return [
+        prefix['Prefix'].rstrip('/')
+        for page in paginator.paginate(Bucket=bucket, Delimiter='/')
+        for prefix in page.get('CommonPrefixes', [])
+    ]
+
+
+def list_archives(s3_client, bucket, prefix, name=None):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            if is_index_key(key) or (name and name not in key.rpartition('/')[2]):
+                continue
+            yield key
+
+
+def plan_ranges(s3_client, bucket, key, days, key_contains, predicate):
+    # Returns the (key, (start, end)) byte ranges of the archive to fetch, where a range
+    # of None stands for the whole archive. For a compacted archive, days holds the dates
+    # wanted, and only the parts of it which came from the daily archives of those dates
+    # are fetched.
+    try:
+        document = read_index_document(s3_client, bucket, key)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidObjectState':
+            raise
+        # An index larger than GlacierObjectSize follows its archive into Glacier
+        print(f"Skipping {key}, whose index must be restored from Glacier first", file=sys.stderr)
+        return []
+    if document is None:
+        return [(key, None)]
+
+    spans = None
+    if days is not None:
+        spans = [(offset, offset + length) for day, offset, length, _ in document.get('days', []) if day in days]
+        if not spans:
+            return []
+
+    ranges = []
+    for log_file, offset, length, last_modified in decode_chunk(document):
+        if spans is not None and not any(start <= offset < end for start, end in spans):
+            continue
+        if key_contains and key_contains not in log_file:
+            continue
+        if not predicate.may_match_log_file(log_file, last_modified):
+            continue
+        if ranges and ranges[-1][0] <= offset < ranges[-1][1]:
+            # In a recompressed archive, log files share the gzip member holding them
+            continue
+        if ranges and ranges[-1][1] == offset and offset + length - ranges[-1][0] <= MAX_RANGE_SIZE:
+            ranges[-1] = (ranges[-1][0], offset + length)
+        else:
+            ranges.append((offset, offset + length))
+    return [(key, byte_range) for byte_range in ranges]
+
+
+def fetch_records(s3_client, bucket, key, byte_range, predicate):
+    kwargs = {'Range': f'bytes={byte_range[0]}-{byte_range[1] - 1}'} if byte_range else {}
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key, **kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'InvalidObjectState':
+            print(f"Skipping {key}, which must be restored from Glacier first", file=sys.stderr)
+            return []
+        raise
+
+    records = []
+    for line in iter_lines(decompressed(response['Body'].iter_chunks(MB), separator=b'\n')):
+        if not predicate.may_match_line(line):
+            continue
+        records += [record for record in parse_records(line) if predicate.matches(record)]
+    return records
+
+
+def iter_lines(chunks):
+    partial = []
+    for data in chunks:
+        lines = data.split(b'\n')
+        if len(lines) > 1:
+            partial.append(lines[0])
+            yield b''.join(partial)
+            yield from lines[1:-1]
+            partial = []
+        partial.append(lines[-1])
+    last = b''.join(partial)
+    if last:
+        yield last
+
+
+def parse_records(line):
+    # A line is a whole CloudTrail or Config log file, a JSON record, or plain text
+    text = line.decode('utf-8', errors='replace').strip()
+    if not text:
+        return []
+    try:
+        document = json.loads(text)
+    except ValueError:
+        return [text]
+    if isinstance(document, dict):
+        for field in ('Records', 'configurationItems'):
+            if isinstance(document.get(field), list):
+                return document[field]
+        return [document]
+    if isinstance(document, list):
+        return document
+    return [text]
+
+
+def parse_condition(condition):
+    # FIELD=VALUE, where the value is taken as JSON if it is, e.g. readOnly=true, and as
+    # a string otherwise, e.g. eventName=ConsoleLogin
+    field, value = condition.split('=', 1)
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return field, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retrieves log records from aggregated log archives.")
+    parser.add_argument('--bucket', required=True, help="The bucket holding the archives")
+    parser.add_argument('--root', action='append', dest='roots',
+                        help="A source bucket name, or the final aggregation prefix. May be repeated. Default: all.")
+    parser.add_argument('--date', action='append', dest='dates', type=lambda s: datetime.strptime(s, '%Y-%m-%d'),
+                        help="A date, YYYY-MM-DD. May be repeated. Default: the days of the time window.")
+    parser.add_argument('--start', type=parse_time, help="The start of the time window, ISO 8601, inclusive")
+    parser.add_argument('--end', type=parse_time, help="The end of the time window, ISO 8601, exclusive")
+    parser.add_argument('--time-field', default='eventTime', help="The time field of the records. Default: eventTime.")
+    parser.add_argument('--name', help="Only archives with this in their file name, e.g. CloudTrail")
+    parser.add_argument('--key-contains', help="Only original log files with this in their key, e.g. an account ID")
+    parser.add_argument('--where', action='append', default=[], metavar='FIELD=VALUE',
+                        help="A field which must have a value, e.g. eventName=ConsoleLogin. May be repeated.")
+    parser.add_argument('--limit', type=int, help="The maximum number of records to output")
+    parser.add_argument('--concurrency', type=int, default=16, help="The number of concurrent requests")
+    parser.add_argument('--endpoint-url', help="The S3 endpoint, for S3-compatible storage")
+    parser.add_argument('--profile', help="The AWS profile to use")
+    parser.add_argument('--region', help="The AWS region to use")
+    args = parser.parse_args()
+
+    dates = args.dates
+    if not dates:
+        if not args.start:
+            parser.error("Either --date or --start must be given")
+        end = args.end or args.start
+        dates = [args.start + timedelta(days=n) for n in range((end.date() - args.start.date()).days + 1)]
+
+    equals = dict(parse_condition(condition) for condition in args.where)
+    predicate = Predicate(equals, args.start, args.end, args.time_field)
+
+    session = boto3.Session(profile_name=args.profile, region_name=args.region)
+    s3_client = session.client('s3', endpoint_url=args.endpoint_url,
+                               config=Config(max_pool_connections=args.concurrency))
+
+    records = query(s3_client, args.bucket, dates, args.roots, args.name, args.key_contains, predicate,
+                    args.concurrency)
+    for n, record in enumerate(records, start=1):
+        print(record if isinstance(record, str) else json.dumps(record))
+        if args.limit and n >= args.limit:
+            break
+
+
+if __name__ == '__main__':
+    main()